@@ -1,9 +1,12 @@
 import getpass
 import logging
 import sys
+import threading
 import traceback
 from collections import OrderedDict
 from pprint import pprint
+from time import time, perf_counter
+from typing import Optional
 
 import requests
 from requests import RequestException
@@ -12,7 +15,9 @@ from requests.auth import HTTPBasicAuth
 from urllib3 import Retry, disable_warnings
 from urllib3.exceptions import InsecureRequestWarning
 
-from DCNM_errors import DCNMConnectionError, DCNMAuthenticationError, DCNMUnauthorizedError
+from DCNM_errors import DCNMConnectionError, DCNMAuthenticationError, DCNMUnauthorizedError, DCNMOfflineError
+from DCNM_utils import LogPreview
+from metrics import RequestMetrics
 
 logger = logging.getLogger(__name__)
 
@@ -45,7 +50,8 @@ class DcnmRestApi:
 
     def __init__(self, device, *args, port=443, connection_timeout=30, read_timeout=60, verify=False,
                  total_retries=10, read_retries=3, connect_retries=3, status_retries=3, backoff_factor=0.3,
-                 status_forcelist=(413, 429, 502, 503, 504), dryrun=False, **kwargs):
+                 status_forcelist=(413, 429, 502, 503, 504), dryrun=False, token_refresh_margin=300,
+                 token_cache=None, trace_sink=None, hooks=None, offline=False, **kwargs):
         self.headers = {
             'Content-Type': "application/json"
         }
@@ -66,6 +72,7 @@ class DcnmRestApi:
         self.status_forcelist = status_forcelist
         retry = Retry(total=total_retries, read=read_retries, connect=connect_retries, status=status_retries,
                       backoff_factor=backoff_factor, status_forcelist=status_forcelist)
+        self.retry = retry
         adapter = HTTPAdapter(max_retries=retry)
 
         self.connection = requests.Session()
@@ -73,18 +80,56 @@ class DcnmRestApi:
         self.connection.mount("https://", adapter)
 
         self.login_expiration_time = 1000000000
+        # seconds before the token expires at which it is proactively refreshed
+        self.token_refresh_margin = token_refresh_margin
+        self._token_expires: Optional[float] = None
+        self._username: Optional[str] = None
+        self._password: Optional[str] = None
+        # only one thread at a time may log on again, the others wait for the new token
+        self._logon_lock = threading.RLock()
+        # optional token_cache.TokenCache, lets repeated cli runs reuse a token instead of logging on
+        self.token_cache = token_cache
+        # optional DCNM_utils.TraceSink, receives full request and response bodies
+        self.trace_sink = trace_sink
+        # metrics.RequestHooks instances notified of every request and re-logon
+        self.hooks = list(hooks) if hooks else []
         self._timeout = (connection_timeout, read_timeout)
         self.verify = verify
         self._auth = False
-        logger.debug("dryrun set to : {}".format(dryrun))
-        self.dryrun = dryrun
+        # offline runs work from an exported inventory, nothing is sent to the controller
+        self.offline = offline
+        logger.debug("dryrun set to : {}".format(dryrun or offline))
+        self.dryrun = dryrun or offline
 
-    def logon(self, username=None, password=None):
+    def mount(self, adapter):
+        """
+        :param adapter: requests transport adapter to send the https requests through, e.g. the record and
+        replay adapters of the cassette module
+        """
+        self.connection.mount("https://", adapter)
+
+    def logon(self, username=None, password=None, use_cache=True):
         """ DCNM Login Method.
+
+        If a token cache is configured and use_cache is True, a cached token that is not about to expire
+        is used instead of logging on.
         """
 
+        if self.offline:
+            logger.info("offline mode, not logging on to {}".format(self.device))
+            return
+
+        if use_cache and self.token_cache is not None:
+            if username is None:
+                username = input("Enter username: ")
+                print(username)
+            if self._logon_from_cache(username):
+                return
+
         path = "/logon"
         data = "{{'expirationTime': {}}}".format(self.login_expiration_time)
+        # a rejected token stays in self.headers for the requests in flight, it must not be sent with the logon
+        headers = {k: v for k, v in self.headers.items() if k != 'Dcnm-Token'}
 
         try:
             for _ in range(self.retries):
@@ -98,7 +143,7 @@ class DcnmRestApi:
                         prompt="Enter password for user {}: ".format(username))
 
                 auth = HTTPBasicAuth(username, password)
-                response = self.connection.post(self.dcnm_url_prepend + path, data, headers=self.headers, auth=auth,
+                response = self.connection.post(self.dcnm_url_prepend + path, data, headers=headers, auth=auth,
                                                 timeout=self.timeout, verify=self.verify)
                 if response.status_code == 500:
                     print("Invalid credentials. Failed to perform logon.")
@@ -127,7 +172,25 @@ class DcnmRestApi:
             raise
         self.headers["Dcnm-Token"] = info["DATA"]["Dcnm-Token"]
         self.txt_headers["Dcnm-Token"] = info["DATA"]["Dcnm-Token"]
+        # login_expiration_time is in milliseconds
+        self._token_expires = time() + self.login_expiration_time / 1000
+        self._username = username
+        self._password = password
         self._auth = True
+        if self.token_cache is not None:
+            self.token_cache.save(self.device, username, self.token, self._token_expires)
+
+    def _logon_from_cache(self, username: str) -> bool:
+        cached = self.token_cache.load(self.device, username, margin=self.token_refresh_margin)
+        if cached is None:
+            return False
+        token, self._token_expires = cached
+        self.headers["Dcnm-Token"] = token
+        self.txt_headers["Dcnm-Token"] = token
+        self._username = username
+        self._auth = True
+        logger.info("logon: using cached token for user {} on {}".format(username, self.device))
+        return True
 
     def logout(self):
         method = "POST"
@@ -143,7 +206,8 @@ class DcnmRestApi:
                                                              "Invalid token. Failed to perform logout.")],
                                          skip_authcheck=True)
             logger.debug("logout: response: {}".format(info))
-            if self._auth: del (self.headers["Dcnm-Token"])
+            if self.token_cache is not None and self._username is not None:
+                self.token_cache.remove(self.device, self._username)
         except requests.ConnectionError as e:
             msg = "Error on attempt to logout from DCNM controller: {}".format(e)
             data = self._simple_exception_handler(info, msg)
@@ -161,8 +225,8 @@ class DcnmRestApi:
         finally:
             # Clean up tokens
             self._auth = False
-            del self.headers["Dcnm-Token"]
-            del self.txt_headers["Dcnm-Token"]
+            self.headers.pop("Dcnm-Token", None)
+            self.txt_headers.pop("Dcnm-Token", None)
 
     def check_url_connection(self, url, headers):
         # Verify HTTPS request URL for DCNM controller is accessible
@@ -176,7 +240,7 @@ class DcnmRestApi:
                 info = self._verify_response(response, "HEAD")
                 logger.debug("check_url_connection: info: {}".format(info))
             except DCNMUnauthorizedError:
-                if self._re_logon():
+                if self._re_logon(stale_token=headers.get("Dcnm-Token")):
                     response = self.connection.head(self.physical, verify=False, timeout=self.timeout)
                     info = {}
                     info = self._verify_response(response, "HEAD")
@@ -185,23 +249,64 @@ class DcnmRestApi:
             data, msg = self._exception_handler(URL_CHECK_EXCEPTIONS, (url, e), info)
             raise DCNMConnectionError(self._return_info(None, "HEAD", url, msg, json_respond_data=data))
 
-    def _re_logon(self):
-        self._auth = False
-        del self.headers["Dcnm-Token"]
-        del self.txt_headers["Dcnm-Token"]
-        logger.critical(
-            "Unauthorized access to DCNM resource {}. Token no good. Attempting to re-login".format(self.physical))
-        try:
-            self.logon()
-        except RequestException as e:
-            msg = "Error on attempt to re-logon to DCNM controller: {}".format(e)
-            raise DCNMConnectionError(self._return_info(None, "HEAD", self.physical, msg))
-        except DCNMAuthenticationError as e:
-            logger.critical("Error in attempting to re-logon to DCNM controller: {}".format(e))
-            raise
-        if not self.auth:
-            raise DCNMAuthenticationError("Token is no longer good and attempt to re-logon failed./n")
-        return True
+    def add_hook(self, hook):
+        """ register a metrics.RequestHooks instance """
+        self.hooks.append(hook)
+
+    def _call_hooks(self, event: str, *args):
+        # instrumentation must never break a request
+        for hook in self.hooks:
+            try:
+                getattr(hook, event)(*args)
+            except Exception:
+                logger.exception("request hook {} failed on {}".format(hook, event))
+
+    def _re_logon(self, stale_token: Optional[str] = None, proactive: bool = False) -> bool:
+        """
+        Single-flight token refresh. The first request to find its token rejected logs on again while
+        any other request that hits the same problem waits on the lock. A request arriving after the
+        token it used has already been replaced returns straight away and retries with the new token.
+        The token is swapped in place, so requests still in flight never see the headers without one.
+        """
+        with self._logon_lock:
+            if stale_token is not None and self.token is not None and self.token != stale_token:
+                logger.debug("_re_logon: token already refreshed by another request")
+                return True
+            # _auth stays set while logging on again so that concurrent 401s are still reported as
+            # DCNMUnauthorizedError and wait on the lock rather than failing outright
+            if not proactive:
+                logger.critical("Unauthorized access to DCNM resource {}. Token no good. "
+                                "Attempting to re-login".format(self.physical))
+            self._call_hooks('relogon', self.device, proactive)
+            try:
+                self.logon(username=self._username, password=self._password, use_cache=False)
+            except RequestException as e:
+                self._auth = False
+                msg = "Error on attempt to re-logon to DCNM controller: {}".format(e)
+                raise DCNMConnectionError(self._return_info(None, "HEAD", self.physical, msg))
+            except (DCNMAuthenticationError, DCNMConnectionError) as e:
+                self._auth = False
+                logger.critical("Error in attempting to re-logon to DCNM controller: {}".format(e))
+                raise
+            if not self.auth:
+                raise DCNMAuthenticationError("Token is no longer good and attempt to re-logon failed./n")
+            return True
+
+    def _refresh_token_if_expiring(self):
+        """
+        Log on again before the token reaches login_expiration_time so that long running jobs do not
+        find out about an expired token through a burst of 401 responses
+        """
+        if not self._auth or self._token_expires is None:
+            return
+        if time() < self._token_expires - self.token_refresh_margin:
+            return
+        stale_token = self.token
+        with self._logon_lock:
+            if self.token != stale_token:
+                return
+            logger.info("Dcnm-Token expires within {} seconds. Refreshing.".format(self.token_refresh_margin))
+            self._re_logon(stale_token=stale_token, proactive=True)
 
     def get(self, path, headers=None, data=None, errors=None, data_type="json", **kwargs):
         info = self.send_request('get', path, headers=headers, data=data, errors=errors, data_type=data_type, **kwargs)
@@ -228,6 +333,8 @@ class DcnmRestApi:
         elif data is None:
             data = ""
 
+        self._refresh_token_if_expiring()
+
         if headers:
             local_headers = headers
             local_headers["Dcnm-Token"] = self.token
@@ -244,17 +351,28 @@ class DcnmRestApi:
             raise DCNMConnectionError(self._return_info(None, method, path, msg))
 
         url = self.dcnm_url_prepend + path
-        logger.debug(
-            "send_request: method {}: url: {}, headers: {}, kwargs: {}".format(method, url, local_headers, kwargs))
+        if logger.isEnabledFor(logging.DEBUG):
+            # headers are not logged, they carry the token
+            logger.debug("send_request: method %s: url: %s, kwargs: %s", method, url, kwargs)
         if self.dryrun and method in {'post', 'put', 'delete'}:
             logger.debug("Dryrun enabled. Returning OK code for this send_request")
             return {"RETURN_CODE": 200}
+        if self.offline:
+            raise DCNMOfflineError("offline mode: {} {} needs the DCNM controller, the data must be loaded from an "
+                                   "inventory instead".format(method.upper(), path))
         #self.check_url_connection(url, local_headers)
         info = {}
 
         try:
-            for _ in range(2):
-                logger.debug("send_request: data: {}".format(data))
+            for attempt in range(2):
+                logger.debug("send_request: data: %s", LogPreview(data))
+                if headers:
+                    local_headers["Dcnm-Token"] = self.token
+                sent_token = local_headers.get("Dcnm-Token")
+                metrics = None
+                if self.hooks:
+                    metrics = RequestMetrics(method, path)
+                    self._call_hooks('request_start', metrics)
                 try:
                     if data_type == "json":
                         response = self.connection.request(method, url, json=data,
@@ -266,12 +384,24 @@ class DcnmRestApi:
                                                            headers=local_headers, timeout=self.timeout,
                                                            verify=self.verify,
                                                            **kwargs)
-                    logger.debug("send_request: response: {}".format(response))
-                    info = self._verify_response(response, method, errors)
+                    logger.debug("send_request: response: %s", response)
+                    if metrics is not None:
+                        metrics.response(response)
+                    if self.trace_sink is not None:
+                        self.trace_sink.record(method=method, url=url, status=response.status_code, request=data,
+                                               response=self._response_to_json(response))
+                    info = self._verify_response(response, method, errors=errors, metrics=metrics)
+                    break
                 except DCNMUnauthorizedError:
-                    if self._re_logon():
+                    # retry once with the refreshed token, a second rejection is a real failure
+                    if attempt == 0 and self._re_logon(stale_token=sent_token):
                         continue
-            logger.debug("send_request: returning info {}".format(info))
+                    raise
+                finally:
+                    if metrics is not None:
+                        metrics.finish()
+                        self._call_hooks('request_end', metrics)
+            logger.debug("send_request: returning info %s", LogPreview(info))
         except tuple(REQUESTS_EXCEPTIONS.keys()) as e:
             data, msg = self._exception_handler(REQUESTS_EXCEPTIONS, (method, url, e), info)
             if e.args:
@@ -308,12 +438,17 @@ class DcnmRestApi:
         return data
 
     def _verify_response(self, response, method, path=None, msg=None, data=None,
-                         errors=None, skip_authcheck=False):
+                         errors=None, skip_authcheck=False, metrics=None):
         """ Process the return code and response object from DCNM """
 
 
         msg = response.text
-        jrd = self._response_to_json(response)
+        if metrics is not None:
+            decode_start = perf_counter()
+            jrd = self._response_to_json(response)
+            metrics.decode_time = perf_counter() - decode_start
+        else:
+            jrd = self._response_to_json(response)
         rc = response.status_code
         path = response.url
 
@@ -348,7 +483,7 @@ class DcnmRestApi:
 
         info = {'RETURN_CODE': rc, 'METHOD': method, 'REQUEST_PATH': path, 'MESSAGE': msg, 'DATA': json_respond_data}
 
-        logger.debug("_return_info: {}".format(info))
+        logger.debug("_return_info: %s", LogPreview(info))
         return info
 
     @property
@@ -373,7 +508,8 @@ class DcnmRestApi:
     def __repr__(self):
         """self, device, *args, port=443, connection_timeout=30, read_timeout=60, verify=False,
                  total_retries=10, read_retries=3, connect_retries=3, status_retries=3, backoff_factor=0.3,
-                 status_forcelist=(413, 429, 502, 503, 504), dryrun=False, **kwargs
+                 status_forcelist=(413, 429, 502, 503, 504), dryrun=False, token_refresh_margin=300,
+                 token_cache=None, **kwargs
         """
         return f'{type(self).__name__}({self.device!r}, ' \
                f'port={self.port!r}, ' \
@@ -386,7 +522,9 @@ class DcnmRestApi:
                f'status_retries={self.status_retries!r},' \
                f'backoff_factor={self.backoff_factor!r},' \
                f'status_forcelist={self.status_forcelist!r},' \
-               f'dryrun={self.dryrun!r})'
+               f'token_refresh_margin={self.token_refresh_margin!r},' \
+               f'dryrun={self.dryrun!r},' \
+               f'offline={self.offline!r})'
 
 
 if __name__ == '__main__':
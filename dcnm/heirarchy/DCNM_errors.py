@@ -44,6 +44,10 @@ class DCNMValueError(Exception):
 class DCNMConnectionError(Exception):
     pass
 
+
+class DCNMOfflineError(DCNMConnectionError):
+    pass
+
 class DCNMAuthenticationError(Exception):
     pass
 
@@ -1,4 +1,5 @@
 import functools
+import json
 import logging
 import re
 import sys
@@ -200,3 +201,55 @@ def _check_patterns(patterns: List[Union[str, tuple]], string_to_check: Union[st
         logger.error("_check_patterns: patterns wrong type {}".format(patterns))
         raise DCNMParameterError("patterns must be a list or tuple")
     return False
+
+
+# longest rendering of a payload written to the debug log, full payloads go to a TraceSink
+LOG_PREVIEW_LENGTH = 512
+
+
+class LogPreview:
+    """
+    Lazily rendered, truncated view of a payload for use as a logging argument
+
+    logger.debug("data: %s", LogPreview(data)) only builds the string if a handler actually emits the record,
+    so large request and response bodies cost nothing when DEBUG is disabled.
+    """
+    __slots__ = ('obj', 'length')
+
+    def __init__(self, obj, length: int = LOG_PREVIEW_LENGTH):
+        self.obj = obj
+        self.length = length
+
+    def __str__(self):
+        text = str(self.obj)
+        if len(text) > self.length:
+            return "{}... <{} more characters>".format(text[:self.length], len(text) - self.length)
+        return text
+
+
+class TraceSink:
+    """
+    Writes full request and response bodies to a file, one JSON object per line.
+
+    Only enabled when explicitly requested, e.g. with the --trace command line option. Tokens are never written,
+    headers are not recorded.
+    """
+
+    def __init__(self, file: str):
+        self.file = file
+        self._lock = threading.Lock()
+        self._f = open(file, 'a')
+
+    def record(self, **fields):
+        fields.setdefault('time', time())
+        line = json.dumps(fields, default=str)
+        with self._lock:
+            self._f.write(line + '\n')
+            self._f.flush()
+
+    def close(self):
+        with self._lock:
+            self._f.close()
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.file!r})'
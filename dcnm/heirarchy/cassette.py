@@ -0,0 +1,210 @@
+"""
+Record and replay of the http traffic of the REST client
+
+RecordingAdapter is a requests transport adapter that sends requests like the default adapter and appends every
+request/response pair to a gzip compressed cassette of newline delimited json:
+
+    {"format": "dcnm-cassette", "version": 1, "created": 1634567890.1}
+    {"method": "GET", "path": "/rest/...", "body": "<request body digest>", "status": 200,
+     "headers": {"Content-Type": "application/json"}, "elapsed": 0.132, "content": "<response body>"}
+    ...
+
+Request headers are not recorded, so neither are the token or the basic auth credentials of the logon. Tokens
+returned in a response body are replaced by <scrubbed>, there and everywhere they appear later in the cassette.
+
+ReplayAdapter serves a cassette back without a network, optionally sleeping for the recorded latencies. Requests
+are matched on method and path, preferring a recorded request with the same body. Recorded responses are served
+in order and the last one for a path is repeated, so status polling runs as long as it needs to.
+"""
+import gzip
+import hashlib
+import json
+import logging
+import threading
+from collections import defaultdict, deque
+from time import perf_counter, sleep, time
+from typing import Deque, Dict, Optional, Set, Tuple
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+from DCNM_errors import DCNMFileError
+
+logger = logging.getLogger(__name__)
+
+CASSETTE_FORMAT = "dcnm-cassette"
+CASSETTE_VERSION = 1
+SCRUBBED = "<scrubbed>"
+# json keys whose values are secrets, compared in lower case
+TOKEN_KEYS = {'dcnm-token', 'token', 'jwttoken', 'password'}
+# response headers kept in the cassette
+KEPT_HEADERS = ('Content-Type',)
+
+
+def _path(url: str) -> str:
+    parts = urlsplit(url)
+    return parts.path + ('?' + parts.query if parts.query else '')
+
+
+def _body_digest(body) -> str:
+    if not body:
+        return ''
+    if isinstance(body, str):
+        body = body.encode()
+    return hashlib.sha1(body).hexdigest()[:16]
+
+
+def _find_secrets(data, secrets: Set[str]):
+    """ add the values of TOKEN_KEYS found anywhere in the decoded json data to secrets """
+    if isinstance(data, dict):
+        for key, value in data.items():
+            if isinstance(value, str) and key.lower() in TOKEN_KEYS and value:
+                secrets.add(value)
+            else:
+                _find_secrets(value, secrets)
+    elif isinstance(data, list):
+        for value in data:
+            _find_secrets(value, secrets)
+
+
+class RecordingAdapter(HTTPAdapter):
+    """
+    HTTPAdapter that records every exchange to a cassette file. Mount it on the REST client with
+    DcnmRestApi.mount and close it at the end of the run.
+    """
+
+    def __init__(self, file: str, **kwargs):
+        super().__init__(**kwargs)
+        self.file = file
+        self.count = 0
+        self._secrets: Set[str] = set()
+        self._lock = threading.Lock()
+        self._f = gzip.open(file, 'wt', compresslevel=6)
+        self._f.write(json.dumps({'format': CASSETTE_FORMAT, 'version': CASSETTE_VERSION, 'created': time()}) + '\n')
+
+    def send(self, request, **kwargs):
+        start = perf_counter()
+        response = super().send(request, **kwargs)
+        elapsed = perf_counter() - start
+        self._record(request, response, elapsed)
+        return response
+
+    def _scrub(self, content: str) -> str:
+        try:
+            _find_secrets(json.loads(content), self._secrets)
+        except ValueError:
+            pass
+        for secret in self._secrets:
+            content = content.replace(secret, SCRUBBED)
+        return content
+
+    def _record(self, request, response, elapsed: float):
+        content = response.content.decode(response.encoding or 'utf-8', 'replace') if response.content else ''
+        with self._lock:
+            if self._f.closed:
+                return
+            entry = {'method': request.method, 'path': _path(request.url), 'body': _body_digest(request.body),
+                     'status': response.status_code,
+                     'headers': {k: response.headers[k] for k in KEPT_HEADERS if k in response.headers},
+                     'elapsed': round(elapsed, 6), 'content': self._scrub(content)}
+            self._f.write(json.dumps(entry, separators=(',', ':')) + '\n')
+            self.count += 1
+
+    def close(self):
+        with self._lock:
+            if not self._f.closed:
+                self._f.close()
+                logger.info("cassette: recorded {} requests to {}".format(self.count, self.file))
+        super().close()
+
+
+class ReplayAdapter(BaseAdapter):
+    """
+    Transport adapter that answers requests from a cassette file instead of the network
+
+    :param file: cassette written by RecordingAdapter
+    :type file: str
+    :param latency: sleep for the recorded elapsed time of each response
+    :type latency: bool
+    :param latency_scale: multiplier applied to the recorded latencies
+    :type latency_scale: float
+    """
+
+    def __init__(self, file: str, latency: bool = False, latency_scale: float = 1.0):
+        super().__init__()
+        self.file = file
+        self.latency = latency
+        self.latency_scale = latency_scale
+        self._lock = threading.Lock()
+        self._recorded: Dict[Tuple[str, str], Deque[dict]] = defaultdict(deque)
+        self.count = 0
+        self._load()
+
+    def _load(self):
+        try:
+            with gzip.open(self.file, 'rt') as f:
+                header = json.loads(f.readline())
+                if not isinstance(header, dict) or header.get('format') != CASSETTE_FORMAT:
+                    raise DCNMFileError("{} is not a cassette file".format(self.file))
+                if header['version'] > CASSETTE_VERSION:
+                    raise DCNMFileError("cassette {} has version {}, this program reads up to version {}".format(
+                        self.file, header['version'], CASSETTE_VERSION))
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self._recorded[(entry['method'], entry['path'])].append(entry)
+                        self.count += 1
+        except (OSError, EOFError, ValueError) as e:
+            # EOFError is a cassette cut short by a crash, the requests read so far are still served
+            if not self.count:
+                raise DCNMFileError("unable to read cassette {}: {}".format(self.file, e))
+            logger.warning("cassette: {} is truncated, replaying the {} requests read".format(self.file, self.count))
+        logger.info("cassette: loaded {} requests from {}".format(self.count, self.file))
+
+    def _next(self, method: str, path: str, body: str) -> Optional[dict]:
+        with self._lock:
+            recorded = self._recorded.get((method, path))
+            if not recorded:
+                return None
+            entry = next((e for e in recorded if e['body'] == body), recorded[0])
+            # the last response of a path is repeated rather than used up
+            if len(recorded) > 1:
+                recorded.remove(entry)
+            return entry
+
+    @staticmethod
+    def _synthetic(path: str) -> Optional[dict]:
+        """ logon and logout always succeed, a run recorded with a cached token has no logon to replay """
+        if path.endswith('/logon'):
+            return {'status': 200, 'headers': {'Content-Type': 'application/json'}, 'elapsed': 0.0,
+                    'content': json.dumps({'Dcnm-Token': SCRUBBED})}
+        if path.endswith('/logout'):
+            return {'status': 200, 'headers': {}, 'elapsed': 0.0, 'content': ''}
+        return None
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        path = _path(request.url)
+        entry = self._next(request.method, path, _body_digest(request.body)) or self._synthetic(path)
+        if entry is None:
+            raise requests.ConnectionError("cassette {} has no recorded response for {} {}".format(
+                self.file, request.method, path), request=request)
+        if self.latency and entry['elapsed']:
+            sleep(entry['elapsed'] * self.latency_scale)
+        response = requests.Response()
+        response.status_code = entry['status']
+        response.reason = 'Replayed'
+        response.headers = CaseInsensitiveDict(entry['headers'])
+        response._content = entry['content'].encode()
+        response.encoding = 'utf-8'
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        return response
+
+    def close(self):
+        pass
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.file!r}, latency={self.latency!r})'
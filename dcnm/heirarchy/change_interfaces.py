@@ -1,15 +1,23 @@
 import argparse
 import logging
-from pickle import dump
+import os
 from time import strftime, gmtime
-from typing import Union, Optional, Dict, List
+from typing import Union, Optional, Dict, List, Iterable, Mapping
 
 from DCNM_connect import DcnmRestApi
 from handler import Handler
-from interfaces_utilities import depickle, _get_serial_numbers
+from interfaces_utilities import _get_serial_numbers
 from interfaces_utilities import get_interfaces_to_change, push_to_dcnm, \
     deploy_to_fabric_using_interface_deploy, verify_interface_change, _dbg, deploy_to_fabric_using_switch_deploy
 from plugin_utils import PlugInEngine
+from journal import ChangeJournal, DEFAULT_JOURNAL, PUT, POLICY
+from metrics import MetricsAggregator
+from offline import load_inventory, save_inventory
+from profiler import PhaseProfiler, phase
+from snapshot import dump_interfaces_snapshot, load_snapshot
+from cassette import RecordingAdapter, ReplayAdapter
+from token_cache import TokenCache, DEFAULT_TOKEN_CACHE
+from DCNM_utils import TraceSink
 
 
 def command_args(plugins: List[str]) -> argparse.Namespace:
@@ -47,7 +55,8 @@ def command_args(plugins: List[str]) -> argparse.Namespace:
     parser.add_argument("-e", "--all", action="store_true",
                         help="perform actions for all switches")
     parser.add_argument("-x", "--excel", metavar="EXCEL_FILE",
-                        help="descriptions xlsx file")
+                        help="descriptions xlsx, csv or parquet file. the parsed file is cached in\n"
+                             "~/.dcnm/descriptions by content, set DCNM_DESCRIPTIONS_CACHE to change or disable")
     parser.add_argument("-g", "--debug", action="store_true",
                         help="Shortcut for setting screen and logfile levels to DEBUG")
     parser.add_argument("-s", "--screenloglevel", default="INFO",
@@ -55,14 +64,16 @@ def command_args(plugins: List[str]) -> argparse.Namespace:
     parser.add_argument("-l", "--loglevel", default=None,
                         choices=['NONE', 'DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
                         help="Default is NONE.")
-    parser.add_argument("-p", "--pickle", default="switches_configuration_policies.pickle",
+    parser.add_argument("-p", "--pickle", default="switches_configuration_policies.snap",
                         metavar="FILE",
-                        help="filename for pickle file used to save original switch configuration policies\n"
-                             "if included for deploy, it must also be included for backout")
-    parser.add_argument("-i", "--icpickle", default="interfaces_existing_conf.pickle",
+                        help="filename for snapshot file used to save original switch configuration policies\n"
+                             "if included for deploy, it must also be included for backout.\n"
+                             "pickle files from earlier versions are still accepted for backout")
+    parser.add_argument("-i", "--icpickle", default="interfaces_existing_conf.snap",
                         metavar="FILE",
-                        help="filename for pickle file used to save original interface configuration policies\n"
-                             "if included for deploy, it must also be included for backout")
+                        help="filename for snapshot file used to save original interface configuration policies\n"
+                             "if included for deploy, it must also be included for backout.\n"
+                             "pickle files from earlier versions are still accepted for backout")
     parser.add_argument("-j", "--switch_deploy", action="store_true",
                         help="By default interface deploy is used (along with policy deploy when needed.\n"
                              "In certain situations this can lead to the need for a second deploy especially \n"
@@ -81,6 +92,53 @@ def command_args(plugins: List[str]) -> argparse.Namespace:
                         metavar="FILE",
                         help="filename for yaml file containing uplink information\n"
                              "default filename is 'uplinks.yaml'")
+    parser.add_argument("-k", "--token-cache", nargs="?", const=DEFAULT_TOKEN_CACHE, default=None,
+                        metavar="FILE",
+                        help="reuse the DCNM token between runs. The token is kept encrypted in FILE\n"
+                             "(default {}) and the session is not logged out at the end of the run.\n"
+                             "The key comes from DCNM_TOKEN_CACHE_KEY, --token-cache-key or the OS keyring\n"
+                             "(keyring package), without one the cache is disabled".format(DEFAULT_TOKEN_CACHE))
+    parser.add_argument("--token-cache-key", metavar="KEYFILE", default=None,
+                        help="read the token cache key from KEYFILE, created if missing. Keep it where the\n"
+                             "readers of the cache cannot read it, next to the cache it only obfuscates the token")
+    parser.add_argument("--journal", default=DEFAULT_JOURNAL, metavar="FILE",
+                        help="file recording each pushed interface and completed deploy, default is {}".format(
+                            DEFAULT_JOURNAL))
+    parser.add_argument("--resume", action="store_true",
+                        help="continue an interrupted run from its journal. work the journal records as done\n"
+                             "is skipped and the snapshots of the interrupted run are kept")
+    parser.add_argument("--legacy-pickle", action="store_true",
+                        help="read --pickle and --icpickle files written as pickles by earlier versions.\n"
+                             "loading a pickle can run arbitrary code, only use it for files from trusted locations.\n"
+                             "convert them once with python snapshot.py FILE instead")
+    parser.add_argument("--profile", nargs="?", const="change_interfaces_profile", default=None,
+                        metavar="PREFIX",
+                        help="profile the phases of the run. prints wall, cpu and network wait time per phase and\n"
+                             "writes PREFIX.collapsed (flamegraph input) and PREFIX.<phase>.pstats")
+    parser.add_argument("--trace", metavar="FILE", default=None,
+                        help="write the full body of every DCNM request and response to FILE as json lines.\n"
+                             "tokens and headers are not written. the debug log only holds truncated previews")
+    parser.add_argument("--workers", type=int, default=1, metavar="N",
+                        help="run the plugins that support it in N processes, default is 1.\n"
+                             "worth it for large fabrics, the processes take time to start")
+
+    parser.add_argument("--offline", metavar="DIR", default=None,
+                        help="run the plugins against the inventory saved in DIR by --save-inventory without\n"
+                             "connecting to DCNM, and list the interfaces that would change. nothing is pushed,\n"
+                             "deployed or snapshotted. IP_or_DNS_NAME is not contacted")
+    parser.add_argument("--save-inventory", metavar="DIR", default=None,
+                        help="save the interfaces, switches and switch policies collected from DCNM to DIR\n"
+                             "for later --offline runs")
+
+    cassette = parser.add_mutually_exclusive_group()
+    cassette.add_argument("--record", metavar="FILE", default=None,
+                          help="record every DCNM request and response to the cassette FILE (gzipped json lines).\n"
+                               "tokens are scrubbed and request headers are not recorded")
+    cassette.add_argument("--replay", metavar="FILE", default=None,
+                          help="answer DCNM requests from the cassette FILE written by --record instead of the\n"
+                               "controller. use separate snapshot and journal files from the recorded run")
+    parser.add_argument("--replay-latency", action="store_true",
+                        help="with --replay, wait the recorded response time of each request")
 
     dryrun = parser.add_mutually_exclusive_group()
     dryrun.add_argument("--dryrun",
@@ -93,10 +151,16 @@ def command_args(plugins: List[str]) -> argparse.Namespace:
                         const=False)
     dryrun.set_defaults(dryrun=True)
 
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.offline and (args.backout or args.resume or not args.dryrun):
+        parser.error("--offline can not be combined with --backout, --resume or --deploy")
+    return args
 
 
-def _normal_deploy(args: argparse.Namespace, handler: Handler, plugins: PlugInEngine):
+def _normal_deploy(args: argparse.Namespace, handler: Handler, plugins: PlugInEngine,
+                   journal: Optional[ChangeJournal]):
     """
 
     :param args: cli options provided by user
@@ -106,6 +170,8 @@ def _normal_deploy(args: argparse.Namespace, handler: Handler, plugins: PlugInEn
     :type handler: Handler
     :param plugins: object responsible for running user specified plugins for choosing interfaces to change
     :type: plugins: PlugInEngine
+    :param journal: record of completed work, used to skip that work when resuming. None for offline and dry runs
+    :type journal: ChangeJournal or None
 
     master function to push changes to dcnm, deploy changes to fabric and verify changes based on cli args
     """
@@ -113,37 +179,79 @@ def _normal_deploy(args: argparse.Namespace, handler: Handler, plugins: PlugInEn
     if args.verbose:
         _dbg("Pushing to DCNM and Deploying")
     serials = _get_serial_numbers(args)
-    handler.get_interfaces_nvpairs(serial_numbers=serials)
-    if args.all:
-        handler.get_all_switches()
-    else:
-        handler.get_switches_by_serial_number(serial_numbers=serials)
+    with phase("collect"):
+        if args.offline:
+            load_inventory(handler, args.offline, serial_numbers=serials)
+        else:
+            handler.get_interfaces_nvpairs(serial_numbers=serials)
+            if args.all:
+                handler.get_all_switches()
+            else:
+                handler.get_switches_by_serial_number(serial_numbers=serials)
+            if args.save_inventory:
+                save_inventory(handler, args.save_inventory)
     if args.verbose:
         _dbg("number of leaf switches", len(handler.all_leaf_switches))
         _dbg("leaf switches", handler.all_leaf_switches)
     policy_ids: Union[set, list, None] = None
-    interfaces_will_change, interfaces_existing_conf = get_interfaces_to_change(handler, plugins, args, serials)
-    with open(args.icpickle, 'wb') as f:
-        dump(interfaces_existing_conf, f)
+    with phase("plan"):
+        interfaces_will_change, interfaces_existing_conf = get_interfaces_to_change(handler, plugins, args, serials)
+    if args.offline:
+        _dbg("OFFLINE: {} interfaces would change".format(len(interfaces_will_change)),
+             interfaces_will_change if args.verbose else sorted(interfaces_will_change))
+        return
+    if args.resume and os.path.isfile(args.icpickle):
+        # the interrupted run's snapshot holds the configuration from before any change was pushed
+        logger.info("resume: keeping existing snapshot {}".format(args.icpickle))
+    else:
+        with phase("snapshot"):
+            dump_interfaces_snapshot(interfaces_existing_conf, args.icpickle)
     if args.verbose:
         _dbg("interfaces to change", interfaces_will_change)
-    _deploy_stub(args, handler, interfaces_will_change, policy_ids, serials)
+    _deploy_stub(args, handler, interfaces_will_change, policy_ids, serials, journal,
+                 fields=plugins.changed_fields)
+
+
+def _journal_run(args: argparse.Namespace) -> dict:
+    """
+    the mode, the selected changes and the main arguments written into the journal, --resume only continues a
+    journal that matches them
+    """
+    return {'mode': 'backout' if args.backout else 'deploy', 'switch_deploy': args.switch_deploy, 'all': args.all,
+            'plugins': sorted(args.plugins), 'mgmt': getattr(args, 'mgmt', False),
+            'serials': sorted(args.serials or []), 'input_file': args.input_file}
 
 
 def _deploy_stub(args: argparse.Namespace, handler: Handler, interfaces_will_change: dict,
-                 policy_ids: Optional[Union[list, tuple, str]], serials: list):
-    success: set = push_to_dcnm(handler, interfaces_will_change, verbose=args.verbose)
-    if args.switch_deploy:
-        deploy_to_fabric_using_switch_deploy(handler, serials, deploy_timeout=args.timeout, verbose=args.verbose)
-    else:
-        deploy_to_fabric_using_interface_deploy(handler, success, policies=policy_ids, deploy_timeout=args.timeout,
-                                                fallback=args.backout,
-                                                verbose=args.verbose)
+                 policy_ids: Optional[Union[list, tuple, str]], serials: list, journal: Optional[ChangeJournal],
+                 fields: Optional[Mapping[tuple, Iterable[str]]] = None):
+    with phase("push"):
+        success: set = push_to_dcnm(handler, interfaces_will_change, verbose=args.verbose, journal=journal)
+    if journal is not None and journal.resume:
+        # interfaces pushed by the interrupted run no longer show up as changes but may still need deploying
+        success |= journal.completed(PUT)
+    if journal is not None:
+        journal.checkpoint("push")
+    with phase("deploy"):
+        if args.switch_deploy:
+            deploy_to_fabric_using_switch_deploy(handler, serials, deploy_timeout=args.timeout, verbose=args.verbose,
+                                                 journal=journal)
+        else:
+            deploy_to_fabric_using_interface_deploy(handler, success, policies=policy_ids,
+                                                    deploy_timeout=args.timeout, fallback=args.backout,
+                                                    verbose=args.verbose, journal=journal)
     # Verify
-    verify_interface_change(handler, interfaces_will_change, serial_numbers=serials, verbose=args.verbose)
+    if journal is not None:
+        journal.checkpoint("deploy")
+    with phase("verify"):
+        # a fallback restores whole interfaces, so it has no changed fields and compares all of them
+        verify_interface_change(handler, interfaces_will_change, serial_numbers=serials, verbose=args.verbose,
+                                fields=fields)
+    if journal is not None:
+        journal.checkpoint("verify")
 
 
-def _fallback(args: argparse.Namespace, handler: Handler, plugins: PlugInEngine):
+def _fallback(args: argparse.Namespace, handler: Handler, plugins: PlugInEngine, journal: Optional[ChangeJournal]):
     """
     fallback to original config: push changes to dcnm, deploy changes to fabric and verify changes based on cli args
     """
@@ -152,37 +260,46 @@ def _fallback(args: argparse.Namespace, handler: Handler, plugins: PlugInEngine)
     logger.info("FALLING BACK")
     serials = _get_serial_numbers(args)
     if args.switch_deploy:
-        if args.all:
-            handler.get_all_switches()
-        else:
-            handler.get_switches_by_serial_number(serial_numbers=serials)
+        with phase("collect"):
+            if args.all:
+                handler.get_all_switches()
+            else:
+                handler.get_switches_by_serial_number(serial_numbers=serials)
         if args.verbose:
             _dbg("number of leaf switches", len(handler.all_leaf_switches))
             _dbg("leaf switches", handler.all_leaf_switches)
 
-    interfaces_existing_conf = depickle(args.icpickle)
+    with phase("load snapshot"):
+        # only the switches being restored are read from the snapshot
+        interfaces_existing_conf = load_snapshot(args.icpickle, serial_numbers=serials,
+                                                 allow_pickle=args.legacy_pickle)
     if args.verbose:
         _dbg("these interface configs will be restored", interfaces_existing_conf)
 
     policy_ids: Union[list, None] = None
     if args.description and not args.excel:
-        interface_desc_policies: Dict[str, list] = depickle(args.pickle)
+        interface_desc_policies: Dict[str, list] = load_snapshot(args.pickle, serial_numbers=serials,
+                                                                 allow_pickle=args.legacy_pickle)
         policy_ids: set = set()
-        for serial_number in interface_desc_policies:
-            for policy in interface_desc_policies[serial_number]:
-                handler.post_new_policy(policy)
-                policy_ids.add(policy["policyId"])
+        with phase("restore policies"):
+            for serial_number in interface_desc_policies:
+                for policy in interface_desc_policies[serial_number]:
+                    policy_ids.add(policy["policyId"])
+                    if journal is not None and journal.is_done(POLICY, policy["policyId"]):
+                        continue
+                    if handler.post_new_policy(policy) and journal is not None:
+                        journal.record(POLICY, policy["policyId"])
         policy_ids: list = list(policy_ids)
         if args.verbose:
             _dbg("these switch policies will be restored", interface_desc_policies)
-    _deploy_stub(args, handler, interfaces_existing_conf, policy_ids, serials)
+    _deploy_stub(args, handler, interfaces_existing_conf, policy_ids, serials, journal)
 
 
 if __name__ == '__main__':
     # initialize plugins
     plugins = PlugInEngine()
     # parse cli args
-    args = command_args(list(plugins.plugins.keys()))
+    args = command_args(plugins.plugin_names)
     mode = "DRYRUN" if args.dryrun else "DEPLOY"
 
     # set up screen logging
@@ -222,8 +339,30 @@ if __name__ == '__main__':
     print("args parsed -- Running in %s mode" % mode)
     if args.verbose:
         _dbg("Connecting to DCNM...")
-    dcnm = DcnmRestApi(args.dcnm, dryrun=args.dryrun)
-    dcnm.logon(username=args.username)
+    # a replayed run has no real token to cache
+    token_cache: Optional[TokenCache] = TokenCache(args.token_cache, args.token_cache_key) \
+        if args.token_cache and not args.replay else None
+    trace_sink: Optional[TraceSink] = TraceSink(args.trace) if args.trace else None
+    request_metrics = MetricsAggregator()
+    # the plugin measurements are reported with the request metrics
+    plugins.add_hook(request_metrics)
+    profiler: Optional[PhaseProfiler] = PhaseProfiler(args.profile) if args.profile else None
+    if profiler is not None:
+        profiler.start()
+    dcnm = DcnmRestApi(args.dcnm, dryrun=args.dryrun, token_cache=token_cache, trace_sink=trace_sink,
+                       hooks=[request_metrics], offline=bool(args.offline))
+    cassette: Optional[Union[RecordingAdapter, ReplayAdapter]] = None
+    if args.record:
+        cassette = RecordingAdapter(args.record, max_retries=dcnm.retry)
+    elif args.replay:
+        cassette = ReplayAdapter(args.replay, latency=args.replay_latency)
+    if cassette is not None:
+        dcnm.mount(cassette)
+    if args.replay:
+        # the cassette answers the logon, there are no credentials to ask for
+        dcnm.logon(username=args.username or 'replay', password='replay')
+    else:
+        dcnm.logon(username=args.username)
 
     #initialize handler
     if args.verbose:
@@ -234,17 +373,39 @@ if __name__ == '__main__':
     if args.verbose:
         _dbg("Initializing Plugins...")
     plugins.set_plugins(args.plugins)
+
+    # offline and dry runs change nothing, the journal of the last real run is left alone
+    journal: Optional[ChangeJournal] = None
+    # the connector of an offline run is in dryrun mode too
+    if not dcnm.dryrun:
+        journal = ChangeJournal(args.journal, resume=args.resume, run=_journal_run(args))
+    if journal is None and args.resume:
+        logger.warning("dry run: the journal {} is neither read nor written".format(args.journal))
+    elif journal is not None and args.resume:
+        print("resuming from journal {}, the interrupted run stopped after: {}".format(args.journal,
+                                                                                   journal.resumed_from))
     if not args.backout:
         if args.verbose:
             _dbg("Normal Deploy...")
-        _normal_deploy(args, handler, plugins)
+        _normal_deploy(args, handler, plugins, journal)
 
     # Fallback
     else:
         if args.verbose:
             _dbg("Fallback...")
-        _fallback(args, handler, plugins)
+        _fallback(args, handler, plugins, journal)
 
+    if journal is not None:
+        journal.close()
+    if trace_sink is not None:
+        trace_sink.record(metrics={'requests': request_metrics.summary(), 'plugins': request_metrics.plugin_summary()})
+        trace_sink.close()
+    if cassette is not None:
+        cassette.close()
+    request_metrics.print_report()
+    if profiler is not None:
+        profiler.stop()
+        profiler.print_report()
     print('=' * 40)
     print("FINISHED. GO GET PLASTERED!")
     print('=' * 40)
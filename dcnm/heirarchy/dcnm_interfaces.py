@@ -8,8 +8,10 @@ from DCNM_errors import DCNMParameterError, DCNMInterfacesParameterError
 from plugin_utils import PlugInEngine
 from filters import filterfactory
 from DCNM_connect import DcnmRestApi
-from DCNM_utils import error_handler, _check_patterns, _check_response
+from DCNM_utils import error_handler, _check_patterns, _check_response, LogPreview
+from export import save_records, load_records, INTERFACES
 from handler import DcnmComponent, Handler
+from inventory_diff import InventoryDiff, RecordHashes, diff_inventories
 
 logger = logging.getLogger(__name__)
 
@@ -21,6 +23,8 @@ class DcnmInterfaces(DcnmComponent):
         self.all_interfaces_details_prev: Dict[tuple, dict] = {}
         self.all_interfaces_nvpairs: Dict[tuple, dict] = {}
         self.all_interfaces_nvpairs_prev: Dict[tuple, dict] = {}
+        # content digests of the records of the current and previous inventories
+        self._record_hashes = RecordHashes()
 
     @error_handler("ERROR: get_all_interfaces_detail: getting interface details for serial number")
     def get_all_interfaces_details(self, serial_number: Optional[str] = None, interface: Optional[str] = None):
@@ -264,7 +268,8 @@ class DcnmInterfaces(DcnmComponent):
         :type physical: bool
         :param serial_numbers: required list or tuple of switch serial numbers
         :type serial_numbers: list or tuple
-        :param save_to_file: optional parameter, if None do not save, if str use as filename to save to
+        :param save_to_file: optional parameter, if None do not save, if str use as filename to save to,
+        written as newline delimited json, or parquet if the name ends in .parquet
         :type save_to_file: None or str
         :param save_prev: if True and  attribute all_interfaces_nvpairs exists,
         copy to attribute all_interfaces_nvpairs_prev
@@ -319,8 +324,7 @@ class DcnmInterfaces(DcnmComponent):
                                                    "oper must be a string or a list of strings")
 
         if save_to_file is not None:
-            with open(save_to_file, 'w') as f:
-                f.write(str(self.all_interfaces_details))
+            save_records(self.all_interfaces_details, save_to_file, INTERFACES)
 
     @error_handler("ERROR: get_all_interfaces_nvpairs: getting interface details and nvpairs for serial number")
     def get_all_interfaces_nvpairs(self, serial_number: Optional[str] = None,
@@ -389,7 +393,7 @@ class DcnmInterfaces(DcnmComponent):
         params = {'serialNumber': serial_number, 'ifName': interface}
         logger.info("get_all_interfaces_nvpairs: serial_number: {}".format(serial_number))
         response = _check_response(self.dcnm.get(path, params=params))
-        logger.debug("get_all_interfaces_nvpairs: response: {}".format(response))
+        logger.debug("get_all_interfaces_nvpairs: response: %s", LogPreview(response))
         for policy in json.loads(response['MESSAGE']):
             for interface in policy['interfaces']:
                 # print(interface)
@@ -423,7 +427,8 @@ class DcnmInterfaces(DcnmComponent):
         :type policy: str or list of strings
         :param interface: optional interface
         :type interface: str
-        :param save_to_file: optional parameter, if None do not save, if str use as filename to save to
+        :param save_to_file: optional parameter, if None do not save, if str use as filename to save to,
+        written as newline delimited json, or parquet if the name ends in .parquet
         :type save_to_file: None or str
         :param save_prev: if True and  attribute all_interfaces_nvpairs exists,
         copy to attribute all_interfaces_nvpairs_prev
@@ -475,8 +480,9 @@ class DcnmInterfaces(DcnmComponent):
         if self.all_interfaces_nvpairs and not save_prev:
             self.all_interfaces_nvpairs.clear()
         elif self.all_interfaces_nvpairs and save_prev:
-            self.all_interfaces_nvpairs_prev = deepcopy(self.all_interfaces_nvpairs)
-            self.all_interfaces_nvpairs.clear()
+            # the pulled interfaces go into a new dictionary, so the previous one is kept without copying it
+            self.all_interfaces_nvpairs_prev = self.all_interfaces_nvpairs
+            self.all_interfaces_nvpairs = {}
 
         if serial_numbers and isinstance(serial_numbers, str):
             serial_numbers = [serial_numbers]
@@ -514,8 +520,59 @@ class DcnmInterfaces(DcnmComponent):
                                                    "config must be a string or a list of strings")
 
         if save_to_file is not None:
-            with open(save_to_file, 'w') as f:
-                f.write(str(self.all_interfaces_nvpairs))
+            save_records(self.all_interfaces_nvpairs, save_to_file, INTERFACES)
+
+    def refresh_interfaces_nvpairs(self, serial_numbers: Union[str, List[str], Tuple[str]]) -> InventoryDiff:
+        """
+        :param serial_numbers: the switches to pull again
+        :type serial_numbers: str or list or tuple
+        :return: the interfaces of those switches that were added, removed or modified since the last pull
+        :rtype: InventoryDiff
+
+        Pulls the interfaces of some switches and keeps the interfaces of the others, e.g. the switches in the
+        serial_numbers of a diff_switches_policies. The previous inventory is kept in all_interfaces_nvpairs_prev.
+        """
+        if isinstance(serial_numbers, str):
+            serial_numbers = [serial_numbers]
+        refreshed: Dict[tuple, dict] = {}
+        for sn in serial_numbers:
+            refreshed.update(self.get_all_interfaces_nvpairs(serial_number=sn))
+        scope = set(serial_numbers)
+        current = {key: detail for key, detail in self.all_interfaces_nvpairs.items() if key[1] not in scope}
+        current.update(refreshed)
+        self.all_interfaces_nvpairs_prev = self.all_interfaces_nvpairs
+        self.all_interfaces_nvpairs = current
+        return self.diff_interfaces_nvpairs(serial_numbers=serial_numbers)
+
+    def diff_interfaces_nvpairs(self, serial_numbers: Optional[Union[list, tuple]] = None) -> InventoryDiff:
+        """
+        :param serial_numbers: only compare the interfaces of these switches, e.g. the switches of a partial pull
+        :type serial_numbers: None or list or tuple
+        :return: the interfaces added, removed or modified between all_interfaces_nvpairs_prev and
+        all_interfaces_nvpairs
+        :rtype: InventoryDiff
+        """
+        diff = diff_inventories(self.all_interfaces_nvpairs_prev, self.all_interfaces_nvpairs, self._record_hashes,
+                                serial_numbers)
+        self._prune_record_hashes()
+        return diff
+
+    def diff_interfaces_details(self, serial_numbers: Optional[Union[list, tuple]] = None) -> InventoryDiff:
+        """
+        :param serial_numbers: only compare the interfaces of these switches
+        :type serial_numbers: None or list or tuple
+        :return: the interfaces added, removed or modified between all_interfaces_details_prev and
+        all_interfaces_details
+        :rtype: InventoryDiff
+        """
+        diff = diff_inventories(self.all_interfaces_details_prev, self.all_interfaces_details, self._record_hashes,
+                                serial_numbers)
+        self._prune_record_hashes()
+        return diff
+
+    def _prune_record_hashes(self):
+        self._record_hashes.prune(self.all_interfaces_nvpairs, self.all_interfaces_nvpairs_prev,
+                                  self.all_interfaces_details, self.all_interfaces_details_prev)
 
     def get_interface_details(self, serial_number, interface):
         return self.all_interfaces_details.get((interface, serial_number))
@@ -523,6 +580,42 @@ class DcnmInterfaces(DcnmComponent):
     def get_interface_nvpairs(self, serial_number, interface):
         return self.all_interfaces_nvpairs.get((interface, serial_number))
 
+    def load_interfaces_details(self, file: str, serial_numbers: Optional[Union[list, tuple]] = None,
+                                save_prev: bool = False):
+        """
+        :param file: file written by get_interfaces_details with save_to_file
+        :type file: str
+        :param serial_numbers: only load the interfaces of these serial numbers
+        :type serial_numbers: None or list or tuple
+        :param save_prev: if True, keep the current all_interfaces_details in all_interfaces_details_prev
+        :type save_prev: bool
+
+        Rehydrate all_interfaces_details from an export without contacting DCNM
+        """
+        if save_prev:
+            self.all_interfaces_details_prev = self.all_interfaces_details
+        self.all_interfaces_details = load_records(file, INTERFACES, serial_numbers)
+        logger.info("load_interfaces_details: loaded {} interfaces from {}".format(
+            len(self.all_interfaces_details), file))
+
+    def load_interfaces_nvpairs(self, file: str, serial_numbers: Optional[Union[list, tuple]] = None,
+                                save_prev: bool = False):
+        """
+        :param file: file written by get_interfaces_nvpairs with save_to_file
+        :type file: str
+        :param serial_numbers: only load the interfaces of these serial numbers
+        :type serial_numbers: None or list or tuple
+        :param save_prev: if True, keep the current all_interfaces_nvpairs in all_interfaces_nvpairs_prev
+        :type save_prev: bool
+
+        Rehydrate all_interfaces_nvpairs from an export without contacting DCNM
+        """
+        if save_prev:
+            self.all_interfaces_nvpairs_prev = self.all_interfaces_nvpairs
+        self.all_interfaces_nvpairs = load_records(file, INTERFACES, serial_numbers)
+        logger.info("load_interfaces_nvpairs: loaded {} interfaces from {}".format(
+            len(self.all_interfaces_nvpairs), file))
+
     @staticmethod
     def get_filtered_interfaces_nvpairs(interfaces_nv_pairs: dict, policy: Optional[Union[str, List[str]]] = None,
                                         CONF: Optional[Union[str, List[str]]] = None,
@@ -3,8 +3,9 @@ from copy import deepcopy
 from typing import Dict, Tuple, Union
 
 from DCNM_connect import DcnmRestApi
-from DCNM_utils import spinner, _check_action_response
+from DCNM_utils import spinner, _check_action_response, LogPreview
 from handler import Handler, DcnmComponent, SingletonMeta
+from journal import PUT
 
 logger = logging.getLogger('dcnm_puts')
 
@@ -67,7 +68,7 @@ class ChangeDcnmPolicy(DcnmComponent, metaclass=SingletonMeta):
         return info
 
     @spinner()
-    def put_interface_changes(self, interfaces_will_change: Dict[tuple, dict]) -> Tuple[set, set]:
+    def put_interface_changes(self, interfaces_will_change: Dict[tuple, dict], journal=None) -> Tuple[set, set]:
         """
 
         :param self:
@@ -113,6 +114,8 @@ class ChangeDcnmPolicy(DcnmComponent, metaclass=SingletonMeta):
                                'policy': 'int_trunk_host_11_1'}
                                }
         :type interfaces_will_change: dict, the key is a tuple, the value is a dictionary
+        :param journal: optional, records every successful put. interfaces it already holds are not pushed again
+        :type journal: journal.ChangeJournal
         :return: two sets, one of successful configurations, one of failed configurations
         :rtype: (set, set, )
 
@@ -123,6 +126,10 @@ class ChangeDcnmPolicy(DcnmComponent, metaclass=SingletonMeta):
         failed: set = set()
         success: set = set()
         for interface, details in interfaces_will_change_local.items():
+            if journal is not None and journal.is_done(PUT, interface):
+                logger.debug("put_interface_changes:  %s already pushed according to the journal", interface)
+                success.add(interface)
+                continue
             result = self.put_interface(interface, details)
             if not result:
                 logger.critical(
@@ -131,14 +138,16 @@ class ChangeDcnmPolicy(DcnmComponent, metaclass=SingletonMeta):
                 logger.critical(details)
                 failed.add(interface)
             elif result:
-                logger.debug("put_interface_changes:  {} successfully changed. Yay.".format(interface))
-                logger.debug(details)
+                logger.debug("put_interface_changes:  %s successfully changed. Yay.", interface)
+                logger.debug("put_interface_changes:  %s", LogPreview(details))
                 success.add(interface)
+                if journal is not None:
+                    journal.record(PUT, interface)
             else:
                 logger.critical("ERROR: put_interface_changes:  Don't know what happened: {}".format(result))
                 logger.critical("ERROR: put_interface_changes:  {} : {}".format(interface, details))
                 failed.add(interface)
-        logger.debug("put_interface_changes:  Successfully configured {}".format(success))
+        logger.debug("put_interface_changes:  Successfully configured %s", success)
         if failed:
             logger.critical("ERROR: put_interface_changes:  Failed configuring {}".format(failed))
         else:
@@ -1,34 +1,87 @@
 import json
 import logging
+import sys
 from collections import defaultdict
 from copy import deepcopy
 from pickle import dump
 from pprint import pprint
 from time import time, sleep
-from typing import Optional, Union, Dict, List, Tuple, Iterable
+from typing import Optional, Union, Dict, List, Tuple, Iterable, FrozenSet
 
 from DCNM_errors import DCNMInterfacesParameterError, DCNMSwitchesPoliciesParameterError, \
     DCNMParameterError, DCNMSwitchesSwitchesParameterError, DCNMSwitchStatusParameterError, DCNMSwitchStatusError
 from DCNM_connect import DcnmRestApi
 from DCNM_utils import error_handler, _check_response, spinner, get_info_from_policies_config
+from export import save_records, load_records, POLICIES, SWITCHES
 from plugin_utils import PlugInEngine
 from handler import DcnmComponent, Handler
 from filters import filterfactory
+from inventory_diff import InventoryDiff, RecordHashes, diff_inventories, policies_by_id
 
 logger = logging.getLogger(__name__)
 
 
 class Switch:
+    """
+    A switch of the inventory. The details the tool uses are slots, the other fields of the DCNM switch details
+    are kept in an extras mapping. add_details only keeps a reference to the details record, the extras mapping is
+    built from it the first time an extra field is read, and only for a switch that has some. Both are readable as
+    attributes or with switch[key]. The details record must not be changed after it is added.
+    """
+    FIELDS = ('serialNumber', 'switchRole', 'fabricName', 'peerSerialNumber', 'model', 'ipAddress')
+    __slots__ = FIELDS + ('policies', 'policies_prev', '_extras', '_details')
+
     def __init__(self, serial_number: str, switchRole: str, fabricName: str):
         self.serialNumber = serial_number
         self.peerSerialNumber: Optional[str] = None
-        self.switchRole = switchRole
-        self.fabricName = fabricName
+        self.switchRole = _intern(switchRole)
+        self.fabricName = _intern(fabricName)
+        self.model: Optional[str] = None
+        self.ipAddress: Optional[str] = None
         self.policies: List[Dict] = []
         self.policies_prev: List[Dict] = []
+        self._extras: Optional[Dict] = None
+        # details record whose extra fields are not in _extras yet
+        self._details: Optional[Dict] = None
+
+    @property
+    def extras(self) -> Dict:
+        if self._details is not None:
+            self._materialize_extras()
+        return self._extras if self._extras is not None else {}
+
+    def _materialize_extras(self):
+        details, self._details = self._details, None
+        extras = {key: value for key, value in details.items() if key not in _SWITCH_FIELDS}
+        if extras:
+            if self._extras is None:
+                self._extras = extras
+            else:
+                self._extras.update(extras)
 
     def add_details(self, details: dict):
-        self.__dict__.update(details)
+        if self._details is not None:
+            self._materialize_extras()
+        for key in _SWITCH_FIELDS.intersection(details):
+            self._set_field(key, details[key])
+        if not _SWITCH_FIELDS.issuperset(details):
+            self._details = details
+
+    def _set_field(self, key, value):
+        if key in _SWITCH_FIELDS:
+            setattr(self, key, _intern(value) if key in _INTERNED_FIELDS else value)
+        else:
+            if self._details is not None:
+                self._materialize_extras()
+            if self._extras is None:
+                self._extras = {}
+            self._extras[key] = value
+
+    def details(self) -> Dict:
+        """ the details of the switch, without the policies """
+        details = {key: getattr(self, key) for key in self.FIELDS}
+        details.update(self.extras)
+        return details
 
     def add_policies(self, policies: Union[dict, list]):
         if isinstance(policies, list):
@@ -40,45 +93,125 @@ class Switch:
         self.policies = []
 
     def save_policies(self):
-        self.policies_prev = list(deepcopy(self.policies))
+        # the policy dicts are never changed in place, the lists are replaced, so a shallow copy is enough
+        self.policies_prev = list(self.policies)
+
+    def __getattr__(self, name):
+        # only called for names that are not slots
+        if not name.startswith('_'):
+            extras = self.extras
+            if name in extras:
+                return extras[name]
+        raise AttributeError(f"{type(self).__name__!r} object has no attribute {name!r}")
 
     def __str__(self):
         output_str = ""
-        for key, item in self.__dict__.items():
+        for key, item in self:
             output_str = f"{output_str}\n{key} = {item}"
         return output_str
 
     def __getitem__(self, key):
-        return self.__getattribute__(key)
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
 
     def __setitem__(self, key, value):
-        self.__setattr__(key, value)
+        """ sets a field like add_details, call SwitchDict.changed() after changing the role of a switch """
+        if key in ('policies', 'policies_prev'):
+            setattr(self, key, value)
+        else:
+            self._set_field(key, value)
 
     def __delitem__(self, key):
-        self.__delattr__(key)
+        if key in _SWITCH_FIELDS:
+            setattr(self, key, None)
+        elif key in self.extras:
+            del self._extras[key]
+        else:
+            raise KeyError(key)
 
     def __missing__(self, key):
         raise KeyError(f"Missing key value {key!r}")
 
     def __iter__(self):
-        return iter(list(self.__dict__.items()))
+        items = [(key, getattr(self, key)) for key in self.FIELDS + ('policies', 'policies_prev')]
+        return iter(items + list(self.extras.items()))
 
     def __repr__(self):
         return f'{type(self).__name__}({self.serialNumber!r}, {self.switchRole!r}, {self.fabricName!r})'
 
 
+_SWITCH_FIELDS = frozenset(Switch.FIELDS)
+# values repeated across many switches, kept once
+_INTERNED_FIELDS = frozenset(('switchRole', 'fabricName', 'model'))
+
+
+def _intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+class SwitchDict(dict):
+    """
+    dict of serial number -> Switch that counts its changes, so indexes built from it know when to rebuild.
+    Call changed() after modifying a switch in place in a way that affects an index, e.g. its role
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.version = 0
+
+    def changed(self):
+        self.version += 1
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.version += 1
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.version += 1
+
+    def clear(self):
+        super().clear()
+        self.version += 1
+
+    def pop(self, *args):
+        self.version += 1
+        return super().pop(*args)
+
+    def popitem(self):
+        self.version += 1
+        return super().popitem()
+
+    def setdefault(self, key, default=None):
+        self.version += 1
+        return super().setdefault(key, default)
+
+    def update(self, *args, **kwargs):
+        super().update(*args, **kwargs)
+        self.version += 1
+
+
 class DcnmSwitches(DcnmComponent):
     def __init__(self, handler: Handler, dcnm_connector: DcnmRestApi):
         super().__init__(handler, dcnm_connector)
-        self.switches: dict = {}
-        self._all_leaf_switches: Optional[List[str]] = None
-        self._all_notleaf_switches: Optional[List[str]] = None
+        self.switches: SwitchDict = SwitchDict()
+        # role -> serial numbers, rebuilt when the version of switches changes
+        self._switches_by_role: Dict[str, FrozenSet[str]] = {}
+        self._all_leaf_switches: FrozenSet[str] = frozenset()
+        self._all_notleaf_switches: FrozenSet[str] = frozenset()
+        self._roles_version: int = -1
         self.all_switches_vpc_pairs: bool = False
         self.all_switches_details: bool = False
         self.all_switches_policies: bool = False
         self.all_switches_policies_prev: bool = False
         self._switches_policies = defaultdict(list)
         self._switches_policies_prev = defaultdict(list)
+        # policies read by load_switches_policies, served by get_switches_policies when the connector is offline
+        self._loaded_policies: Dict[str, List[dict]] = {}
+        # content digests of the current and previous switch policies
+        self._policy_hashes = RecordHashes()
 
     @error_handler("ERROR getting switch serial numbers")
     def get_all_switches(self):
@@ -91,10 +224,6 @@ class DcnmSwitches(DcnmComponent):
 
         """
         logger.info("get all switches")
-        if self.all_leaf_switches:
-            self.all_leaf_switches.clear()
-        if self.all_notleaf_switches:
-            self.all_notleaf_switches.clear()
         self.switches.clear()
         self.all_switches_vpc_pairs: bool = False
         self.all_switches_details: bool = False
@@ -124,10 +253,6 @@ class DcnmSwitches(DcnmComponent):
             raise DCNMInterfacesParameterError('serial_numbers must be a list or a tuple')
         elif serial_numbers and isinstance(serial_numbers, (list, tuple)):
             if clear_prev:
-                if self.all_leaf_switches:
-                    self.all_leaf_switches.clear()
-                if self.all_notleaf_switches:
-                    self.all_notleaf_switches.clear()
                 self.switches.clear()
                 self.all_switches_vpc_pairs: bool = False
                 self.all_switches_details: bool = False
@@ -145,16 +270,31 @@ class DcnmSwitches(DcnmComponent):
         else:
             self.get_all_switches()
 
+    def _index_roles(self):
+        if self._roles_version == self.switches.version:
+            return
+        by_role: Dict[str, set] = defaultdict(set)
+        for serial, obj in self.switches.items():
+            by_role[obj.switchRole].add(serial)
+        self._switches_by_role = {role: frozenset(serials) for role, serials in by_role.items()}
+        self._all_leaf_switches = self._switches_by_role.get("leaf", frozenset())
+        self._all_notleaf_switches = frozenset(self.switches) - self._all_leaf_switches
+        self._roles_version = self.switches.version
+
+    @property
+    def switches_by_role(self) -> Dict[str, FrozenSet[str]]:
+        """ {switch role: frozenset of serial numbers} """
+        self._index_roles()
+        return self._switches_by_role
+
     @property
-    def all_leaf_switches(self):
-        if not self._all_leaf_switches:
-            self._all_leaf_switches = [serial for serial, obj in self.switches.items() if obj.switchRole == "leaf"]
+    def all_leaf_switches(self) -> FrozenSet[str]:
+        self._index_roles()
         return self._all_leaf_switches
 
     @property
-    def all_notleaf_switches(self):
-        if not self._all_notleaf_switches:
-            self._all_notleaf_switches = [serial for serial, obj in self.switches.items() if obj.switchRole != "leaf"]
+    def all_notleaf_switches(self) -> FrozenSet[str]:
+        self._index_roles()
         return self._all_notleaf_switches
 
     @property
@@ -171,6 +311,20 @@ class DcnmSwitches(DcnmComponent):
                                             for serial_number, switch in self.switches.items()}
         return self._switches_policies_prev
 
+    def diff_switches_policies(self, serial_numbers: Optional[Union[list, tuple]] = None) -> InventoryDiff:
+        """
+        :param serial_numbers: only compare the policies of these switches
+        :type serial_numbers: None or list or tuple
+        :return: the policies, keyed by policy id, added, removed or modified between the previous policies of the
+        switches, see get_switches_policies with save_prev, and their current policies
+        :rtype: InventoryDiff
+        """
+        old = policies_by_id({serial_number: switch.policies_prev for serial_number, switch in self.switches.items()})
+        new = policies_by_id({serial_number: switch.policies for serial_number, switch in self.switches.items()})
+        diff = diff_inventories(old, new, self._policy_hashes, serial_numbers)
+        self._policy_hashes.prune(old, new)
+        return diff
+
     def get_switch(self, serial_number):
         return self.switches.get(serial_number)
 
@@ -182,7 +336,8 @@ class DcnmSwitches(DcnmComponent):
         switch = self.switches.get(serial_number)
         return switch.policies
 
-    def delete_switch_policies(self, serial_number):
+    def clear_switch_policies(self, serial_number):
+        # not named delete_switch_policies, the handler would dispatch the DcnmPuts delete of policies here
         if serial_number in self.switches:
             self.switches[serial_number].policies.clear()
 
@@ -211,7 +366,8 @@ class DcnmSwitches(DcnmComponent):
         :type templateName: str or None
         :param generatedConfig: optional regex str
         :type generatedConfig: str or None
-        :param save_to_file: optional parameter, if None do not save, if str use as filename to save to
+        :param save_to_file: optional parameter, if None do not save, if str use as filename to save to,
+        written as newline delimited json, or parquet if the name ends in .parquet
         :type save_to_file: None or str
         :param save_prev: if True and  attribute all_switches_policies exists,
         copy to attribute all_switches_policies_prev
@@ -327,10 +483,10 @@ class DcnmSwitches(DcnmComponent):
         """
 
         if self.all_switches_policies and not save_prev:
-            for switch in self.switches:
+            for switch in self.switches.values():
                 switch.clear_policies()
         elif self.all_switches_policies and save_prev:
-            for switch in self.switches:
+            for switch in self.switches.values():
                 switch.save_policies()
                 switch.clear_policies()
                 self.all_switches_policies_prev = True
@@ -356,12 +512,18 @@ class DcnmSwitches(DcnmComponent):
 
         params = self.determine_parameters(serial_numbers)
 
-        logger.info("get_switches_policies: getting switch policies for serial number: {}".format(params))
-        response = _check_response(self.dcnm.get(path, params=params))
-
         all_switches_policies: defaultdict[List] = defaultdict(list)
-        for policy in json.loads(response['MESSAGE']):
-            all_switches_policies[policy['serialNumber']].append(policy)
+        if self.dcnm.offline:
+            logger.info("get_switches_policies: offline, using loaded switch policies for serial number: {}".format(
+                params))
+            for sn in params['serialNumber'].split(','):
+                if sn in self._loaded_policies:
+                    all_switches_policies[sn] = list(self._loaded_policies[sn])
+        else:
+            logger.info("get_switches_policies: getting switch policies for serial number: {}".format(params))
+            response = _check_response(self.dcnm.get(path, params=params))
+            for policy in json.loads(response['MESSAGE']):
+                all_switches_policies[policy['serialNumber']].append(policy)
         logger.debug(list(all_switches_policies.keys()))
 
         if fabric:
@@ -399,8 +561,7 @@ class DcnmSwitches(DcnmComponent):
         self.all_switches_policies = True
 
         if save_to_file is not None:
-            with open(save_to_file, 'w') as f:
-                f.write(str(self.switches_policies))
+            save_records(all_switches_policies, save_to_file, POLICIES)
 
     def determine_parameters(self, serial_numbers: Optional[Union[Iterable, str]] = None):
         """Return serial numbers as dictionary Requests can use to construct HTTP parameters"""
@@ -453,7 +614,8 @@ class DcnmSwitches(DcnmComponent):
         :type serial_numbers: Optional[Union[List[str], Tuple[str], str]]
         :param fabric: fabric interested in, optional
         :type fabric: str
-        :param save_to_file: if str, save the information to a file where the str is the name of the file
+        :param save_to_file: if str, save the information to a file where the str is the name of the file,
+        written as newline delimited json, or parquet if the name ends in .parquet
         :type save_to_file: None or str
 
         Pull the details for each switch serial number
@@ -490,14 +652,69 @@ class DcnmSwitches(DcnmComponent):
         for fabric in fabric_set:
             switches_details.update(self.get_fabric_switches_details(fabric))
 
-        for sn, switch in self.switches:
-            switch.add_details(switches_details[sn])
+        for sn in serial_numbers:
+            self.switches[sn].add_details(switches_details[sn])
+        self.switches.changed()
 
         if save_to_file is not None:
-            with open(save_to_file, 'w') as f:
-                f.write(str(switches_details))
+            save_records({sn: switches_details[sn] for sn in serial_numbers}, save_to_file, SWITCHES)
+
+        self.all_switches_details = True
+
+    def _loaded_switch(self, serial_number: str, record: dict) -> Switch:
+        """ the switch object for serial_number, created from an exported record if it is not known yet """
+        switch = self.switches.get(serial_number)
+        if switch is None:
+            switch = Switch(serial_number, record.get('switchRole', record.get('role')), record.get('fabricName'))
+            self.switches[serial_number] = switch
+        return switch
 
+    def load_switches_policies(self, file: str, serial_numbers: Optional[Union[List[str], Tuple[str]]] = None,
+                               save_prev: bool = False):
+        """
+        :param file: file written by get_switches_policies with save_to_file
+        :type file: str
+        :param serial_numbers: only load the policies of these serial numbers
+        :type serial_numbers: None or list or tuple
+        :param save_prev: if True, keep the current policies of each loaded switch in policies_prev
+        :type save_prev: bool
+
+        Rehydrate the policies of the switch objects from an export without contacting DCNM. Switches not yet
+        known are created from the policy records. When the connector is offline, get_switches_policies filters
+        these policies instead of requesting them.
+        """
+        all_switches_policies = load_records(file, POLICIES, serial_numbers)
+        self._loaded_policies.update(all_switches_policies)
+        self._switches_policies.clear()
+        for sn, policies in all_switches_policies.items():
+            switch = self._loaded_switch(sn, policies[0])
+            if save_prev:
+                switch.save_policies()
+                self.all_switches_policies_prev = True
+            switch.clear_policies()
+            switch.add_policies(policies)
+        self.all_switches_policies = True
+        logger.info("load_switches_policies: loaded policies of {} switches from {}".format(
+            len(all_switches_policies), file))
+
+    def load_switches_details(self, file: str, serial_numbers: Optional[Union[List[str], Tuple[str]]] = None):
+        """
+        :param file: file written by get_switches_details with save_to_file
+        :type file: str
+        :param serial_numbers: only load the details of these serial numbers
+        :type serial_numbers: None or list or tuple
+
+        Rehydrate the details of the switch objects from an export without contacting DCNM. Switches not yet
+        known are created from the detail records.
+        """
+        count = 0
+        for sn, details in load_records(file, SWITCHES, serial_numbers).items():
+            self._loaded_switch(sn, details).add_details(details)
+            count += 1
+        # the details can change the role of a switch
+        self.switches.changed()
         self.all_switches_details = True
+        logger.info("load_switches_details: loaded details of {} switches from {}".format(count, file))
 
     def get_switches_status(self, serial_numbers: Optional[Union[str, List[str]]] = None) -> Dict[str, str]:
         logger.info("get switches status")
@@ -0,0 +1,185 @@
+"""
+Streaming loader for interface description spreadsheets
+
+A descriptions file has the columns interface, switch (the switch serial number) and description, in any order
+and any case, on its first row. The rows are read one at a time and the lookup dictionary
+
+    {(interface, switch serial number): description}
+
+is built in a single pass, so the file is never held in memory as a table.
+
+    .xlsx, .xlsm    openpyxl in read only mode
+    .csv            the csv module
+    .parquet        pyarrow record batches, or pandas when pyarrow is not installed
+    others (.xls)   pandas.read_excel
+
+The parsed result is cached by the sha256 of the file, so running again with an unchanged file skips the
+spreadsheet entirely. The cache lives in ~/.dcnm/descriptions. Set the DCNM_DESCRIPTIONS_CACHE environment
+variable to another directory, or to an empty string to disable it.
+"""
+import csv
+import gzip
+import hashlib
+import json
+import logging
+import os
+from typing import Any, Dict, Iterator, Optional, Sequence, Tuple
+
+from DCNM_errors import ExcelFileError
+
+logger = logging.getLogger(__name__)
+
+COLUMNS = ('interface', 'switch', 'description')
+DEFAULT_DESCRIPTIONS_CACHE = os.path.join(os.path.expanduser("~"), ".dcnm", "descriptions")
+# bump when the parsing changes, so results cached by an older version are not used
+CACHE_VERSION = 1
+
+
+def _columns(header: Sequence[Any], file: str) -> Tuple[int, int, int]:
+    """ :return: positions of the interface, switch and description columns in the header row """
+    names = [str(name).strip().lower() if name is not None else '' for name in header]
+    missing = [column for column in COLUMNS if column not in names]
+    if missing:
+        logger.debug("Columns missing. {}".format(names))
+        raise ExcelFileError('One or more columns missing from {}: {}'.format(file, ', '.join(missing)))
+    return names.index('interface'), names.index('switch'), names.index('description')
+
+
+def _xlsx_rows(file: str) -> Iterator[Sequence[Any]]:
+    from openpyxl import load_workbook
+    workbook = load_workbook(file, read_only=True, data_only=True)
+    try:
+        yield from workbook.active.iter_rows(values_only=True)
+    finally:
+        workbook.close()
+
+
+def _csv_rows(file: str) -> Iterator[Sequence[Any]]:
+    with open(file, newline='', encoding='utf-8-sig') as f:
+        yield from csv.reader(f)
+
+
+def _parquet_rows(file: str) -> Iterator[Sequence[Any]]:
+    try:
+        import pyarrow.parquet
+    except ImportError:
+        yield from _pandas_rows(file, parquet=True)
+        return
+    parquet_file = pyarrow.parquet.ParquetFile(file)
+    yield parquet_file.schema_arrow.names
+    for batch in parquet_file.iter_batches():
+        yield from zip(*(column.to_pylist() for column in batch.columns))
+
+
+def _pandas_rows(file: str, parquet: bool = False) -> Iterator[Sequence[Any]]:
+    try:
+        import pandas
+    except ImportError:
+        raise ExcelFileError("the pandas package is required to read {}, save it as .xlsx or .csv instead".format(
+            file))
+    df = pandas.read_parquet(file) if parquet else pandas.read_excel(file)
+    yield list(df.columns)
+    for row in df.itertuples(index=False, name=None):
+        # empty cells are NaN, which is not equal to itself
+        yield tuple(None if value != value else value for value in row)
+
+
+def _rows(file: str) -> Iterator[Sequence[Any]]:
+    extension = os.path.splitext(file)[1].lower()
+    if extension in ('.xlsx', '.xlsm'):
+        return _xlsx_rows(file)
+    if extension == '.csv':
+        return _csv_rows(file)
+    if extension == '.parquet':
+        return _parquet_rows(file)
+    return _pandas_rows(file)
+
+
+def _cell(value: Any) -> str:
+    if value is None:
+        return ''
+    # whole numbers read from a spreadsheet come back as floats
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value)
+
+
+def parse_descriptions(file: str) -> Dict[Tuple[str, str], str]:
+    """
+    :param file: descriptions spreadsheet
+    :type file: str
+    :return: {(interface, switch serial number): description}
+    :rtype: dict
+
+    Rows without an interface or a switch are skipped, an empty description is read as an empty string.
+    """
+    rows = _rows(file)
+    header = next(rows, None)
+    if header is None:
+        raise ExcelFileError('{} is empty'.format(file))
+    interface_column, switch_column, description_column = _columns(header, file)
+    descriptions: Dict[Tuple[str, str], str] = {}
+    skipped = 0
+    for row in rows:
+        try:
+            interface, switch = _cell(row[interface_column]).strip(), _cell(row[switch_column]).strip()
+            description = _cell(row[description_column])
+        except IndexError:
+            interface = switch = ''
+        if not interface or not switch:
+            skipped += 1
+            continue
+        descriptions[(interface, switch)] = description
+    if skipped:
+        logger.debug("parse_descriptions: skipped {} rows without an interface or a switch".format(skipped))
+    return descriptions
+
+
+def file_digest(file: str) -> str:
+    digest = hashlib.sha256()
+    with open(file, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _cache_file(cache_dir: str, digest: str) -> str:
+    return os.path.join(cache_dir, '{}-v{}.json.gz'.format(digest, CACHE_VERSION))
+
+
+def load_descriptions(file: str, cache_dir: Optional[str] = None) -> Dict[Tuple[str, str], str]:
+    """
+    :param file: descriptions spreadsheet
+    :type file: str
+    :param cache_dir: directory of the parsed results, DCNM_DESCRIPTIONS_CACHE or ~/.dcnm/descriptions if None,
+    an empty string disables the cache
+    :type cache_dir: str or None
+    :return: {(interface, switch serial number): description}
+    :rtype: dict
+    """
+    if cache_dir is None:
+        cache_dir = os.environ.get("DCNM_DESCRIPTIONS_CACHE", DEFAULT_DESCRIPTIONS_CACHE)
+    if not cache_dir:
+        return parse_descriptions(file)
+    cache_file = _cache_file(cache_dir, file_digest(file))
+    try:
+        with gzip.open(cache_file, 'rt') as f:
+            descriptions = {(interface, switch): description for interface, switch, description in json.load(f)}
+        logger.debug("load_descriptions: {} descriptions of {} read from {}".format(len(descriptions), file,
+                                                                                   cache_file))
+        return descriptions
+    except FileNotFoundError:
+        pass
+    except (OSError, EOFError, ValueError) as e:
+        logger.debug("load_descriptions: unable to read {}: {}".format(cache_file, e))
+    descriptions = parse_descriptions(file)
+    tmp = cache_file + '.tmp'
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with gzip.open(tmp, 'wt', compresslevel=1) as f:
+            json.dump([[interface, switch, description] for (interface, switch), description in descriptions.items()],
+                      f, separators=(',', ':'))
+        os.replace(tmp, cache_file)
+    except OSError as e:
+        logger.debug("load_descriptions: unable to write {}: {}".format(cache_file, e))
+    return descriptions
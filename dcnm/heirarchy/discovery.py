@@ -0,0 +1,87 @@
+import json
+import logging
+import os
+from typing import Any, Dict, Iterable, Optional
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DISCOVERY_CACHE = os.path.join(os.path.expanduser("~"), ".dcnm", "discovery_cache.json")
+
+
+class DiscoveryCache:
+    """
+    On disk cache of what the Handler and the PlugInEngine discover by importing and inspecting modules.
+
+    Every entry is stored with the modification time and size of the source files it was derived from and is only
+    returned while all of those files are unchanged, so editing a dcnm_ module or the plugins module is picked up
+    by the next run. The cache is best effort: an unreadable or unwritable cache file just means discovery runs.
+    Set the DCNM_DISCOVERY_CACHE environment variable to another file name, or to an empty string to disable it.
+    """
+
+    def __init__(self, cache_file: Optional[str] = None):
+        if cache_file is None:
+            cache_file = os.environ.get("DCNM_DISCOVERY_CACHE", DEFAULT_DISCOVERY_CACHE)
+        self.cache_file = cache_file
+        self.enabled = bool(cache_file)
+        self._entries: Optional[Dict[str, dict]] = None
+
+    @staticmethod
+    def fingerprint(files: Iterable[str]) -> Dict[str, list]:
+        """
+        :return: {absolute file name: [modification time in ns, size]}, None values for missing files
+        :rtype: dict
+        """
+        result = {}
+        for file in sorted(files):
+            file = os.path.abspath(file)
+            try:
+                stat = os.stat(file)
+            except OSError:
+                result[file] = None
+            else:
+                result[file] = [stat.st_mtime_ns, stat.st_size]
+        return result
+
+    def _read(self) -> Dict[str, dict]:
+        if self._entries is None:
+            self._entries = {}
+            if os.path.isfile(self.cache_file):
+                try:
+                    with open(self.cache_file) as f:
+                        self._entries = json.load(f)
+                except (OSError, ValueError) as e:
+                    logger.debug("discovery cache: unable to read {}: {}".format(self.cache_file, e))
+        return self._entries
+
+    def get(self, key: str, files: Iterable[str]) -> Optional[Any]:
+        """
+        :param key: name of the entry
+        :type key: str
+        :param files: source files the entry was derived from
+        :type files: iterable
+        :return: the cached value, or None if there is none or one of the files changed since it was stored
+        """
+        if not self.enabled:
+            return None
+        entry = self._read().get(key)
+        if entry is None or entry['files'] != self.fingerprint(files):
+            logger.debug("discovery cache: no valid entry for {}".format(key))
+            return None
+        return entry['value']
+
+    def put(self, key: str, files: Iterable[str], value: Any):
+        if not self.enabled:
+            return
+        entries = self._read()
+        entries[key] = {'files': self.fingerprint(files), 'value': value}
+        tmp = self.cache_file + '.tmp'
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.cache_file)), exist_ok=True)
+            with open(tmp, 'w') as f:
+                json.dump(entries, f)
+            os.replace(tmp, self.cache_file)
+        except OSError as e:
+            logger.debug("discovery cache: unable to write {}: {}".format(self.cache_file, e))
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.cache_file!r})'
@@ -0,0 +1,203 @@
+"""
+Structured export of the interfaces, policies and switch details collected from DCNM
+
+The default format is newline delimited json, optionally gzip compressed when the file name ends in .gz
+
+    {"format": "dcnm-export", "version": 1, "kind": "interfaces", "created": 1634567890.1}     header
+    {"key": ["Ethernet1/1", "FDO21120U5D"], "value": {...}}                                    one line per record
+    ...
+
+Records are written one at a time as the dictionary is walked and read back one line at a time, so neither side
+builds the whole file in memory. Tuple keys are written as json lists and turned back into tuples on load.
+Policies are written one record per policy rather than one per switch.
+
+File names ending in .parquet are written as a table with a serial_number column (and an interface column for
+interfaces) and the record as json in a value column. Parquet needs the optional pandas package (and a parquet
+engine such as pyarrow) and is built in memory before being written.
+"""
+import gzip
+import json
+import logging
+import os
+from collections import defaultdict
+from time import time
+from typing import Dict, Iterable, Iterator, Optional, Tuple, Union
+
+from DCNM_errors import DCNMFileError
+
+logger = logging.getLogger(__name__)
+
+EXPORT_FORMAT = "dcnm-export"
+EXPORT_VERSION = 1
+
+# kinds of export
+INTERFACES = 'interfaces'
+POLICIES = 'policies'
+SWITCHES = 'switches'
+KINDS = (INTERFACES, POLICIES, SWITCHES)
+
+NDJSON = 'ndjson'
+PARQUET = 'parquet'
+
+
+def _format(file: str, fmt: Optional[str] = None) -> str:
+    if fmt is not None:
+        if fmt not in (NDJSON, PARQUET):
+            raise DCNMFileError("unknown export format {}, use {} or {}".format(fmt, NDJSON, PARQUET))
+        return fmt
+    return PARQUET if file.endswith('.parquet') else NDJSON
+
+
+def _open(file: str, mode: str, compressed: bool):
+    if compressed:
+        return gzip.open(file, mode + 't', compresslevel=6)
+    return open(file, mode)
+
+
+def _serial_number(key: Union[str, tuple]) -> str:
+    return key[1] if isinstance(key, tuple) else key
+
+
+def iter_records(data: dict, kind: str) -> Iterator[Tuple[Union[str, tuple], dict]]:
+    """
+    :return: generator of (key, record), one per policy for policies
+    """
+    for key, value in data.items():
+        if kind == POLICIES:
+            for policy in value:
+                yield key, policy
+        else:
+            yield key, value
+
+
+def _import_pandas():
+    try:
+        import pandas
+    except ImportError:
+        raise DCNMFileError("the pandas package is required for parquet exports, use a .json or .ndjson file name "
+                            "for newline delimited json instead")
+    return pandas
+
+
+def save_records(data: dict, file: str, kind: str, fmt: Optional[str] = None) -> int:
+    """
+    :param data: interfaces keyed by (interface name, serial number), or policies or switch details keyed by
+    serial number
+    :type data: dict
+    :param file: name of the file to write
+    :type file: str
+    :param kind: interfaces, policies or switches
+    :type kind: str
+    :param fmt: ndjson or parquet, picked from the file name if None
+    :type fmt: str or None
+    :return: number of records written
+    :rtype: int
+    """
+    if kind not in KINDS:
+        raise DCNMFileError("unknown export kind {}".format(kind))
+    fmt = _format(file, fmt)
+    if fmt == PARQUET:
+        return _save_parquet(data, file, kind)
+    count = 0
+    tmp = file + '.tmp'
+    with _open(tmp, 'w', file.endswith('.gz')) as f:
+        f.write(json.dumps({'format': EXPORT_FORMAT, 'version': EXPORT_VERSION, 'kind': kind,
+                            'created': time()}) + '\n')
+        for key, record in iter_records(data, kind):
+            if isinstance(key, tuple):
+                key = list(key)
+            f.write(json.dumps({'key': key, 'value': record}, separators=(',', ':')) + '\n')
+            count += 1
+    os.replace(tmp, file)
+    logger.info("export: wrote {} {} records to {}".format(count, kind, file))
+    return count
+
+
+def _save_parquet(data: dict, file: str, kind: str) -> int:
+    pandas = _import_pandas()
+    columns = defaultdict(list)
+    for key, record in iter_records(data, kind):
+        columns['serial_number'].append(_serial_number(key))
+        if kind == INTERFACES:
+            columns['interface'].append(key[0])
+        columns['value'].append(json.dumps(record, separators=(',', ':')))
+    frame = pandas.DataFrame(columns, columns=['serial_number', 'interface', 'value'] if kind == INTERFACES
+                             else ['serial_number', 'value'])
+    frame.attrs['kind'] = kind
+    frame.to_parquet(file, index=False)
+    logger.info("export: wrote {} {} records to {}".format(len(frame), kind, file))
+    return len(frame)
+
+
+def _read_ndjson(file: str, kind: Optional[str]) -> Iterator[Tuple[Union[str, tuple], dict]]:
+    with _open(file, 'r', file.endswith('.gz')) as f:
+        try:
+            header = json.loads(f.readline())
+        except ValueError:
+            header = None
+        if not isinstance(header, dict) or header.get('format') != EXPORT_FORMAT:
+            raise DCNMFileError("{} is not a dcnm export file".format(file))
+        if header['version'] > EXPORT_VERSION:
+            raise DCNMFileError("export {} has version {}, this program reads up to version {}".format(
+                file, header['version'], EXPORT_VERSION))
+        if kind is not None and header['kind'] != kind:
+            raise DCNMFileError("export {} holds {}, not {}".format(file, header['kind'], kind))
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                key = record['key']
+                yield tuple(key) if isinstance(key, list) else key, record['value']
+
+
+def _read_parquet(file: str, kind: Optional[str]) -> Iterator[Tuple[Union[str, tuple], dict]]:
+    pandas = _import_pandas()
+    frame = pandas.read_parquet(file)
+    if kind is not None and frame.attrs.get('kind', kind) != kind:
+        raise DCNMFileError("export {} holds {}, not {}".format(file, frame.attrs['kind'], kind))
+    if 'interface' in frame.columns:
+        for interface, serial_number, value in zip(frame['interface'], frame['serial_number'], frame['value']):
+            yield (interface, serial_number), json.loads(value)
+    else:
+        for serial_number, value in zip(frame['serial_number'], frame['value']):
+            yield serial_number, json.loads(value)
+
+
+def read_records(file: str, kind: Optional[str] = None,
+                 serial_numbers: Optional[Iterable[str]] = None) -> Iterator[Tuple[Union[str, tuple], dict]]:
+    """
+    :param file: export file written by save_records
+    :type file: str
+    :param kind: raise DCNMFileError if the file holds another kind of record
+    :type kind: str or None
+    :param serial_numbers: only return the records of these serial numbers
+    :type serial_numbers: iterable or None
+    :return: generator of (key, record) in the order they were written
+    """
+    if not os.path.isfile(file):
+        logger.critical("Error: file {} not found".format(file))
+        raise DCNMFileError("Error: input file {} not found".format(file))
+    reader = _read_parquet if _format(file) == PARQUET else _read_ndjson
+    if serial_numbers is not None:
+        serial_numbers = set(serial_numbers)
+    for key, record in reader(file, kind):
+        if serial_numbers is None or _serial_number(key) in serial_numbers:
+            yield key, record
+
+
+def load_records(file: str, kind: str, serial_numbers: Optional[Iterable[str]] = None) -> dict:
+    """
+    :param file: export file written by save_records
+    :type file: str
+    :param kind: interfaces, policies or switches
+    :type kind: str
+    :param serial_numbers: only load the records of these serial numbers
+    :type serial_numbers: iterable or None
+    :return: the dictionary that was exported, policies are grouped back into a list per serial number
+    :rtype: dict
+    """
+    if kind == POLICIES:
+        policies: Dict[str, list] = defaultdict(list)
+        for serial_number, policy in read_records(file, kind, serial_numbers):
+            policies[serial_number].append(policy)
+        return dict(policies)
+    return dict(read_records(file, kind, serial_numbers))
@@ -0,0 +1,131 @@
+"""
+Interface index of switch freeform policies
+
+A switch_freeform policy holds free CLI text in its generatedConfig, e.g.
+
+    interface Ethernet1/1
+      description server 1
+      no cdp enable
+    interface Ethernet1/2
+      description server 2
+
+FreeformIndex reads the configs of a set of switch policies once, line by line, and indexes the interface blocks
+by (interface name, serial number). Each entry holds the description, the other lines of the block and the ids
+of the policies the block came from, so plugins needing interface scoped freeform lines do not each run their
+own regular expressions over every policy. The policies are read, never copied or changed.
+"""
+import logging
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+DESCRIPTION = 'description'
+
+
+def parse_freeform(config: str) -> Iterator[Tuple[str, List[str]]]:
+    """
+    :param config: freeform CLI text
+    :type config: str
+    :return: generator of (interface name, lines of the interface block with the indentation removed)
+
+    An interface block starts with an unindented interface line and holds the indented lines that follow it.
+    """
+    name: Optional[str] = None
+    lines: List[str] = []
+    for line in config.splitlines():
+        if not line.strip():
+            continue
+        if not line[0].isspace():
+            if name is not None:
+                yield name, lines
+            words = line.split(None, 1)
+            if len(words) == 2 and words[0].lower() == 'interface':
+                name, lines = words[1].strip(), []
+            else:
+                name = None
+        elif name is not None:
+            lines.append(line.lstrip())
+    if name is not None:
+        yield name, lines
+
+
+class FreeformInterface:
+    """
+    The freeform configuration of an interface
+    """
+    __slots__ = ('description', 'lines', 'policy_ids')
+
+    def __init__(self):
+        self.description: Optional[str] = None
+        # lines of the interface blocks other than the description
+        self.lines: List[str] = []
+        self.policy_ids: List[str] = []
+
+    def __repr__(self):
+        return f'{type(self).__name__}(description={self.description!r}, lines={self.lines!r}, ' \
+               f'policy_ids={self.policy_ids!r})'
+
+
+class FreeformIndex:
+    """
+    (interface name, serial number) -> FreeformInterface, built from switch policies
+
+    :param policies: switch policies keyed by serial number
+    :type policies: dict or None
+    """
+
+    def __init__(self, policies: Optional[Dict[str, Iterable[dict]]] = None):
+        self.interfaces: Dict[Tuple[str, str], FreeformInterface] = {}
+        # policies that configure the description of at least one interface
+        self.description_policy_ids: Set[str] = set()
+        if policies:
+            for serial_number, switch_policies in policies.items():
+                for policy in switch_policies:
+                    self.add_policy(serial_number, policy)
+
+    def add_policy(self, serial_number: str, policy: dict):
+        config = policy.get('generatedConfig')
+        if not config:
+            return
+        policy_id = policy.get('policyId')
+        for name, lines in parse_freeform(config):
+            interface = self.interfaces.get((name, serial_number))
+            if interface is None:
+                interface = self.interfaces[(name, serial_number)] = FreeformInterface()
+            if policy_id not in interface.policy_ids:
+                interface.policy_ids.append(policy_id)
+            for line in lines:
+                words = line.split(None, 1)
+                if words[0].lower() == DESCRIPTION:
+                    # a later policy overrides the description of an earlier one
+                    interface.description = words[1] if len(words) == 2 else ''
+                    self.description_policy_ids.add(policy_id)
+                else:
+                    interface.lines.append(line.rstrip())
+
+    def descriptions(self) -> Dict[Tuple[str, str], str]:
+        """
+        :return: description keyed by (interface name, serial number), for the interfaces that have one
+        :rtype: dict
+        """
+        return {key: interface.description for key, interface in self.interfaces.items()
+                if interface.description is not None}
+
+    def get(self, key: Tuple[str, str]) -> Optional[FreeformInterface]:
+        return self.interfaces.get(key)
+
+    def __getitem__(self, key: Tuple[str, str]) -> FreeformInterface:
+        return self.interfaces[key]
+
+    def __contains__(self, key) -> bool:
+        return key in self.interfaces
+
+    def __len__(self) -> int:
+        return len(self.interfaces)
+
+    def __iter__(self):
+        return iter(self.interfaces)
+
+    def __repr__(self):
+        return f'{type(self).__name__}({len(self.interfaces)} interfaces, ' \
+               f'{len(self.description_policy_ids)} description policies)'
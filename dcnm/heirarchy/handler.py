@@ -5,6 +5,7 @@ import os
 from typing import Optional, Callable, List, Dict
 
 from DCNM_connect import DcnmRestApi
+from discovery import DiscoveryCache
 
 logger = logging.getLogger(__name__)
 
@@ -13,6 +14,10 @@ class HandlerError(Exception):
     pass
 
 
+# marks an attribute a component does not have, None is a legitimate attribute value
+_MISSING = object()
+
+
 class SingletonMeta(type):
     _instances = {}
 
@@ -23,17 +28,39 @@ class SingletonMeta(type):
 
 
 class Handler(metaclass=SingletonMeta):
-    def __init__(self, dcnm: DcnmRestApi, module_directory: str = '.'):
+    def __init__(self, dcnm: DcnmRestApi, module_directory: str = '.',
+                 discovery_cache: Optional[DiscoveryCache] = None):
         self.dcnm = dcnm
         self.module_directory = module_directory
+        self.discovery_cache = discovery_cache if discovery_cache is not None else DiscoveryCache()
+        # components are created the first time one of their attributes is used
+        self.dcnm_objects: Dict[str, object] = {}
+        self._dcnm_object_modules: Dict[str, str] = {}
+        # attribute name -> name of the component that has it
+        self._dispatch: Dict[str, str] = {}
         files: List[str] = self._get_module_list(module_directory)
-        self.dcnm_objects: Dict[str, object] = self._import_dcnm_objects(files)
-        self.dcnm_objects_dirs: Dict[str, List] = self._get_dcnm_objects_dirs()
+        self.dcnm_objects_dirs: Dict[str, List] = self._discover_dcnm_objects(files)
+        self._dispatch = self._build_dispatch(self.dcnm_objects_dirs)
 
     def _get_module_list(self, module_directory: str):
         files = [f.replace('.py', '') for f in os.listdir(module_directory) if f.startswith('dcnm_')]
         return files
 
+    def _discover_dcnm_objects(self, files: List[str]) -> Dict[str, List]:
+        """
+        :return: dir() of each component, read from the discovery cache when none of the dcnm_ modules changed
+        """
+        source_files = [os.path.join(self.module_directory, file + '.py') for file in files] + [__file__]
+        cache_key = 'handler:' + os.path.abspath(self.module_directory)
+        cached = self.discovery_cache.get(cache_key, source_files)
+        if cached is not None:
+            self._dcnm_object_modules = cached['modules']
+            return cached['dirs']
+        self.dcnm_objects = self._import_dcnm_objects(files)
+        dirs = self._get_dcnm_objects_dirs()
+        self.discovery_cache.put(cache_key, source_files, {'modules': self._dcnm_object_modules, 'dirs': dirs})
+        return dirs
+
     def _import_dcnm_objects(self, files: List[str]):
         _modules = [importlib.import_module(file, ".") for file in files]
         dcnm_objects = {}
@@ -41,43 +68,55 @@ class Handler(metaclass=SingletonMeta):
             for k, v in inspect.getmembers(m):
                 if "Dcnm" in k and inspect.isclass(v) and any(["DcnmComponent" in str(base) for base in v.__bases__]):
                     dcnm_objects[k] = v(self, self.dcnm)
+                    self._dcnm_object_modules[k] = m.__name__
                     break
         logger.debug(dcnm_objects)
         return dcnm_objects
 
+    def get_dcnm_object(self, name: str):
+        """ the component named name, imported and created on first use """
+        dcnm_object = self.dcnm_objects.get(name)
+        if dcnm_object is None:
+            module = importlib.import_module(self._dcnm_object_modules[name], ".")
+            dcnm_object = getattr(module, name)(self, self.dcnm)
+            self.dcnm_objects[name] = dcnm_object
+        return dcnm_object
+
     def __getattr__(self, name: str):
-        logger.debug(f"handler: __getattr__: getting {name} of type {type(name)}")
         dcnm_object_name = self.find_dcnm_object_attr(name)
-        attribute = getattr(self.dcnm_objects[dcnm_object_name], name, None)
-        if attribute is None:
-            logger.debug(f"handler: __getattr__: Cannot find attribute {name}")
+        if dcnm_object_name is None:
+            logger.debug("handler: __getattr__: Cannot find attribute %s", name)
+            raise HandlerError(f"Handler Cannot Find Attribute {name}")
+        attribute = getattr(self.get_dcnm_object(dcnm_object_name), name, _MISSING)
+        if attribute is _MISSING:
+            logger.debug("handler: __getattr__: Cannot find attribute %s", name)
             raise HandlerError(f"Handler Cannot Find Attribute {name}")
-        logger.debug(f"handler: __getattr__: attribute is {attribute}")
-        if callable(attribute):
-            def _method(*args, **kwargs):
-                logger.debug(f"handler: __getattr__: tried to handle unknown method {name}")
-                if args:
-                    logger.debug(f"handler: __getattr__: it had arguments: {args}, {kwargs}")
-                y = attribute(*args, **kwargs)
-                logger.debug(f"handler: __getattr__: y from __call__ is {y} and is {type(y)}")
-                return y
-
-            return _method
-        else:
-            return attribute
+        if inspect.ismethod(attribute):
+            # methods do not change, keep the bound method on the handler so the next lookup never gets here.
+            # data attributes and properties are looked up every time, they change as the components work
+            logger.debug("handler: __getattr__: caching method %s of %s", name, dcnm_object_name)
+            self.__dict__[name] = attribute
+        return attribute
 
     def _get_dcnm_objects_dirs(self):
         return {name: dir(dcnm_obj) for name, dcnm_obj in self.dcnm_objects.items()}
 
+    @staticmethod
+    def _build_dispatch(dcnm_objects_dirs: Dict[str, List]) -> Dict[str, str]:
+        """ attribute name -> component name, the first component with the attribute wins """
+        dispatch: Dict[str, str] = {}
+        for name, attributes in dcnm_objects_dirs.items():
+            for attribute in attributes:
+                dispatch.setdefault(attribute, name)
+        return dispatch
+
     def find_dcnm_object_attr(self, attribute):
-        for name, dir in self.dcnm_objects_dirs.items():
-            if attribute in dir:
-                return name
+        return self._dispatch.get(attribute)
 
     def __dir__(self):
         dirs = object.__dir__(self)
-        for dcnm_obj in self.dcnm_objects.values():
-            dirs += dir(dcnm_obj)
+        for dcnm_obj_dir in self.dcnm_objects_dirs.values():
+            dirs += dcnm_obj_dir
         return sorted(list(set(dirs)))
 
     def __repr__(self):
@@ -91,7 +130,6 @@ class DcnmComponent:
         super().__init__(**kwargs)
 
     def __getattr__(self, name):
-        logger.debug(f"DcnmComponent: __getattr__: getting {name} of type {type(name)}")
         return getattr(self.handler, name)
 
 
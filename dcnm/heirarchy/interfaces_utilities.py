@@ -7,13 +7,14 @@ from copy import deepcopy
 from functools import partial
 from pickle import load
 from pprint import pprint
-from typing import Optional, Union, Dict, List, Tuple, Set, Callable, Iterable
-
-from colorama import init, Back, Fore, Style
+from typing import Optional, Union, Dict, List, Tuple, Set, Callable, Iterable, FrozenSet, Mapping
 
 from DCNM_errors import DCNMPolicyDeployError, DCNMValueError
-from DCNM_errors import ExcelFileError, DCNMFileError
+from DCNM_errors import DCNMFileError
+from descriptions import load_descriptions
 from handler import Handler
+from inventory_diff import InventoryDiff
+from journal import ChangeJournal, DEPLOY, POLICIES_DEPLOY
 from plugin_utils import PlugInEngine
 
 logger = logging.getLogger(__name__)
@@ -33,31 +34,19 @@ def _dbg(header: str, data=None):
 
 def read_existing_descriptions(file: str) -> Dict[tuple, str]:
     """
-    :param file: an Excel file path/name containing columns "interface", "switch" and "description"
-    the switch column is the switch serial number
+    :param file: an Excel (or csv or parquet) file path/name containing columns "interface", "switch" and
+    "description", the switch column is the switch serial number
     :type file: str
     :return: dictionary
     :rtype: dict[tuple, str]
 
     Read in an Excel file and return a dictionary of form {(interface, switch_serial_number): interface_description}
     """
-    import pandas
-    from pandas import read_excel
     if _file_check(file, skip_load=True):
-        existing_descriptions_local: dict
-        logger.debug("reading excel file {}".format(file))
-        df: pandas.DataFrame = read_excel(file)
-        df.columns = df.columns.str.lower()
-        if 'description' not in df.columns or 'interface' not in df.columns or 'switch' not in df.columns:
-            logger.debug("Columns missing. {}".format(df.columns))
-            raise ExcelFileError('One or more columns missing')
-        existing_descriptions_local = df.to_dict('records')
-        # print(existing_descriptions)
-        existing_descriptions_local = {(interface['interface'], interface['switch']): interface['description'] for
-                                       interface
-                                       in
-                                       existing_descriptions_local}
-        logger.debug("read_existing_descriptions: existing descriptions: {}".format(existing_descriptions_local))
+        logger.debug("reading descriptions file {}".format(file))
+        existing_descriptions_local: Dict[tuple, str] = load_descriptions(file)
+        logger.debug("read_existing_descriptions: read {} existing descriptions".format(
+            len(existing_descriptions_local)))
         return existing_descriptions_local
 
 
@@ -90,19 +79,71 @@ def get_interfaces_to_change(handler: Handler,
     logger.debug("get_interfaces_to_change: initializing plugins")
     plugins.initialize_selected_plugins(handler, args, serials)
     logger.debug("get_interfaces_to_change: running plugins")
+    changed = plugins.run_selected_plugins_on(existing_interfaces, handler.all_leaf_switches,
+                                              workers=getattr(args, 'workers', 1))
     for interface, details in existing_interfaces.items():
-        change: bool = False
-        # print(details)
-        change = plugins.run_selected_plugins(interface, details,
-                                              leaf=interface[1] in handler.all_leaf_switches)
-        if change:
+        if interface in changed:
             interfaces_original[interface] = handler.all_interfaces_nvpairs[interface]
             interfaces_to_change[interface] = details
     logger.debug("Interfaces to change: {}".format(interfaces_to_change))
     return interfaces_to_change, interfaces_original
 
 
-def verify_interface_change(handler: Handler, interfaces_will_change: dict, verbose: bool = True, **kwargs):
+# fields DCNM sets itself, so they are not compared
+UNVERIFIED_FIELDS = frozenset({'PRIORITY', 'FABRIC_NAME'})
+
+
+def interface_field_diffs(expected: Mapping[tuple, dict], actual: Mapping[tuple, dict],
+                          fields: Optional[Mapping[tuple, Iterable[str]]] = None) -> Dict[tuple, Dict[str, tuple]]:
+    """
+    :param expected: the desired interface details, keyed by (interface name, serial number)
+    :type expected: dict
+    :param actual: the interface details pulled from DCNM
+    :type actual: dict
+    :param fields: the nvPairs keys to compare for each interface, interfaces missing from it or with no keys have
+    all of their nvPairs except UNVERIFIED_FIELDS and their policy compared
+    :type fields: dict or None
+    :return: {interface: {nvPairs key or 'policy': (expected value, value in DCNM)}} of the interfaces that do not
+    match, values missing from DCNM are None
+    :rtype: dict
+
+    Only the requested fields are read, nothing is copied.
+    """
+    diffs: Dict[tuple, Dict[str, tuple]] = {}
+    for interface, detail in expected.items():
+        expected_nvpairs = detail['interfaces'][0]['nvPairs']
+        actual_detail = actual.get(interface)
+        actual_nvpairs = actual_detail['interfaces'][0]['nvPairs'] if actual_detail else {}
+        keys = fields.get(interface) if fields is not None else None
+        # no recorded field, e.g. a plugin that only changed the policy, falls back to comparing everything
+        full = not keys
+        if full:
+            keys = (expected_nvpairs.keys() | actual_nvpairs.keys()) - UNVERIFIED_FIELDS
+        interface_diffs = {key: (expected_nvpairs.get(key), actual_nvpairs.get(key)) for key in keys
+                           if expected_nvpairs.get(key) != actual_nvpairs.get(key)}
+        if full and detail.get('policy') != (actual_detail or {}).get('policy'):
+            interface_diffs['policy'] = (detail.get('policy'), (actual_detail or {}).get('policy'))
+        if interface_diffs:
+            diffs[interface] = interface_diffs
+    return diffs
+
+
+def _report_drift(drift: InventoryDiff, interfaces_will_change: Mapping[tuple, dict], verbose: bool):
+    """ warn about the interfaces that changed since they were pulled but were not changed by this run """
+    if not drift.old:
+        return
+    unexpected = drift.changed - interfaces_will_change.keys()
+    if unexpected:
+        logger.warning("verify_interface_change: {} interfaces changed outside this run: {}".format(
+            len(unexpected), sorted(unexpected)))
+        if verbose:
+            _dbg("Interfaces changed outside this run", {interface: drift.fields(interface)
+                                                          for interface in sorted(unexpected)})
+
+
+def verify_interface_change(handler: Handler, interfaces_will_change: dict, verbose: bool = True,
+                            fields: Optional[Mapping[tuple, Iterable[str]]] = None,
+                            **kwargs) -> Dict[tuple, Dict[str, tuple]]:
     """
 
     :param handler: An object that provides access to DCNM-interfacing objects
@@ -111,48 +152,48 @@ def verify_interface_change(handler: Handler, interfaces_will_change: dict, verb
     :type interfaces_will_change: dict
     :param verbose: output more information if this is set
     :type verbose: bool
-    :param kwargs:
+    :param fields: the nvPairs keys changed for each interface, e.g. PlugInEngine.changed_fields, if None all
+    nvPairs are compared
+    :type fields: dict or None
+    :param kwargs: passed to get_interfaces_nvpairs
     :type kwargs:
-    :return: None
-    :rtype:
+    :return: {interface: {nvPairs key: (desired value, value in DCNM)}} of the interfaces that failed verification
+    :rtype: dict
 
-    Pulls interface information from DCNM and compares it to the interfaces_will_change dict.
-    Displays failures.
+    Pulls the interfaces of the switches that changed from DCNM and compares the changed fields to the
+    interfaces_will_change dict. Displays failures. Other interfaces of those switches that differ from the
+    previous pull are reported as changed outside this run.
     """
-    handler.get_interfaces_nvpairs(save_prev=True, **kwargs)
-    failed: set = set()
-    success: set = set()
     if verbose:
         _dbg("Verifying Interface Configurations")
-    interfaces_will_change_local = deepcopy(interfaces_will_change)
-    all_interfaces_nv_pairs_local = deepcopy(handler.all_interfaces_nvpairs)
-    for interface in interfaces_will_change:
-        # priority changes, so remove from comparison
-        interfaces_will_change_local[interface]['interfaces'][0]['nvPairs'].pop('PRIORITY', None)
-        interfaces_will_change_local[interface]['interfaces'][0]['nvPairs'].pop('FABRIC_NAME', None)
-        all_interfaces_nv_pairs_local[interface]['interfaces'][0]['nvPairs'].pop('PRIORITY', None)
-        all_interfaces_nv_pairs_local[interface]['interfaces'][0]['nvPairs'].pop('FABRIC_NAME', None)
-        if interfaces_will_change_local[interface] == all_interfaces_nv_pairs_local[interface]:
-            logger.debug("Verification confirmed for interface {}".format(interface))
-            logger.debug("{}".format(interfaces_will_change[interface]))
-            success.add(interface)
-        else:
-            logger.critical("Verification failed for interface {}".format(interface))
-            logger.critical("Desired configuration: {}".format(interfaces_will_change[interface]))
-            logger.critical("Configuration pulled from DCNM: {}".format(handler.all_interfaces_nvpairs[interface]))
-            failed.add(interface)
+    if not interfaces_will_change:
+        logger.debug("verify_interface_change: nothing to verify")
+        return {}
+    # only the switches with changed interfaces are pulled
+    kwargs['serial_numbers'] = sorted({serial_number for _, serial_number in interfaces_will_change})
+    handler.get_interfaces_nvpairs(save_prev=True, **kwargs)
+    _report_drift(handler.diff_interfaces_nvpairs(serial_numbers=kwargs['serial_numbers']), interfaces_will_change,
+                  verbose)
+    failed = interface_field_diffs(interfaces_will_change, handler.all_interfaces_nvpairs, fields)
+    logger.debug("verify_interface_change: verified {} interfaces, {} failed".format(len(interfaces_will_change),
+                                                                                    len(failed)))
+    for interface, diffs in failed.items():
+        logger.critical("Verification failed for interface {}".format(interface))
+        for key, (desired, actual) in sorted(diffs.items()):
+            logger.critical("    {}: desired {!r}, DCNM has {!r}".format(key, desired, actual))
     if failed:
-        if failed:
-            _failed_dbg("verify_interface_change:  Failed configuring {}".format(failed),
-                        ("Failed verification config changes to for the following switches:", failed))
+        _failed_dbg("verify_interface_change:  Failed configuring {}".format(set(failed)),
+                    ("Failed verification config changes to for the following switches:",
+                     failed if verbose else set(failed)))
     else:
         logger.debug("verify_interface_change: No Failures!")
         if verbose:
             _dbg("Successfully Verified All Interface Changes! Yay!")
-    # return success, failed
+    return failed
 
 
-def push_to_dcnm(handler: Handler, interfaces_to_change: dict, verbose: bool = True) -> set:
+def push_to_dcnm(handler: Handler, interfaces_to_change: dict, verbose: bool = True,
+                 journal: Optional[ChangeJournal] = None) -> set:
     """
 
     :param handler: An object that provides access to DCNM-interfacing objects
@@ -161,6 +202,8 @@ def push_to_dcnm(handler: Handler, interfaces_to_change: dict, verbose: bool = T
     :type interfaces_will_change: dict
     :param verbose: output more information if this is set
     :type verbose: bool
+    :param journal: optional change journal, interfaces it records as pushed are skipped
+    :type journal: ChangeJournal
     :return: successful changes
     :rtype: set
 
@@ -170,7 +213,7 @@ def push_to_dcnm(handler: Handler, interfaces_to_change: dict, verbose: bool = T
     failure: set
     if verbose:
         _dbg("Putting changes to dcnm")
-    success, failure = handler.put_interface_changes(interfaces_to_change)
+    success, failure = handler.put_interface_changes(interfaces_to_change, journal=journal)
     if failure:
         _failed_dbg("Failed putting to DCNM for the following: {}".format(failure),
                     ("Failed pushing config changes to DCNM for the following switches:", failure))
@@ -204,7 +247,8 @@ def deploy_to_fabric_using_interface_deploy(handler: Handler, deploy: Union[Set[
                                             policies: Optional[Union[list, tuple, str]] = None,
                                             deploy_timeout: int = 300,
                                             fallback: bool = False,
-                                            verbose: bool = True):
+                                            verbose: bool = True,
+                                            journal: Optional[ChangeJournal] = None):
     """
 
     :param handler: An object that provides access to DCNM-interfacing objects
@@ -219,14 +263,22 @@ def deploy_to_fabric_using_interface_deploy(handler: Handler, deploy: Union[Set[
     :type fallback: bool
     :param verbose: True means to print more information
     :type verbose: bool
+    :param journal: optional change journal, a deploy it records as completed is not repeated
+    :type journal: ChangeJournal
 
     Pushes interface and policy changes to the fabric using the interface deploy API
     """
     deploy_list: list = create_deploy_list(deploy)
     if verbose:
         _dbg('Deploying changes to switches')
-    if handler.deploy_interfaces(deploy_list, deploy_timeout=deploy_timeout):
+    if journal is not None and journal.deploy_done('interfaces', {serial_number for _, serial_number in deploy}):
+        logger.info("interface deploy already completed according to the journal")
+        if verbose:
+            _dbg('Interface deploy already completed according to the journal', deploy)
+    elif handler.deploy_interfaces(deploy_list, deploy_timeout=deploy_timeout):
         logger.debug('successfully deployed to {}'.format(deploy))
+        if journal is not None:
+            journal.record(DEPLOY, 'interfaces')
         if verbose:
             _dbg('!!Successfully Deployed Config Changes to Switches!!', deploy)
     else:
@@ -236,7 +288,7 @@ def deploy_to_fabric_using_interface_deploy(handler: Handler, deploy: Union[Set[
     print('=' * 40)
     print('=' * 40)
     if policies and fallback:
-        fallback_policy_deploy(handler, policies, deploy_timeout=deploy_timeout, verbose=verbose)
+        fallback_policy_deploy(handler, policies, deploy_timeout=deploy_timeout, verbose=verbose, journal=journal)
     print()
     print('=' * 40)
     print('=' * 40)
@@ -245,7 +297,8 @@ def deploy_to_fabric_using_interface_deploy(handler: Handler, deploy: Union[Set[
 
 
 def fallback_policy_deploy(handler: Handler,
-                           policies: Union[list, tuple, str], deploy_timeout: int = 300, verbose: bool = True):
+                           policies: Union[list, tuple, str], deploy_timeout: int = 300, verbose: bool = True,
+                           journal: Optional[ChangeJournal] = None):
     """
 
     :param handler: An object that provides access to DCNM-interfacing objects
@@ -256,6 +309,8 @@ def fallback_policy_deploy(handler: Handler,
     :type deploy_timeout: int
     :param verbose: True means to print more information
     :type verbose: bool
+    :param journal: optional change journal, the policy deploy is skipped if it records it as completed
+    :type journal: ChangeJournal
 
     Deploys previous policies during fallback operation
     """
@@ -263,8 +318,12 @@ def fallback_policy_deploy(handler: Handler,
         policies = [policies]
     if verbose:
         _dbg("DEPLOYING POLICIES: ", policies)
-    if handler.deploy_policies(policies, deploy_timeout=deploy_timeout):
+    if journal is not None and journal.deploy_done(POLICIES_DEPLOY, []):
+        logger.info("policy deploy already completed according to the journal")
+    elif handler.deploy_policies(policies, deploy_timeout=deploy_timeout):
         logger.debug('successfully deployed policies {}'.format(policies))
+        if journal is not None:
+            journal.record(DEPLOY, POLICIES_DEPLOY)
         if verbose:
             _dbg('!!Successfully Deployed Config Policies to Switches!!', policies)
     else:
@@ -275,7 +334,8 @@ def fallback_policy_deploy(handler: Handler,
 def deploy_to_fabric_using_switch_deploy(handler: Handler,
                                          serial_numbers: Optional[Union[str, list, tuple]] = None,
                                          deploy_timeout: int = 300,
-                                         verbose: bool = True):
+                                         verbose: bool = True,
+                                         journal: Optional[ChangeJournal] = None):
     """
 
     :param handler: An object that provides access to DCNM-interfacing objects
@@ -286,6 +346,8 @@ def deploy_to_fabric_using_switch_deploy(handler: Handler,
     :type deploy_timeout: int
     :param verbose: True means to print more information
     :type verbose: bool
+    :param journal: optional change journal, switches it records as deployed are not deployed again
+    :type journal: ChangeJournal
 
     Pushes interface and policy changes to the fabric using the switch level deploy API
     """
@@ -301,7 +363,7 @@ def deploy_to_fabric_using_switch_deploy(handler: Handler,
                                         "alternatively, the get_all_switches or get_switches_by_serial_number\n"
                                         "must be called before using this function")
         else:
-            serial_numbers = handler.all_leaf_switches + handler.all_notleaf_switches
+            serial_numbers = sorted(handler.all_leaf_switches | handler.all_notleaf_switches)
     logger.debug("deploy_to_fabric_using_switch_deploy: deploying: serial numbers: {}".format(serial_numbers))
     reduced_serial_numbers = serial_numbers.copy()
     if len(reduced_serial_numbers) > 1:
@@ -310,8 +372,12 @@ def deploy_to_fabric_using_switch_deploy(handler: Handler,
     for serial_number in reduced_serial_numbers:
         if serial_number in deployed:
             continue
-        if handler.deploy_switch_config(serial_number):
+        if journal is not None and journal.deploy_done(serial_number, [serial_number]):
+            logger.info("switch deploy of {} already completed according to the journal".format(serial_number))
+        elif handler.deploy_switch_config(serial_number):
             logger.debug('deploy returned successfully')
+            if journal is not None:
+                journal.record(DEPLOY, serial_number)
             if verbose:
                 _dbg('deploy returned successfully for: ', serial_number)
         else:
@@ -343,6 +409,7 @@ def deploy_to_fabric_using_switch_deploy(handler: Handler,
 
 
 def _failed_dbg(log_msg: str, messages: tuple):
+    from colorama import init, Back, Fore, Style
     init()
     logger.critical(log_msg)
     print()
@@ -444,6 +511,40 @@ def _get_uplinks(uplinks_file: str) -> Dict[str, list]:
     return local_uplinks
 
 
+def _get_uplinks_by_switch(switches_details: Mapping, local_uplinks: Dict[str, list],
+                           serial_numbers: Iterable[str]) -> Dict[str, FrozenSet[str]]:
+    """
+    :param switches_details: switch details keyed by serial number, each with a model
+    :type switches_details: mapping
+    :param local_uplinks: uplink ports keyed by model, as returned by _get_uplinks
+    :type local_uplinks: dict
+    :param serial_numbers: switches to index
+    :type serial_numbers: iterable
+    :return: uplink ports keyed by serial number
+    :rtype: dict
+
+    A switch matches the first model of local_uplinks that is a substring of its model. Switches with no uplink
+    data are reported once and left out of the result.
+    """
+    uplinks_by_model: Dict[Optional[str], Optional[FrozenSet[str]]] = {}
+    uplinks_by_switch: Dict[str, FrozenSet[str]] = {}
+    missing: List[tuple] = []
+    for serial_number in serial_numbers:
+        details = switches_details.get(serial_number)
+        model = details['model'] if details is not None else None
+        if model not in uplinks_by_model:
+            uplinks = next((local_uplinks[m] for m in local_uplinks if model and m in model), None)
+            uplinks_by_model[model] = frozenset(uplinks) if uplinks else None
+        if uplinks_by_model[model] is None:
+            missing.append((serial_number, model))
+        else:
+            uplinks_by_switch[serial_number] = uplinks_by_model[model]
+    if missing:
+        _failed_dbg('orphan_port: No uplink data for switches {}'.format(missing),
+                    ('No uplink data for the models of these switches, their interfaces are not changed', missing))
+    return uplinks_by_switch
+
+
 def _get_serial_numbers(args: argparse.Namespace):
     """
     get serial numbers from cli or from filename provided by cli
@@ -0,0 +1,184 @@
+"""
+Content hash diff between inventory snapshots
+
+An inventory is a mapping of records, e.g. all_interfaces_nvpairs keyed by (interface name, serial number), or
+switch policies keyed by policy id (see policies_by_id). diff_inventories sorts the keys of two inventories into
+added, removed, modified and unchanged. Records that are the same object in both inventories are unchanged
+without looking at them, the others are compared by a digest of their json content.
+
+RecordHashes caches the digest of each record, so a record is hashed once however many diffs it takes part in.
+The cache is keyed by the record object: records of a pull are new objects, and records must not be changed in
+place once hashed. The inventories pulled from DCNM follow both rules, changes are planned on copies of them.
+"""
+import hashlib
+import json
+import logging
+from typing import Any, Dict, FrozenSet, Hashable, Iterable, List, Mapping, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+def record_digest(record: Any) -> bytes:
+    """ :return: digest of the json content of the record, independent of the order of dictionary keys """
+    content = json.dumps(record, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.blake2b(content.encode(), digest_size=16).digest()
+
+
+def policies_by_id(switches_policies: Mapping[str, Iterable[dict]]) -> Dict[str, dict]:
+    """
+    :param switches_policies: lists of policies keyed by serial number
+    :type switches_policies: dict
+    :return: the policies keyed by policy id
+    :rtype: dict
+    """
+    return {policy['policyId']: policy for policies in switches_policies.values() for policy in policies}
+
+
+def _serial_number(key: Hashable, record: dict) -> Optional[str]:
+    # interfaces are keyed by (interface name, serial number), policies carry their serial number
+    if isinstance(key, tuple):
+        return key[1]
+    return record.get('serialNumber')
+
+
+class RecordHashes:
+    """
+    Content digests cached per record object
+    """
+
+    def __init__(self):
+        self._digests: Dict[int, Tuple[Any, bytes]] = {}
+        self.hashed = 0
+
+    def digest(self, record: Any) -> bytes:
+        entry = self._digests.get(id(record))
+        # the record is kept with its digest, so its id is not reused by another object while it is cached
+        if entry is None or entry[0] is not record:
+            entry = self._digests[id(record)] = (record, record_digest(record))
+            self.hashed += 1
+        return entry[1]
+
+    def prune(self, *inventories: Mapping[Hashable, Any]):
+        """ forget the digests of the records that are in none of the inventories """
+        keep = {id(record) for inventory in inventories for record in inventory.values()}
+        self._digests = {key: entry for key, entry in self._digests.items() if key in keep}
+
+    def __len__(self) -> int:
+        return len(self._digests)
+
+    def __repr__(self):
+        return f'{type(self).__name__}({len(self._digests)} records)'
+
+
+class InventoryDiff:
+    """
+    Keys added, removed and modified between an old and a new inventory
+
+    :param old: the old inventory
+    :type old: dict
+    :param new: the new inventory
+    :type new: dict
+    """
+
+    def __init__(self, old: Mapping[Hashable, Any], new: Mapping[Hashable, Any]):
+        self.old = old
+        self.new = new
+        self.added: Set[Hashable] = set()
+        self.removed: Set[Hashable] = set()
+        self.modified: Set[Hashable] = set()
+        self.unchanged = 0
+        # switches with at least one added, removed or modified record
+        self.serial_numbers: Set[str] = set()
+
+    @property
+    def changed(self) -> FrozenSet[Hashable]:
+        return frozenset(self.added | self.removed | self.modified)
+
+    def fields(self, key: Hashable) -> List[str]:
+        """
+        :return: the nvPairs keys of a modified interface that differ, or the differing top level keys of another
+        record
+        :rtype: list
+        """
+        old, new = self.old.get(key) or {}, self.new.get(key) or {}
+        try:
+            old, new = old['interfaces'][0]['nvPairs'], new['interfaces'][0]['nvPairs']
+        except (KeyError, IndexError, TypeError):
+            pass
+        return sorted(field for field in old.keys() | new.keys() if old.get(field) != new.get(field))
+
+    def summary(self) -> Dict[str, int]:
+        return {'added': len(self.added), 'removed': len(self.removed), 'modified': len(self.modified),
+                'unchanged': self.unchanged, 'switches': len(self.serial_numbers)}
+
+    def report(self, limit: Optional[int] = None) -> str:
+        """
+        :param limit: list at most this many records of each kind, all if None
+        :type limit: int or None
+        """
+        lines = ["added: {added}, removed: {removed}, modified: {modified}, unchanged: {unchanged}, "
+                 "switches: {switches}".format(**self.summary())]
+        for kind, keys in (('+', self.added), ('-', self.removed), ('~', self.modified)):
+            keys = sorted(keys, key=str)
+            for key in keys[:limit]:
+                lines.append("{} {}{}".format(kind, key, ": " + ", ".join(self.fields(key)) if kind == '~' else ''))
+            if limit is not None and len(keys) > limit:
+                lines.append("{} ... {} more".format(kind, len(keys) - limit))
+        return '\n'.join(lines)
+
+    def print_report(self, limit: Optional[int] = 50):
+        print('=' * 40)
+        print("INVENTORY CHANGES")
+        print('=' * 40)
+        print(self.report(limit))
+
+    def __bool__(self) -> bool:
+        return bool(self.added or self.removed or self.modified)
+
+    def __repr__(self):
+        return '{}({})'.format(type(self).__name__,
+                               ', '.join('{}={}'.format(name, count) for name, count in self.summary().items()))
+
+
+def diff_inventories(old: Mapping[Hashable, Any], new: Mapping[Hashable, Any],
+                     hashes: Optional[RecordHashes] = None,
+                     serial_numbers: Optional[Iterable[str]] = None) -> InventoryDiff:
+    """
+    :param old: the old inventory
+    :type old: dict
+    :param new: the new inventory
+    :type new: dict
+    :param hashes: digest cache, a new one if None
+    :type hashes: RecordHashes or None
+    :param serial_numbers: only compare the records of these switches, e.g. the switches a partial pull refreshed
+    :type serial_numbers: iterable or None
+    :return: the differences
+    :rtype: InventoryDiff
+    """
+    if hashes is None:
+        hashes = RecordHashes()
+    scope = set(serial_numbers) if serial_numbers is not None else None
+    diff = InventoryDiff(old, new)
+    for key, record in new.items():
+        serial_number = _serial_number(key, record)
+        if scope is not None and serial_number not in scope:
+            continue
+        old_record = old.get(key)
+        if old_record is None:
+            diff.added.add(key)
+        elif old_record is not record and hashes.digest(old_record) != hashes.digest(record):
+            diff.modified.add(key)
+        else:
+            diff.unchanged += 1
+            continue
+        if serial_number is not None:
+            diff.serial_numbers.add(serial_number)
+    for key, record in old.items():
+        if key not in new:
+            serial_number = _serial_number(key, record)
+            if scope is None or serial_number in scope:
+                diff.removed.add(key)
+                if serial_number is not None:
+                    diff.serial_numbers.add(serial_number)
+    logger.debug("diff_inventories: {!r}".format(diff))
+    return diff
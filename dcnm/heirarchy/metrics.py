@@ -0,0 +1,288 @@
+import logging
+import math
+import re
+import threading
+from collections import defaultdict
+from time import perf_counter
+from typing import Optional, Dict, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+# serial numbers, or comma separated lists of them, used as a path segment
+SERIAL_SEGMENT = re.compile(r'(?=[A-Z0-9,]*\d)(?=[A-Z0-9,]*[A-Z])[A-Z0-9]{9,14}(,[A-Z0-9]{9,14})*')
+# path segments that follow these segments are names or ids rather than part of the endpoint
+NAMED_SEGMENTS = {'fabrics': '{fabric}', 'switches': '{serial}'}
+# segments that are part of the endpoint even when they follow one of the NAMED_SEGMENTS
+FIXED_SEGMENTS = {'msd', 'roles'}
+
+
+def path_template(path: str) -> str:
+    """
+    :param path: request path, e.g. /control/switches/FDO21120U5D/fabric-name
+    :type path: str
+    :return: the path with the query string dropped and serial numbers and fabric names replaced by
+    placeholders, e.g. /control/switches/{serial}/fabric-name
+    :rtype: str
+    """
+    segments = path.split('?', 1)[0].split('/')
+    for i in range(1, len(segments)):
+        segment = segments[i]
+        if not segment or segment in FIXED_SEGMENTS:
+            continue
+        if segments[i - 1] in NAMED_SEGMENTS:
+            segments[i] = NAMED_SEGMENTS[segments[i - 1]]
+        elif SERIAL_SEGMENT.fullmatch(segment):
+            segments[i] = '{serial}'
+    return '/'.join(segments)
+
+
+class RequestMetrics:
+    """
+    Measurements for a single http request sent by send_request. Filled in as the request progresses and
+    handed to the request_start and request_end hooks.
+    """
+    __slots__ = ('method', 'path', 'template', 'start', 'elapsed', 'status', 'retries', 'bytes_out',
+                 'bytes_in', 'decode_time')
+
+    def __init__(self, method: str, path: str):
+        self.method = method
+        self.path = path
+        self.template = path_template(path)
+        self.start = perf_counter()
+        self.elapsed: Optional[float] = None
+        self.status: Optional[int] = None
+        self.retries = 0
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.decode_time = 0.0
+
+    def response(self, response):
+        """ record what can be learned from a requests.Response """
+        self.status = response.status_code
+        raw_retries = getattr(getattr(response, 'raw', None), 'retries', None)
+        if raw_retries is not None:
+            self.retries = len(raw_retries.history)
+        request = getattr(response, 'request', None)
+        body = getattr(request, 'body', None)
+        if body:
+            self.bytes_out = len(body)
+        content = getattr(response, 'content', None)
+        if content:
+            self.bytes_in = len(content)
+
+    def finish(self):
+        self.elapsed = perf_counter() - self.start
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.method!r}, {self.template!r}, status={self.status!r}, ' \
+               f'elapsed={self.elapsed!r}, retries={self.retries!r})'
+
+
+class RequestHooks:
+    """
+    Base class for request instrumentation. Subclass and override the events of interest, then pass an
+    instance in the hooks argument of the REST client or add it with add_hook. The plugin events are sent by
+    the PlugInEngine the hook is added to with PlugInEngine.add_hook.
+    """
+
+    def request_start(self, metrics: RequestMetrics):
+        pass
+
+    def request_end(self, metrics: RequestMetrics):
+        pass
+
+    def relogon(self, device: str, proactive: bool):
+        pass
+
+    def plugin_initialize(self, plugin: str, elapsed: float, errors: int):
+        pass
+
+    def plugin_call(self, plugin: str, elapsed: float, evaluated: int, changed: int, errors: int):
+        """ elapsed, evaluated, changed and errors are totals of one or more calls of the plugin """
+        pass
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """ nearest rank percentile of values, which must be sorted """
+    if not values:
+        return 0.0
+    rank = max(1, int(math.ceil(pct / 100 * len(values))))
+    return values[rank - 1]
+
+
+class MetricsAggregator(RequestHooks):
+    """
+    In memory collection of request metrics grouped by method and path template, and of the plugin metrics
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies: Dict[Tuple[str, str], List[float]] = defaultdict(list)
+        self.statuses: Dict[Tuple[str, str], Dict[Optional[int], int]] = defaultdict(lambda: defaultdict(int))
+        self.retries: Dict[Tuple[str, str], int] = defaultdict(int)
+        self.bytes_out: Dict[Tuple[str, str], int] = defaultdict(int)
+        self.bytes_in: Dict[Tuple[str, str], int] = defaultdict(int)
+        self.decode_time: Dict[Tuple[str, str], float] = defaultdict(float)
+        self.relogons = 0
+        self.proactive_relogons = 0
+        self.plugins = PluginMetrics()
+
+    def request_end(self, metrics: RequestMetrics):
+        endpoint = (metrics.method.upper(), metrics.template)
+        with self._lock:
+            self.latencies[endpoint].append(metrics.elapsed)
+            self.statuses[endpoint][metrics.status] += 1
+            self.retries[endpoint] += metrics.retries
+            self.bytes_out[endpoint] += metrics.bytes_out
+            self.bytes_in[endpoint] += metrics.bytes_in
+            self.decode_time[endpoint] += metrics.decode_time
+
+    def relogon(self, device: str, proactive: bool):
+        with self._lock:
+            if proactive:
+                self.proactive_relogons += 1
+            else:
+                self.relogons += 1
+
+    def plugin_initialize(self, plugin: str, elapsed: float, errors: int):
+        self.plugins.initialized(plugin, elapsed, errors)
+
+    def plugin_call(self, plugin: str, elapsed: float, evaluated: int, changed: int, errors: int):
+        self.plugins.called(plugin, elapsed, evaluated, changed, errors)
+
+    def plugin_summary(self) -> List[dict]:
+        """ :return: PluginMetrics.summary of the plugin events """
+        return self.plugins.summary()
+
+    def summary(self) -> List[dict]:
+        """
+        :return: one dictionary per endpoint with request count, latency percentiles in seconds, retries,
+        bytes and json decode time
+        :rtype: list
+        """
+        result = []
+        with self._lock:
+            for endpoint in sorted(self.latencies):
+                latencies = sorted(self.latencies[endpoint])
+                result.append({'method': endpoint[0], 'path': endpoint[1], 'count': len(latencies),
+                               'p50': percentile(latencies, 50), 'p95': percentile(latencies, 95),
+                               'p99': percentile(latencies, 99), 'total': sum(latencies),
+                               'statuses': dict(self.statuses[endpoint]), 'retries': self.retries[endpoint],
+                               'bytes_out': self.bytes_out[endpoint], 'bytes_in': self.bytes_in[endpoint],
+                               'decode_time': self.decode_time[endpoint]})
+        return result
+
+    def report(self) -> str:
+        lines = ["{:<7} {:<50} {:>6} {:>8} {:>8} {:>8} {:>7} {:>10} {:>8}".format(
+            'METHOD', 'ENDPOINT', 'COUNT', 'P50 ms', 'P95 ms', 'P99 ms', 'RETRY', 'BYTES IN', 'JSON ms')]
+        for row in self.summary():
+            lines.append("{:<7} {:<50} {:>6} {:>8.1f} {:>8.1f} {:>8.1f} {:>7} {:>10} {:>8.1f}".format(
+                row['method'], row['path'], row['count'], row['p50'] * 1000, row['p95'] * 1000, row['p99'] * 1000,
+                row['retries'], row['bytes_in'], row['decode_time'] * 1000))
+        lines.append("re-logons: {}, proactive token refreshes: {}".format(self.relogons, self.proactive_relogons))
+        return '\n'.join(lines)
+
+    def print_report(self):
+        print('=' * 40)
+        print("DCNM REQUEST LATENCY")
+        print('=' * 40)
+        print(self.report())
+        if self.plugins:
+            self.plugins.print_report()
+
+
+class PluginMetrics:
+    """
+    Time spent in each plugin, how many interfaces it looked at and changed, and the exceptions it raised,
+    collected by the PlugInEngine. Worker processes collect their own and the engine merges them. Each
+    recorded or merged measurement is also sent to the plugin events of the hooks.
+
+    :param hooks: RequestHooks instances, e.g. the MetricsAggregator of the REST client
+    :type hooks: list or None
+    """
+
+    def __init__(self, hooks: Optional[List[RequestHooks]] = None):
+        self._lock = threading.Lock()
+        self.hooks: List[RequestHooks] = list(hooks) if hooks else []
+        self.initialize_time: Dict[str, float] = defaultdict(float)
+        self.call_time: Dict[str, float] = defaultdict(float)
+        self.evaluated: Dict[str, int] = defaultdict(int)
+        self.changed: Dict[str, int] = defaultdict(int)
+        self.errors: Dict[str, int] = defaultdict(int)
+
+    def _call_hooks(self, event: str, *args):
+        # instrumentation must never break a plugin run
+        for hook in self.hooks:
+            try:
+                getattr(hook, event)(*args)
+            except Exception:
+                logger.exception("plugin hook {} failed on {}".format(hook, event))
+
+    def initialized(self, plugin: str, elapsed: float, error: int = 0):
+        with self._lock:
+            self.initialize_time[plugin] += elapsed
+            self.errors[plugin] += error
+        self._call_hooks('plugin_initialize', plugin, elapsed, int(error))
+
+    def called(self, plugin: str, elapsed: float, evaluated: int, changed: int, error: int = 0):
+        with self._lock:
+            self.call_time[plugin] += elapsed
+            self.evaluated[plugin] += evaluated
+            self.changed[plugin] += changed
+            self.errors[plugin] += error
+        self._call_hooks('plugin_call', plugin, elapsed, evaluated, changed, int(error))
+
+    def merge(self, other: 'PluginMetrics'):
+        """ add the measurements of other, e.g. of a worker process, errors are added to the calls """
+        for plugin in sorted(other.initialize_time):
+            self.initialized(plugin, other.initialize_time[plugin])
+        for plugin in sorted(set(other.call_time) | set(other.errors)):
+            self.called(plugin, other.call_time.get(plugin, 0.0), other.evaluated.get(plugin, 0),
+                        other.changed.get(plugin, 0), other.errors.get(plugin, 0))
+
+    def __bool__(self) -> bool:
+        return bool(self.initialize_time or self.call_time or self.errors)
+
+    def __getstate__(self):
+        # the hooks stay in the process that owns them
+        state = self.__dict__.copy()
+        del state['_lock']
+        state['hooks'] = []
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def summary(self) -> List[dict]:
+        """
+        :return: one dictionary per plugin with initialize and call time in seconds, interfaces evaluated and
+        changed, hit rate and exceptions
+        :rtype: list
+        """
+        result = []
+        with self._lock:
+            plugins = set(self.initialize_time) | set(self.call_time) | set(self.errors)
+            for plugin in sorted(plugins):
+                evaluated = self.evaluated[plugin]
+                result.append({'plugin': plugin, 'initialize': self.initialize_time[plugin],
+                               'call': self.call_time[plugin], 'evaluated': evaluated,
+                               'changed': self.changed[plugin],
+                               'hit_rate': self.changed[plugin] / evaluated if evaluated else 0.0,
+                               'errors': self.errors[plugin]})
+        return result
+
+    def report(self) -> str:
+        lines = ["{:<30} {:>10} {:>10} {:>10} {:>9} {:>7} {:>7}".format(
+            'PLUGIN', 'INIT ms', 'CALL ms', 'EVALUATED', 'CHANGED', 'HIT %', 'ERRORS')]
+        for row in self.summary():
+            lines.append("{:<30} {:>10.1f} {:>10.1f} {:>10} {:>9} {:>7.1f} {:>7}".format(
+                row['plugin'], row['initialize'] * 1000, row['call'] * 1000, row['evaluated'], row['changed'],
+                row['hit_rate'] * 100, row['errors']))
+        return '\n'.join(lines)
+
+    def print_report(self):
+        print('=' * 40)
+        print("PLUGINS")
+        print('=' * 40)
+        print(self.report())
@@ -0,0 +1,67 @@
+"""
+Saved inventories for offline runs
+
+An inventory is a directory holding the exports (see export.py) of everything the plugins read from DCNM: the
+interface nvpairs, the switches with their details and the switch policies. save_inventory writes one during a
+normal run, load_inventory populates the handler's components from one so that get_interfaces_to_change and the
+plugins can run without a controller, using a DcnmRestApi created with offline=True.
+"""
+import logging
+import os
+from typing import Optional, Iterable
+
+from DCNM_errors import DCNMFileError
+from export import save_records, INTERFACES, POLICIES, SWITCHES
+from handler import Handler
+
+logger = logging.getLogger(__name__)
+
+INTERFACES_FILE = "interfaces_nvpairs.json"
+SWITCHES_FILE = "switches.json"
+POLICIES_FILE = "switches_policies.json"
+
+def save_inventory(handler: Handler, directory: str):
+    """
+    :param handler: handler whose interfaces nvpairs and switches have been collected
+    :type handler: Handler
+    :param directory: directory to write the inventory to, created if needed
+    :type directory: str
+
+    Switch details and policies are requested from DCNM first if they have not been collected yet.
+    """
+    os.makedirs(directory, exist_ok=True)
+    if not handler.all_switches_details:
+        handler.get_switches_details()
+    if not handler.all_switches_policies:
+        handler.get_switches_policies()
+    save_records(handler.all_interfaces_nvpairs, os.path.join(directory, INTERFACES_FILE), INTERFACES)
+    save_records({sn: switch.details() for sn, switch in handler.switches.items()},
+                 os.path.join(directory, SWITCHES_FILE), SWITCHES)
+    save_records({sn: switch.policies for sn, switch in handler.switches.items() if switch.policies},
+                 os.path.join(directory, POLICIES_FILE), POLICIES)
+    logger.info("save_inventory: saved {} interfaces of {} switches to {}".format(
+        len(handler.all_interfaces_nvpairs), len(handler.switches), directory))
+
+
+def load_inventory(handler: Handler, directory: str, serial_numbers: Optional[Iterable[str]] = None):
+    """
+    :param handler: handler to populate
+    :type handler: Handler
+    :param directory: directory written by save_inventory
+    :type directory: str
+    :param serial_numbers: only load these switches, all switches in the inventory if None
+    :type serial_numbers: iterable or None
+
+    The switches are loaded first so that the leaf and non leaf switch lists are built from the inventory.
+    """
+    if not os.path.isdir(directory):
+        logger.critical("Error: inventory directory {} not found".format(directory))
+        raise DCNMFileError("Error: inventory directory {} not found".format(directory))
+    if serial_numbers is not None:
+        serial_numbers = list(serial_numbers)
+    handler.load_switches_details(os.path.join(directory, SWITCHES_FILE), serial_numbers=serial_numbers)
+    if os.path.isfile(os.path.join(directory, POLICIES_FILE)):
+        handler.load_switches_policies(os.path.join(directory, POLICIES_FILE), serial_numbers=serial_numbers)
+    handler.load_interfaces_nvpairs(os.path.join(directory, INTERFACES_FILE), serial_numbers=serial_numbers)
+    logger.info("load_inventory: loaded {} interfaces of {} switches from {}".format(
+        len(handler.all_interfaces_nvpairs), len(handler.switches), directory))
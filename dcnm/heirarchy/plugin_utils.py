@@ -1,14 +1,22 @@
 import argparse
 import functools
 import importlib
+import importlib.util
 import inspect
 import logging
+import multiprocessing
+import re
 import sys
 import traceback
 from abc import ABC, abstractmethod
-from typing import Dict, List, Optional, Any, Set
+from collections import defaultdict
+from time import perf_counter
+from typing import Dict, List, Optional, Any, Set, Tuple, Iterable, FrozenSet
 
+from DCNM_utils import LogPreview
+from discovery import DiscoveryCache
 from handler import Handler
+from metrics import PluginMetrics, RequestHooks
 
 logger = logging.getLogger(__name__)
 
@@ -32,7 +40,26 @@ class RegisterPlugin:
 class PlugIn(ABC):
     """
     Plugin Abstract Base Class
+
+    A plugin that only reads the state set up by initialize when it is called, and whose state can be pickled
+    once the handler is dropped, can set parallel_safe to True to be run in the worker processes of the engine.
+    Other plugins always run in the main process.
+
+    reads and writes name the interface fields the plugin uses, nvPairs names or 'policy'. after names the
+    plugins that must run before this one when both are selected. The engine orders the plugins from these and
+    refuses to run two plugins that use the same field unless one is declared after the other. A plugin that
+    does not declare writes runs alone, after the plugins that do.
+
+    policy_pattern and interface_prefixes are prefilters: the plugin is only given the interfaces whose policy
+    matches the regular expression (re.search) and whose name starts with one of the prefixes (compared in lower
+    case). Interfaces that fail them are treated as unchanged without calling the plugin.
     """
+    parallel_safe: bool = False
+    reads: FrozenSet[str] = frozenset()
+    writes: Optional[FrozenSet[str]] = None
+    after: Tuple[str, ...] = ()
+    policy_pattern: Optional[str] = None
+    interface_prefixes: Optional[Tuple[str, ...]] = None
 
     def __init__(self):
         print(f"initialize {self.__class__.__name__}")
@@ -40,6 +67,40 @@ class PlugIn(ABC):
         self.args = None
         self.serials = None
         self.leaf_only: bool = False
+        # policy -> whether it matches policy_pattern, each distinct policy is only matched once
+        self._policy_matches: Dict[str, bool] = {}
+
+    @property
+    def prefiltered(self) -> bool:
+        return self.policy_pattern is not None or self.interface_prefixes is not None
+
+    def _matches_policy(self, policy: str) -> bool:
+        matches = self._policy_matches.get(policy)
+        if matches is None:
+            matches = self._policy_matches[policy] = re.search(self.policy_pattern, policy) is not None
+        return matches
+
+    def is_candidate(self, interface: tuple, detail: dict) -> bool:
+        """ :return: False if the prefilters rule the interface out """
+        return (self.policy_pattern is None or self._matches_policy(detail['policy'])) and \
+               (self.interface_prefixes is None or interface[0].lower().startswith(self.interface_prefixes))
+
+    def candidates(self, batch: Dict[tuple, dict], by_policy: Dict[str, List[tuple]]) -> Dict[tuple, dict]:
+        """
+        :param batch: interfaces of a switch
+        :type batch: dict
+        :param by_policy: the keys of the batch grouped by policy
+        :type by_policy: dict
+        :return: the interfaces of the batch that pass the prefilters
+        :rtype: dict
+        """
+        keys: Iterable[tuple] = batch
+        if self.policy_pattern is not None:
+            keys = [key for policy, policy_keys in by_policy.items() if self._matches_policy(policy)
+                    for key in policy_keys]
+        if self.interface_prefixes is not None:
+            keys = [key for key in keys if key[0].lower().startswith(self.interface_prefixes)]
+        return {key: batch[key] for key in keys}
 
     @abstractmethod
     def initialize(self, handler: Handler, args: argparse.Namespace,
@@ -60,11 +121,121 @@ class PlugIn(ABC):
         """
         pass
 
+    def call_batch(self, serial_number: str, batch: Dict[tuple, dict]) -> Dict[tuple, dict]:
+        """
+        :param serial_number: serial number of the switch
+        :type serial_number: str
+        :param batch: the interfaces of the switch, keyed by (interface name, serial number)
+        :type batch: dict
+        :return: the nvPairs to change, keyed by the interfaces to change
+        :rtype: dict
+
+        The engine hands each plugin all the interfaces of a switch at once. The default calls the plugin for
+        each interface. Override it to work on the whole batch, returning only the nvPairs that change, which the
+        engine merges into the interface details.
+        """
+        changes: Dict[tuple, dict] = {}
+        for interface, detail in batch.items():
+            nvpairs = detail['interfaces'][0]['nvPairs']
+            before = nvpairs.copy()
+            if self(interface, detail):
+                # only the fields the call changed, so the engine knows what to verify
+                changes[interface] = {key: value for key, value in nvpairs.items()
+                                      if key not in before or before[key] != value}
+        return changes
+
+    def __getstate__(self):
+        # the handler holds the DCNM session, workers must not use it
+        state = self.__dict__.copy()
+        state['handler'] = None
+        return state
+
 
 class PlugInInitializationError(Exception):
     pass
 
 
+class PlugInConflictError(Exception):
+    """Raise when selected plugins use the same fields without a declared order, or their order has a cycle."""
+
+
+# plugins of a worker process, set once per worker by _init_worker
+_worker_plugins: List[Tuple[str, PlugIn]] = []
+
+
+def _run_plugins(plugins: Iterable[Tuple[str, PlugIn]], interface: tuple, details: dict, leaf: bool,
+                 metrics: PluginMetrics) -> bool:
+    change = False
+    for name, plugin in plugins:
+        # if the function is to run only on leaf switches and this is a leaf switch
+        # or the function can run on any switch
+        if (not plugin.leaf_only or leaf) and plugin.is_candidate(interface, details):
+            logger.debug("run_selected_plugins: sending %s to plugin %s", interface, name)
+            logger.debug("detail: %s", LogPreview(details))
+            start = perf_counter()
+            try:
+                plugin_change = plugin(interface, details)
+            except Exception:
+                metrics.called(name, perf_counter() - start, 1, 0, error=True)
+                raise
+            metrics.called(name, perf_counter() - start, 1, int(bool(plugin_change)))
+            change = plugin_change or change
+    return change
+
+
+def _run_batch(plugins: Iterable[Tuple[str, PlugIn]], serial_number: str, batch: Dict[tuple, dict],
+               leaf: bool, metrics: PluginMetrics) -> Dict[tuple, Dict[str, str]]:
+    """ :return: the interfaces of the batch at least one plugin changed, with {nvPairs key: plugin name} """
+    changed: Dict[tuple, Dict[str, str]] = {}
+    by_policy: Optional[Dict[str, List[tuple]]] = None
+    for name, plugin in plugins:
+        if plugin.leaf_only and not leaf:
+            continue
+        candidates = batch
+        if plugin.prefiltered:
+            if by_policy is None:
+                by_policy = defaultdict(list)
+                for interface, details in batch.items():
+                    by_policy[details['policy']].append(interface)
+            candidates = plugin.candidates(batch, by_policy)
+            if not candidates:
+                continue
+        logger.debug("run_selected_plugins: sending %s interfaces of %s to plugin %s", len(candidates),
+                     serial_number, name)
+        start = perf_counter()
+        try:
+            changes = plugin.call_batch(serial_number, candidates)
+        except Exception:
+            metrics.called(name, perf_counter() - start, len(candidates), 0, error=True)
+            raise
+        metrics.called(name, perf_counter() - start, len(candidates), len(changes))
+        for interface, nvpairs in changes.items():
+            current = batch[interface]['interfaces'][0]['nvPairs']
+            if nvpairs is not current:
+                current.update(nvpairs)
+            fields = changed.setdefault(interface, {})
+            for key in nvpairs:
+                fields[key] = name
+    return changed
+
+
+def _init_worker(plugins: List[Tuple[str, PlugIn]]):
+    global _worker_plugins
+    _worker_plugins = plugins
+
+
+def _run_shard(shard: List[Tuple[str, Dict[tuple, dict], bool]]) -> Tuple[List[Tuple[tuple, dict, Dict[str, str]]],
+                                                                     PluginMetrics]:
+    """
+    :return: the changed interfaces of the shard with their changed details and changed fields, and the plugin
+    metrics
+    """
+    metrics = PluginMetrics()
+    changed = [(interface, batch[interface], fields) for serial_number, batch, leaf in shard
+               for interface, fields in _run_batch(_worker_plugins, serial_number, batch, leaf, metrics).items()]
+    return changed, metrics
+
+
 def singleton(cls):
     """Make a class a SingletonMeta class (only one instance)"""
 
@@ -81,39 +252,142 @@ def singleton(cls):
 @singleton
 class PlugInEngine:
     # We are going to receive a list of plugins as parameter
-    def __init__(self, plugin_module: str = "plugins"):
-        self.plugin_module = importlib.import_module(plugin_module, ".")
+    def __init__(self, plugin_module: str = "plugins", discovery_cache: Optional[DiscoveryCache] = None):
+        self.plugin_module_name = plugin_module
+        self._plugin_module = None
+        self.discovery_cache = discovery_cache if discovery_cache is not None else DiscoveryCache()
         # self._check_loaded_plugin_state(self.plugin_module)
-        self.plugins: Dict = {}
-        self._initialize_plugins()
+        # plugin name -> class name, plugins are only instantiated once selected
+        self.plugin_classes: Dict[str, str] = self._discover_plugins()
+        self.plugins: Dict[str, PlugIn] = {}
         self._selected_plugins: Set = set()
+        # stages of the selected plugins, the plugins of a stage do not depend on each other
+        self._plan: List[List[str]] = []
+        self.metrics = PluginMetrics()
+        # (interface name, serial number) -> {nvPairs key: name of the plugin that last changed it}
+        self.changed_fields: Dict[tuple, Dict[str, str]] = {}
+
+    def add_hook(self, hook: RequestHooks):
+        """ send the plugin initialize and call measurements to hook, e.g. the MetricsAggregator of the REST client """
+        self.metrics.hooks.append(hook)
+
+    @property
+    def plugin_module(self):
+        if self._plugin_module is None:
+            self._plugin_module = importlib.import_module(self.plugin_module_name, ".")
+        return self._plugin_module
+
+    @property
+    def plugin_names(self) -> List[str]:
+        return list(self.plugin_classes)
 
-    def _initialize_plugins(self):
-        for name, obj in inspect.getmembers(self.plugin_module):
-            if inspect.isclass(obj):
-                for base in obj.__bases__:
-                    if 'PlugIn' in str(base):
-                        print(obj)
-                        if hasattr(obj, "alt_name"):
-                            app_name = obj.alt_name
-                        else:
-                            app_name = obj.__name__
-                        self.plugins[app_name] = obj()
-                        break
+    def _discover_plugins(self) -> Dict[str, str]:
+        """
+        :return: plugin name -> class name, read from the discovery cache when the plugin module is unchanged, so
+        listing the plugins (e.g. for --help) does not import the plugin module
+        """
+        spec = importlib.util.find_spec(self.plugin_module_name)
+        source_files = [spec.origin, __file__] if spec is not None and spec.origin else []
+        cache_key = 'plugins:' + (spec.origin if source_files else self.plugin_module_name)
+        plugin_classes = self.discovery_cache.get(cache_key, source_files) if source_files else None
+        if plugin_classes is None:
+            plugin_classes = {}
+            for name, obj in inspect.getmembers(self.plugin_module):
+                if inspect.isclass(obj):
+                    for base in obj.__bases__:
+                        if 'PlugIn' in str(base):
+                            print(obj)
+                            if hasattr(obj, "alt_name"):
+                                app_name = obj.alt_name
+                            else:
+                                app_name = obj.__name__
+                            plugin_classes[app_name] = obj.__name__
+                            break
+            if source_files:
+                self.discovery_cache.put(cache_key, source_files, plugin_classes)
+        return plugin_classes
 
     def set_plugins(self, plugins: List):
-        self._selected_plugins = {plugin for plugin in plugins if plugin in self.plugins.keys()}
-        print(self._selected_plugins)
+        self._selected_plugins = {plugin for plugin in plugins if plugin in self.plugin_classes}
+        for plugin in self._selected_plugins:
+            if plugin not in self.plugins:
+                self.plugins[plugin] = getattr(self.plugin_module, self.plugin_classes[plugin])()
+        self._plan = self._build_plan()
+        print(self.selected_plugins)
+
+    @property
+    def selected_plugins(self) -> List[str]:
+        """ the selected plugins in the order they run """
+        return [plugin for stage in self._plan for plugin in stage]
 
     @property
-    def selected_plugins(self):
-        return self._selected_plugins
+    def plan(self) -> List[List[str]]:
+        return self._plan
+
+    @staticmethod
+    def _conflict(first: PlugIn, second: PlugIn) -> Set[str]:
+        """ :return: the fields one plugin writes and the other uses """
+        return (first.writes & (second.writes | second.reads)) | (second.writes & first.reads)
+
+    def _build_plan(self) -> List[List[str]]:
+        """
+        :return: stages of the selected plugins, each stage sorted by name
+
+        A plugin is placed in the stage after the last of the plugins it runs after. Plugins that do not declare
+        what they write run after all the others, one per stage in name order.
+        """
+        names = sorted(self._selected_plugins)
+        declared = [name for name in names if self.plugins[name].writes is not None]
+        undeclared = [name for name in names if self.plugins[name].writes is None]
+        before: Dict[str, Set[str]] = {name: {other for other in self.plugins[name].after
+                                              if other in self._selected_plugins} for name in names}
+        for i, name in enumerate(undeclared):
+            logger.warning("plugin {} does not declare the fields it writes, it runs on its own".format(name))
+            before[name] |= set(declared) | set(undeclared[:i])
+
+        stage_of: Dict[str, int] = {}
+        visiting: Set[str] = set()
+
+        def stage(name: str) -> int:
+            if name not in stage_of:
+                if name in visiting:
+                    raise PlugInConflictError("plugin order has a cycle through {}".format(name))
+                visiting.add(name)
+                stage_of[name] = 1 + max((stage(other) for other in before[name]), default=-1)
+                visiting.discard(name)
+            return stage_of[name]
+
+        for name in names:
+            stage(name)
+
+        def runs_before(first: str, second: str) -> bool:
+            return first in before[second] or any(runs_before(first, other) for other in before[second])
+
+        for i, first in enumerate(declared):
+            for second in declared[i + 1:]:
+                fields = self._conflict(self.plugins[first], self.plugins[second])
+                if fields and not (runs_before(first, second) or runs_before(second, first)):
+                    raise PlugInConflictError(
+                        "plugins {} and {} both use {} and their order is not declared, set after on one of "
+                        "them".format(first, second, sorted(fields)))
+
+        plan: List[List[str]] = [[] for _ in range(1 + max(stage_of.values(), default=-1))]
+        for name in names:
+            plan[stage_of[name]].append(name)
+        logger.debug("plugin plan: {}".format(plan))
+        return plan
 
     def initialize_selected_plugins(self, handler: Handler, args: argparse.Namespace, serials: Optional[list] = None):
         try:
             for plugin in self.selected_plugins:
                 logger.debug("initialize_selected_plugins: intializing {}".format(plugin))
-                self.plugins[plugin].initialize(handler, args, serials)
+                start = perf_counter()
+                try:
+                    self.plugins[plugin].initialize(handler, args, serials)
+                except:
+                    self.metrics.initialized(plugin, perf_counter() - start, error=True)
+                    raise
+                self.metrics.initialized(plugin, perf_counter() - start)
         except:
             exc_type, exc_value, exc_traceback = sys.exc_info()
             stacktrace = traceback.extract_tb(exc_traceback)
@@ -123,23 +397,80 @@ class PlugInEngine:
             raise PlugInInitializationError("Error Initializing Plugin {}".format(plugin))
 
     def run_selected_plugins(self, interface: tuple, details: dict, leaf: bool):
-       change = False
-       for plugin in self.selected_plugins:
-           # if the function is to run only on leaf switches and this is a leaf switch
-           # or the function can run on any switch
-           if (self.plugins[plugin].leaf_only and leaf) or not self.plugins[plugin].leaf_only:
-               logger.debug("run_selected_plugins: sending {} to plugin {}".format(interface, plugin))
-               logger.debug("detail: {}".format(details))
-               logger.debug("{}".format(self.plugins[plugin]))
-               change = self.plugins[plugin](interface, details) or change
-           else:
-               change = change or False
-       return change
+        return _run_plugins(((plugin, self.plugins[plugin]) for plugin in self.selected_plugins),
+                            interface, details, leaf, self.metrics)
+
+    def run_selected_plugins_on(self, interfaces: Dict[tuple, dict], leaf_switches: Iterable[str],
+                                workers: int = 1) -> Set[tuple]:
+        """
+        :param interfaces: interface details keyed by (interface name, serial number), changed in place
+        :type interfaces: dict
+        :param leaf_switches: serial numbers of the leaf switches
+        :type leaf_switches: set or frozenset
+        :param workers: number of worker processes, 1 runs every plugin in this process
+        :type workers: int
+        :return: the interfaces at least one plugin changed
+        :rtype: set
+
+        The plugins run in plan order and get the interfaces one switch at a time through PlugIn.call_batch. With
+        more than one worker, consecutive parallel safe plugins run in a process pool over shards of the switches.
+        Each worker receives the initialized plugins once, when it starts, and sends back only the interfaces it
+        changed. The other plugins run here. The nvPairs keys each plugin changed are kept in changed_fields, for
+        verify_interface_change.
+        """
+        batches: Dict[str, Dict[tuple, dict]] = defaultdict(dict)
+        for interface, details in interfaces.items():
+            batches[interface[1]][interface] = details
+        self.changed_fields = {}
+        # consecutive plugins that run the same way share one pass over the switches
+        passes: List[Tuple[bool, List[Tuple[str, PlugIn]]]] = []
+        for name in self.selected_plugins:
+            plugin = self.plugins[name]
+            parallel = workers > 1 and plugin.parallel_safe
+            if passes and passes[-1][0] == parallel:
+                passes[-1][1].append((name, plugin))
+            else:
+                passes.append((parallel, [(name, plugin)]))
+        for parallel, pass_plugins in passes:
+            if parallel:
+                self._run_pass_parallel(pass_plugins, interfaces, batches, leaf_switches, workers)
+            else:
+                logger.debug("run_selected_plugins_on: running {} in this process".format(
+                    [name for name, _ in pass_plugins]))
+                for serial_number, batch in batches.items():
+                    for interface, fields in _run_batch(pass_plugins, serial_number, batch,
+                                                        serial_number in leaf_switches, self.metrics).items():
+                        self._record_fields(interface, fields)
+        return set(self.changed_fields)
+
+    def _record_fields(self, interface: tuple, fields: Dict[str, str]):
+        recorded = self.changed_fields.get(interface)
+        if recorded is None:
+            self.changed_fields[interface] = fields
+        else:
+            recorded.update(fields)
+
+    def _run_pass_parallel(self, plugins: List[Tuple[str, PlugIn]], interfaces: Dict[tuple, dict],
+                           batches: Dict[str, Dict[tuple, dict]], leaf_switches: Iterable[str],
+                           workers: int):
+        logger.info("run_selected_plugins_on: running {} on {} interfaces with {} workers".format(
+            [name for name, _ in plugins], len(interfaces), workers))
+        items = [(serial_number, batch, serial_number in leaf_switches) for serial_number, batch in batches.items()]
+        # a few shards per worker evens out uneven shards
+        size = max(1, -(-len(items) // (workers * 4)))
+        shards = [items[i:i + size] for i in range(0, len(items), size)]
+        with multiprocessing.Pool(workers, initializer=_init_worker, initargs=(plugins,)) as pool:
+            for result, metrics in pool.imap_unordered(_run_shard, shards):
+                self.metrics.merge(metrics)
+                for interface, details, fields in result:
+                    interfaces[interface] = details
+                    batches[interface[1]][interface] = details
+                    self._record_fields(interface, fields)
 
 
 if __name__ == '__main__':
     app = PlugInEngine()
     print(app.plugin_module)
     # print(print(inspect.getmembers(app.plugin_module)))
-    print(app.plugins)
-    print(list(app.plugins.keys()))
+    print(app.plugin_classes)
+    print(app.plugin_names)
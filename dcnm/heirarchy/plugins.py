@@ -1,65 +1,78 @@
 import argparse
 import logging
-from pickle import dump
-from typing import Optional, Dict
+import os
+from typing import Optional, Dict, FrozenSet
 
-from DCNM_errors import DCNMValueError
 from handler import Handler
-from DCNM_utils import get_info_from_policies_config
-from interfaces_utilities import _dbg, read_existing_descriptions, _get_uplinks, _failed_dbg
+from DCNM_utils import LogPreview
+from freeform import FreeformIndex
+from interfaces_utilities import _dbg, read_existing_descriptions, _get_uplinks, _get_uplinks_by_switch
 from plugin_utils import PlugIn, RegisterPlugin
+from snapshot import dump_policies_snapshot, load_snapshot
 
 logger = logging.getLogger(__name__)
 
 
 @RegisterPlugin(name="desc")
 class GetDescChanges(PlugIn):
+    parallel_safe = True
+    reads = frozenset({'DESC'})
+    writes = frozenset({'DESC'})
+
     def initialize(self, handler: Handler, args: argparse.Namespace,
                    serials: Optional[list] = None) -> None:
         self.handler = handler
         self.leaf_only = False
-        if not args.excel:
+        if not args.excel and getattr(args, 'resume', False) and os.path.isfile(args.pickle):
+            # the interrupted run already deleted the description policies, use the ones it saved
+            freeform = FreeformIndex(load_snapshot(args.pickle, serial_numbers=serials,
+                                                   allow_pickle=getattr(args, 'legacy_pickle', False)))
+            self.existing_descriptions: Dict[tuple, str] = freeform.descriptions()
+            if args.verbose:
+                _dbg("existing descriptions from saved switch policies", self.existing_descriptions)
+        elif not args.excel:
             self.handler.get_switches_policies(templateName=r'switch_freeform\Z',
                                                generatedConfig=r"interface\s+[a-zA-Z]+\d+/?\d*\n\s+[Dd]escription\s+")
-            existing_descriptions_from_policies: list = get_info_from_policies_config(
-                {serial_number: switch.policies for serial_number, switch in self.handler.switches.items()},
-                r"interface\s+([a-zA-Z]+\d+/?\d*)\n\s+[dD]escription\s+(.*)")
+            freeform = FreeformIndex({serial_number: switch.policies
+                                      for serial_number, switch in self.handler.switches.items()})
             if args.verbose:
-                _dbg("existing description from policies", existing_descriptions_from_policies)
-            policy_ids: list = list({c.policyId for c in existing_descriptions_from_policies})
+                _dbg("existing description from policies", freeform)
+            policy_ids: list = sorted(freeform.description_policy_ids)
             if args.verbose:
                 _dbg("deleting policy ids", policy_ids)
+            # save the policies before they are deleted, an offline run must not replace the backout snapshot
+            if not self.handler.dcnm.offline:
+                dump_policies_snapshot({serial_number: switch.policies
+                                        for serial_number, switch in self.handler.switches.items()}, args.pickle)
             # delete the policy
-            self.handler.delete_switch_policies(list(policy_ids))
-            self.existing_descriptions: Dict[tuple, str] = {k: v for c in existing_descriptions_from_policies for k, v
-                                                            in
-                                                            c.info.items()}
+            self.handler.delete_switch_policies(policy_ids)
+            self.existing_descriptions: Dict[tuple, str] = freeform.descriptions()
             if args.verbose:
                 _dbg("existing descriptions from switch policies", self.existing_descriptions)
-            with open(args.pickle, 'wb') as f:
-                dump(self.handler.all_switches_policies, f)
         else:
             self.existing_descriptions = read_existing_descriptions(args.excel)
             if args.verbose:
                 _dbg("existing descriptions from file", self.existing_descriptions)
 
     def __call__(self, interface: tuple, detail: dict) -> bool:
-        logger.debug("start get_desc_change: interface {}".format(interface))
-        logger.debug("detail: {}".format(detail))
+        logger.debug("start get_desc_change: interface %s", interface)
+        logger.debug("detail: %s", LogPreview(detail))
         # if it's not a vpc (e.g. vpc1) interface and the description is not already the desired description
         if interface in self.existing_descriptions and 'vpc' not in interface[0].lower() and \
                 detail['interfaces'][0]['nvPairs']['DESC'] != self.existing_descriptions[interface]:
-            logger.debug("interface: {}, new description: {}, old description: {}".format(interface,
-                                                                                          self.existing_descriptions[
-                                                                                              interface],
-                                                                                          detail['interfaces'][0][
-                                                                                              'nvPairs']['DESC']))
+            logger.debug("interface: %s, new description: %s, old description: %s", interface,
+                         self.existing_descriptions[interface], detail['interfaces'][0]['nvPairs']['DESC'])
             detail['interfaces'][0]['nvPairs']['DESC'] = self.existing_descriptions[interface]
             return True
         return False
 
 
 class GetCdpChange(PlugIn):
+    parallel_safe = True
+    reads = frozenset({'CDP_ENABLE', 'CONF', 'policy'})
+    writes = frozenset({'CDP_ENABLE', 'CONF'})
+    interface_prefixes = ('mgmt', 'ethernet')
+
     def initialize(self, handler: Handler, args: argparse.Namespace,
                    serials: Optional[list] = None) -> None:
         self.args = args
@@ -68,72 +81,83 @@ class GetCdpChange(PlugIn):
         self.mgmt = args.mgmt
         self.leaf_only = False
 
-    def __call__(self, interface: tuple, detail: dict) -> bool:
-        logger.debug("start get_cdp_change: interface {}".format(interface))
-        logger.debug("detail: {}".format(detail))
+    def _cdp_change(self, interface: tuple, detail: dict, leaf: bool) -> Optional[Dict[str, str]]:
+        """ :return: the nvPairs that disable cdp on the interface, None if it does not change """
+        nvpairs = detail['interfaces'][0]['nvPairs']
         # if the mgmt flag is set and it's a mgmt interface and cdp is enabled
-        if self.mgmt and 'mgmt' in interface[0] and detail['interfaces'][0]['nvPairs']['CDP_ENABLE'] == 'true':
-            detail['interfaces'][0]['nvPairs']['CDP_ENABLE'] = 'false'
-            logger.debug("interface: {}, changing cdp".format(interface))
-            logger.debug("CDP_ENABLE: {}".format(detail['interfaces'][0]['nvPairs']['CDP_ENABLE']))
-            return True
+        if self.mgmt and 'mgmt' in interface[0] and nvpairs['CDP_ENABLE'] == 'true':
+            return {'CDP_ENABLE': 'false'}
         # if it's a leaf switch and ethernet interface and not a fabric interface and cdp is enabled
-        elif interface[1] in self.all_leaf_switches and 'ethernet' in interface[0].lower() \
-                and 'fabric' not in detail['policy'] \
-                and 'no cdp enable' not in detail['interfaces'][0]['nvPairs']['CONF']:
-            if not detail['interfaces'][0]['nvPairs']['CONF']:
-                detail['interfaces'][0]['nvPairs']['CONF'] = 'no cdp enable'
-                logger.debug("interface: {}, changing cdp".format(interface))
-                logger.debug("CONF: {}".format(detail['interfaces'][0]['nvPairs']['CONF']))
-                return True
-            else:
-                # print(interface, detail)
-                detail['interfaces'][0]['nvPairs']['CONF'] = '{}\n{}'.format(
-                    detail['interfaces'][0]['nvPairs']['CONF'],
-                    'no cdp enable')
-                logger.debug("interface: {}, changing cdp".format(interface))
-                logger.debug("multiple CONF: {}".format(detail['interfaces'][0]['nvPairs']['CONF']))
-                return True
-        return False
+        if leaf and 'ethernet' in interface[0].lower() and 'fabric' not in detail['policy'] \
+                and 'no cdp enable' not in nvpairs['CONF']:
+            return {'CONF': '{}\n{}'.format(nvpairs['CONF'], 'no cdp enable') if nvpairs['CONF'] else 'no cdp enable'}
+        return None
+
+    def __call__(self, interface: tuple, detail: dict) -> bool:
+        logger.debug("start get_cdp_change: interface %s", interface)
+        logger.debug("detail: %s", LogPreview(detail))
+        change = self._cdp_change(interface, detail, interface[1] in self.all_leaf_switches)
+        if change is None:
+            return False
+        detail['interfaces'][0]['nvPairs'].update(change)
+        logger.debug("interface: %s, changing cdp: %s", interface, LogPreview(change))
+        return True
+
+    def call_batch(self, serial_number: str, batch: Dict[tuple, dict]) -> Dict[tuple, dict]:
+        # same rules as __call__, without the per interface call and logging
+        leaf = serial_number in self.all_leaf_switches
+        changes: Dict[tuple, dict] = {}
+        for interface, detail in batch.items():
+            change = self._cdp_change(interface, detail, leaf)
+            if change is not None:
+                changes[interface] = change
+        logger.debug("get_cdp_change: %s: %s of %s interfaces change", serial_number, len(changes), len(batch))
+        return changes
 
 
 class GetOrphanportChange(PlugIn):
+    parallel_safe = True
+    reads = frozenset({'CONF', 'policy'})
+    writes = frozenset({'CONF'})
+    # both append to CONF, no cdp enable comes first
+    after = ('GetCdpChange',)
+    policy_pattern = r'int_trunk_host|int_access_host'
+
     def initialize(self, handler: Handler, args: argparse.Namespace,
                    serials: Optional[list] = None) -> None:
         if not handler.all_switches_details:
             handler.get_switches_details(serial_numbers=serials)
-        self.local_switches_details = handler.all_switches_details
-        self.local_uplinks: Dict = _get_uplinks(args.uplinks)
+        # the switch objects carry the details, all_switches_details only records that they were collected
+        local_uplinks: Dict = _get_uplinks(args.uplinks)
+        logger.debug("get_orphanport_change: local_uplinks: %s", LogPreview(local_uplinks))
+        # the plugin only runs on leaf switches
+        self.uplinks: Dict[str, FrozenSet[str]] = _get_uplinks_by_switch(handler.switches, local_uplinks,
+                                                                          handler.all_leaf_switches)
         self.leaf_only = True
-        logger.debug("get_orphanport_change: local_uplinks: {}".format(self.local_uplinks))
 
     def __call__(self, interface: tuple, detail: dict) -> bool:
-        logger.debug("start get_orphanport_change: interface {}".format(interface))
-        logger.debug("detail: {}".format(detail))
-        # get uplinks
-        model = self.local_switches_details[interface[1]]['model']
-        logger.debug("orphan_port: model: {}".format(model))
-        this_model_uplinks: list = [self.local_uplinks[m] for m in self.local_uplinks if m in model][0]
-        if not this_model_uplinks:
-            _failed_dbg('orphan_port: No uplink data for model {}'.format(model), ('No uplink data for model', model))
-            raise DCNMValueError('No uplink data for model {}'.format(model))
-        logger.debug("orphan_port: this_model_uplinks: {}".format(this_model_uplinks))
+        logger.debug("start get_orphanport_change: interface %s", interface)
+        logger.debug("detail: %s", LogPreview(detail))
+        this_switch_uplinks = self.uplinks.get(interface[1])
+        if this_switch_uplinks is None:
+            # no uplink data for the model of the switch, reported by initialize
+            return False
         # if not a mgmt interface and either a trunk host or access_host interface
         if 'mgmt' not in interface[0] and \
-                interface[0] not in this_model_uplinks and \
+                interface[0] not in this_switch_uplinks and \
                 ('int_trunk_host' in detail['policy'] or 'int_access_host' in detail['policy']) and \
                 'vpc orphan-port enable' not in detail['interfaces'][0]['nvPairs']['CONF']:
             if not detail['interfaces'][0]['nvPairs']['CONF']:
                 detail['interfaces'][0]['nvPairs']['CONF'] = 'vpc orphan-port suspend'
-                logger.debug("interface: {}, changing orphan port suspend".format(interface))
-                logger.debug("orphan port CONF: {}".format(detail['interfaces'][0]['nvPairs']['CONF']))
+                logger.debug("interface: %s, changing orphan port suspend", interface)
+                logger.debug("orphan port CONF: %s", LogPreview(detail['interfaces'][0]['nvPairs']['CONF']))
                 return True
             else:
                 # print(interface, detail)
                 detail['interfaces'][0]['nvPairs']['CONF'] = '{}\n{}'.format(
                     detail['interfaces'][0]['nvPairs']['CONF'],
                     'vpc orphan-port suspend')
-                logger.debug("interface: {}, changing orphan port suspend".format(interface))
-                logger.debug("orphan port multiple CONF: {}".format(detail['interfaces'][0]['nvPairs']['CONF']))
+                logger.debug("interface: %s, changing orphan port suspend", interface)
+                logger.debug("orphan port multiple CONF: %s", LogPreview(detail['interfaces'][0]['nvPairs']['CONF']))
                 return True
         return False
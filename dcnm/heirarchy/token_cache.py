@@ -0,0 +1,162 @@
+import hashlib
+import json
+import logging
+import os
+import pathlib
+from time import time
+from typing import Optional, Tuple, Dict
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TOKEN_CACHE = os.path.join(os.path.expanduser("~"), ".dcnm", "token_cache")
+KEYRING_SERVICE = "dcnm-token-cache"
+
+
+class TokenCache:
+    """
+    Encrypted on disk cache of DCNM tokens keyed by controller and username.
+
+    Tokens are encrypted with Fernet from the optional cryptography package. The key is not stored with the
+    cache, it is read from the first of:
+
+    - the DCNM_TOKEN_CACHE_KEY environment variable
+    - key_file, if one is given. A key file readable by whoever can read the cache, e.g. in the same directory,
+      only obfuscates the tokens, the protection is then the owner only permissions of the files
+    - the OS keyring through the optional keyring package, a key is generated and stored there on first use
+
+    The cache file and a generated key file are created with owner only permissions. If cryptography is not
+    installed or there is no key source the cache disables itself rather than storing tokens in clear text.
+    """
+
+    def __init__(self, cache_file: str = DEFAULT_TOKEN_CACHE, key_file: Optional[str] = None):
+        self.cache_file = pathlib.Path(cache_file).expanduser()
+        self.key_file = pathlib.Path(key_file).expanduser() if key_file else None
+        self._fernet = None
+        self.enabled = True
+        try:
+            from cryptography.fernet import Fernet
+        except ImportError:
+            logger.warning("token cache disabled: the cryptography package is required to encrypt cached tokens")
+            self.enabled = False
+            return
+        key = self._get_key(Fernet)
+        if key is None:
+            logger.warning("token cache disabled: set DCNM_TOKEN_CACHE_KEY, give a key file or install the keyring "
+                           "package to keep the encryption key away from the cached tokens")
+            self.enabled = False
+        else:
+            self._fernet = Fernet(key)
+
+    def _get_key(self, fernet_class) -> Optional[bytes]:
+        env_key = os.environ.get("DCNM_TOKEN_CACHE_KEY")
+        if env_key:
+            return env_key.encode()
+        if self.key_file is not None:
+            if self.key_file.is_file():
+                return self.key_file.read_bytes().strip()
+            key = fernet_class.generate_key()
+            self._write_private(self.key_file, key)
+            return key
+        return self._keyring_key(fernet_class)
+
+    def _keyring_key(self, fernet_class) -> Optional[bytes]:
+        """ the key stored in the OS keyring for this cache file, None if there is no usable keyring """
+        try:
+            import keyring
+        except ImportError:
+            return None
+        try:
+            key = keyring.get_password(KEYRING_SERVICE, str(self.cache_file))
+            if key is None:
+                key = fernet_class.generate_key().decode()
+                keyring.set_password(KEYRING_SERVICE, str(self.cache_file), key)
+        except Exception as e:
+            # keyring raises its own errors when no backend is available, e.g. on a headless server
+            logger.warning("token cache: the OS keyring is not usable: {}".format(e))
+            return None
+        return key.encode()
+
+    @staticmethod
+    def _write_private(path: pathlib.Path, contents: bytes):
+        """ atomically write contents to path, readable and writable by the owner only """
+        path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+        tmp = path.with_name(path.name + '.tmp')
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(contents)
+        except Exception:
+            if tmp.exists():
+                tmp.unlink()
+            raise
+        os.replace(tmp, path)
+
+    @staticmethod
+    def _entry_name(controller: str, username: str) -> str:
+        return hashlib.sha256(f"{controller.strip()}|{username}".encode()).hexdigest()
+
+    def _read_entries(self) -> Dict[str, str]:
+        if not self.cache_file.is_file():
+            return {}
+        try:
+            return json.loads(self.cache_file.read_text())
+        except (OSError, ValueError) as e:
+            logger.warning("token cache: unable to read {}: {}".format(self.cache_file, e))
+            return {}
+
+    def load(self, controller: str, username: str, margin: float = 0) -> Optional[Tuple[str, float]]:
+        """
+        :param controller: DCNM hostname or ip address
+        :type controller: str
+        :param username: DCNM username
+        :type username: str
+        :param margin: seconds of validity the token must still have to be returned
+        :type margin: float
+        :return: (token, expiration time in epoch seconds) or None
+        :rtype: tuple or None
+
+        Returns a cached token for controller and username if there is one that is not about to expire.
+        Only local checks are done, a token the controller has since revoked is caught by the 401 handling
+        of the REST client.
+        """
+        if not self.enabled:
+            return None
+        blob = self._read_entries().get(self._entry_name(controller, username))
+        if blob is None:
+            return None
+        try:
+            entry = json.loads(self._fernet.decrypt(blob.encode()))
+        except Exception as e:
+            logger.warning("token cache: discarding unreadable entry for {}: {}".format(controller, e))
+            self.remove(controller, username)
+            return None
+        if entry['expires'] - margin <= time():
+            logger.debug("token cache: cached token for {} has expired".format(controller))
+            self.remove(controller, username)
+            return None
+        return entry['token'], entry['expires']
+
+    def save(self, controller: str, username: str, token: str, expires: float):
+        if not self.enabled:
+            return
+        entries = self._read_entries()
+        blob = self._fernet.encrypt(json.dumps({'token': token, 'expires': expires}).encode())
+        entries[self._entry_name(controller, username)] = blob.decode()
+        try:
+            self._write_private(self.cache_file, json.dumps(entries).encode())
+        except OSError as e:
+            logger.warning("token cache: unable to write {}: {}".format(self.cache_file, e))
+
+    def remove(self, controller: str, username: str):
+        if not self.enabled:
+            return
+        entries = self._read_entries()
+        if entries.pop(self._entry_name(controller, username), None) is not None:
+            try:
+                self._write_private(self.cache_file, json.dumps(entries).encode())
+            except OSError as e:
+                logger.warning("token cache: unable to write {}: {}".format(self.cache_file, e))
+
+    def __repr__(self):
+        key_file = str(self.key_file) if self.key_file is not None else None
+        return f'{type(self).__name__}({str(self.cache_file)!r}, key_file={key_file!r})'
@@ -0,0 +1,98 @@
+"""
+Startup budget check for the change_interfaces scripts
+
+Imports change_interfaces of each package in a fresh interpreter with python -X importtime and fails (exit code 1)
+if the best cumulative import time of several runs is over the budget, or if one of the optional dependencies
+that are only needed by some runs (pandas, yaml, colorama, ...) is imported at startup.
+
+    python import_budget.py                       check both packages with the default budget
+    python import_budget.py --budget 150 -r 10    150 ms budget, best of 10 runs
+"""
+import argparse
+import os
+import subprocess
+import sys
+from typing import Dict, List, Tuple
+
+PACKAGES = ('interfaces', 'heirarchy')
+MODULE = 'change_interfaces'
+DEFAULT_BUDGET_MS = 250
+# optional dependencies that must be imported by the code that needs them, not at startup
+LAZY_MODULES = ('pandas', 'openpyxl', 'yaml', 'colorama', 'cryptography', 'zstandard', 'pyarrow')
+
+
+def import_times(package_dir: str, module: str = MODULE) -> Tuple[int, Dict[str, int]]:
+    """
+    :param package_dir: directory of the package, the scripts use flat imports
+    :type package_dir: str
+    :param module: module to import
+    :type module: str
+    :return: cumulative import time of module in microseconds, and the cumulative time of every module imported
+    :rtype: tuple
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import {}'.format(module)], cwd=package_dir,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if result.returncode:
+        raise RuntimeError("importing {} in {} failed:\n{}".format(module, package_dir, result.stderr))
+    modules: Dict[str, int] = {}
+    # the modules a top level import pulls in are listed before it, indented
+    subtree: Dict[str, int] = {}
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        subtree[name.strip()] = int(cumulative)
+        if not name[1:].startswith(' '):
+            if name.strip() == module:
+                modules = subtree
+            subtree = {}
+    return modules[module], modules
+
+
+def check(package_dir: str, budget_ms: float, runs: int, top: int) -> List[str]:
+    """
+    :return: the budget violations found, empty if the package is within budget
+    :rtype: list
+    """
+    best = None
+    modules: Dict[str, int] = {}
+    for _ in range(runs):
+        total, run_modules = import_times(package_dir)
+        if best is None or total < best:
+            best, modules = total, run_modules
+    name = os.path.basename(os.path.normpath(package_dir))
+    print("{}: {} imports in {:.1f} ms (best of {}, budget {} ms)".format(name, MODULE, best / 1000, runs,
+                                                                           budget_ms))
+    top_level = sorted(((t, m) for m, t in modules.items() if '.' not in m and m != MODULE), reverse=True)
+    print("    slowest modules:")
+    for cumulative, module in top_level[:top]:
+        print("    {:>10.1f} ms  {}".format(cumulative / 1000, module))
+    failures = []
+    if best / 1000 > budget_ms:
+        failures.append("{}: startup {:.1f} ms is over the {} ms budget".format(name, best / 1000, budget_ms))
+    for module in LAZY_MODULES:
+        if module in modules:
+            failures.append("{}: {} is imported at startup, import it where it is used".format(name, module))
+    return failures
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="check the startup import time of the change_interfaces scripts")
+    parser.add_argument("packages", nargs="*", default=PACKAGES,
+                        help="package directories to check, default is {}".format(' '.join(PACKAGES)))
+    parser.add_argument("-b", "--budget", type=float, default=DEFAULT_BUDGET_MS, metavar="MS",
+                        help="startup budget in milliseconds, default is {}".format(DEFAULT_BUDGET_MS))
+    parser.add_argument("-r", "--runs", type=int, default=5,
+                        help="number of runs, the fastest is compared to the budget")
+    parser.add_argument("-t", "--top", type=int, default=8,
+                        help="number of the slowest top level imports to list")
+    args = parser.parse_args()
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    failures = []
+    for package in args.packages:
+        failures += check(os.path.join(here, package), args.budget, args.runs, args.top)
+    for failure in failures:
+        print("FAIL: {}".format(failure))
+    sys.exit(1 if failures else 0)
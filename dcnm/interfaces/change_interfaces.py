@@ -1,20 +1,26 @@
 import argparse
 import logging
+import os
 import sys
 import traceback
 from functools import partial
-from pickle import dump
 from time import strftime, gmtime
-from typing import Union, Optional, Dict, List
-
-import yaml
+from typing import Union, Optional, Dict, List, FrozenSet, Iterable, Mapping
 
 from DCNM_errors import DCNMValueError, DCNMConnectionError
-from interfaces_utilities import depickle, _file_check
+from freeform import FreeformIndex
+from interfaces_utilities import _file_check
+from journal import ChangeJournal, DEFAULT_JOURNAL, PUT, POLICY
+from metrics import MetricsAggregator
+from profiler import PhaseProfiler, phase
+from snapshot import dump_interfaces_snapshot, dump_policies_snapshot, load_snapshot
+from cassette import RecordingAdapter, ReplayAdapter
+from token_cache import TokenCache, DEFAULT_TOKEN_CACHE
+from dcnm_utils import TraceSink, LogPreview
 from dcnm_interfaces import DcnmInterfaces
 from interfaces_utilities import read_existing_descriptions, get_interfaces_to_change, push_to_dcnm, \
     deploy_to_fabric_using_interface_deploy, verify_interface_change, _dbg, deploy_to_fabric_using_switch_deploy, \
-    _failed_dbg
+    _failed_dbg, changed_fields
 
 
 def command_args() -> argparse.Namespace:
@@ -50,7 +56,8 @@ def command_args() -> argparse.Namespace:
     parser.add_argument("-e", "--all", action="store_true",
                         help="perform actions for all switches")
     parser.add_argument("-x", "--excel", metavar="EXCEL_FILE",
-                        help="descriptions xlsx file")
+                        help="descriptions xlsx, csv or parquet file. the parsed file is cached in\n"
+                             "~/.dcnm/descriptions by content, set DCNM_DESCRIPTIONS_CACHE to change or disable")
     parser.add_argument("-g", "--debug", action="store_true",
                         help="Shortcut for setting screen and logfile levels to DEBUG")
     parser.add_argument("-s", "--screenloglevel", metavar="LOGLEVEL", default="INFO",
@@ -68,14 +75,16 @@ def command_args() -> argparse.Namespace:
                              "must be included with the fallback option")
     parser.add_argument("-o", "--orphan", action="store_true",
                         help="add vpc orphan port configuration to interfaces")
-    parser.add_argument("-p", "--pickle", default="switches_configuration_policies.pickle",
+    parser.add_argument("-p", "--pickle", default="switches_configuration_policies.snap",
                         metavar="FILE",
-                        help="filename for pickle file used to save original switch configuration policies\n"
-                             "if included for deploy, it must also be included for backout")
-    parser.add_argument("-i", "--icpickle", default="interfaces_existing_conf.pickle",
+                        help="filename for snapshot file used to save original switch configuration policies\n"
+                             "if included for deploy, it must also be included for backout.\n"
+                             "pickle files from earlier versions are still accepted for backout")
+    parser.add_argument("-i", "--icpickle", default="interfaces_existing_conf.snap",
                         metavar="FILE",
-                        help="filename for pickle file used to save original interface configuration policies\n"
-                             "if included for deploy, it must also be included for backout")
+                        help="filename for snapshot file used to save original interface configuration policies\n"
+                             "if included for deploy, it must also be included for backout.\n"
+                             "pickle files from earlier versions are still accepted for backout")
     parser.add_argument("-j", "--switch_deploy", action="store_true",
                         help="By default interface deploy is used (along with policy deploy when needed.\n"
                              "In certain situations this can lead to the need for a second deploy especially \n"
@@ -90,6 +99,42 @@ def command_args() -> argparse.Namespace:
                              "default is 300 seconds")
     parser.add_argument("-v", "--verbose", action="store_true",
                         help="verbose mode")
+    parser.add_argument("-k", "--token-cache", nargs="?", const=DEFAULT_TOKEN_CACHE, default=None,
+                        metavar="FILE",
+                        help="reuse the DCNM token between runs. The token is kept encrypted in FILE\n"
+                             "(default {}) and the session is not logged out at the end of the run.\n"
+                             "The key comes from DCNM_TOKEN_CACHE_KEY, --token-cache-key or the OS keyring\n"
+                             "(keyring package), without one the cache is disabled".format(DEFAULT_TOKEN_CACHE))
+    parser.add_argument("--token-cache-key", metavar="KEYFILE", default=None,
+                        help="read the token cache key from KEYFILE, created if missing. Keep it where the\n"
+                             "readers of the cache cannot read it, next to the cache it only obfuscates the token")
+    parser.add_argument("--journal", default=DEFAULT_JOURNAL, metavar="FILE",
+                        help="file recording each pushed interface and completed deploy, default is {}".format(
+                            DEFAULT_JOURNAL))
+    parser.add_argument("--resume", action="store_true",
+                        help="continue an interrupted run from its journal. work the journal records as done\n"
+                             "is skipped and the snapshots of the interrupted run are kept")
+    parser.add_argument("--legacy-pickle", action="store_true",
+                        help="read --pickle and --icpickle files written as pickles by earlier versions.\n"
+                             "loading a pickle can run arbitrary code, only use it for files from trusted locations.\n"
+                             "convert them once with python snapshot.py FILE instead")
+    parser.add_argument("--profile", nargs="?", const="change_interfaces_profile", default=None,
+                        metavar="PREFIX",
+                        help="profile the phases of the run. prints wall, cpu and network wait time per phase and\n"
+                             "writes PREFIX.collapsed (flamegraph input) and PREFIX.<phase>.pstats")
+    parser.add_argument("--trace", metavar="FILE", default=None,
+                        help="write the full body of every DCNM request and response to FILE as json lines.\n"
+                             "tokens and headers are not written. the debug log only holds truncated previews")
+
+    cassette = parser.add_mutually_exclusive_group()
+    cassette.add_argument("--record", metavar="FILE", default=None,
+                          help="record every DCNM request and response to the cassette FILE (gzipped json lines).\n"
+                               "tokens are scrubbed and request headers are not recorded")
+    cassette.add_argument("--replay", metavar="FILE", default=None,
+                          help="answer DCNM requests from the cassette FILE written by --record instead of the\n"
+                               "controller. use separate snapshot and journal files from the recorded run")
+    parser.add_argument("--replay-latency", action="store_true",
+                        help="with --replay, wait the recorded response time of each request")
 
     dryrun = parser.add_mutually_exclusive_group()
     dryrun.add_argument("--dryrun",
@@ -118,43 +163,44 @@ def _read_serials_from_file(file: str):
 
 
 def get_desc_changes(dcnm: DcnmInterfaces, pickle: str, excel: Optional[str] = None,
-                     verbose: bool = True) -> callable:
-    if not excel:
+                     verbose: bool = True, resume: bool = False, serials: Optional[list] = None,
+                     allow_pickle: bool = False) -> callable:
+    if not excel and resume and os.path.isfile(pickle):
+        # the interrupted run already deleted the description policies, use the ones it saved
+        existing_descriptions: Dict[tuple, str] = FreeformIndex(
+            load_snapshot(pickle, serial_numbers=serials, allow_pickle=allow_pickle)).descriptions()
+        if verbose:
+            _dbg("existing descriptions from saved switch policies", existing_descriptions)
+    elif not excel:
         dcnm.get_switches_policies(templateName=r'switch_freeform\Z',
                                    config=r"interface\s+[a-zA-Z]+\d+/?\d*\n\s+[Dd]escription\s+")
-        existing_descriptions_from_policies: list = DcnmInterfaces.get_info_from_policies_config(
-            dcnm.all_switches_policies,
-            r"interface\s+([a-zA-Z]+\d+/?\d*)\n\s+[dD]escription\s+(.*)")
+        freeform = FreeformIndex(dcnm.all_switches_policies)
         if verbose:
             _dbg("switch policies", dcnm.all_switches_policies)
-            _dbg("existing description from policies", existing_descriptions_from_policies)
-        policy_ids: list = list({c.policyId for c in existing_descriptions_from_policies})
+            _dbg("existing description from policies", freeform)
+        policy_ids: list = sorted(freeform.description_policy_ids)
         if verbose:
             _dbg("deleting policy ids", policy_ids)
+        # save the policies before they are deleted
+        dump_policies_snapshot(dcnm.all_switches_policies, pickle)
         # delete the policy
-        dcnm.delete_switch_policies(list(policy_ids))
-        existing_descriptions: Dict[tuple, str] = {k: v for c in existing_descriptions_from_policies for k, v in
-                                                   c.info.items()}
+        dcnm.delete_switch_policies(policy_ids)
+        existing_descriptions: Dict[tuple, str] = freeform.descriptions()
         if verbose:
             _dbg("existing descriptions from switch policies", existing_descriptions)
-        with open(pickle, 'wb') as f:
-            dump(dcnm.all_switches_policies, f)
     else:
         existing_descriptions = read_existing_descriptions(excel)
         if verbose:
             _dbg("existing descriptions from file", existing_descriptions)
 
     def descriptions(interface: tuple, detail: dict) -> bool:
-        logger.debug("start get_desc_change: interface {}".format(interface))
-        logger.debug("detail: {}".format(detail))
+        logger.debug("start get_desc_change: interface %s", interface)
+        logger.debug("detail: %s", LogPreview(detail))
         # if it's not a vpc (e.g. vpc1) interface and the description is not already the desired description
         if interface in existing_descriptions and 'vpc' not in interface[0].lower() and \
                 detail['interfaces'][0]['nvPairs']['DESC'] != existing_descriptions[interface]:
-            logger.debug("interface: {}, new description: {}, old description: {}".format(interface,
-                                                                                          existing_descriptions[
-                                                                                              interface],
-                                                                                          detail['interfaces'][0][
-                                                                                              'nvPairs']['DESC']))
+            logger.debug("interface: %s, new description: %s, old description: %s", interface,
+                         existing_descriptions[interface], detail['interfaces'][0]['nvPairs']['DESC'])
             detail['interfaces'][0]['nvPairs']['DESC'] = existing_descriptions[interface]
             return True
         return False
@@ -163,13 +209,13 @@ def get_desc_changes(dcnm: DcnmInterfaces, pickle: str, excel: Optional[str] = N
 
 
 def get_cdp_change(interface: tuple, detail: dict, mgmt: bool = True) -> bool:
-    logger.debug("start get_cdp_change: interface {}".format(interface))
-    logger.debug("detail: {}".format(detail))
+    logger.debug("start get_cdp_change: interface %s", interface)
+    logger.debug("detail: %s", LogPreview(detail))
     # if the mgmt flag is set and it's a mgmt interface and cdp is enabled
     if mgmt and 'mgmt' in interface[0] and detail['interfaces'][0]['nvPairs']['CDP_ENABLE'] == 'true':
         detail['interfaces'][0]['nvPairs']['CDP_ENABLE'] = 'false'
-        logger.debug("interface: {}, changing cdp".format(interface))
-        logger.debug("CDP_ENABLE: {}".format(detail['interfaces'][0]['nvPairs']['CDP_ENABLE']))
+        logger.debug("interface: %s, changing cdp", interface)
+        logger.debug("CDP_ENABLE: %s", detail['interfaces'][0]['nvPairs']['CDP_ENABLE'])
         return True
     # if it's a leaf switch and ethernet interface and not a fabric interface and cdp is enabled
     elif interface[1] in dcnm.all_leaf_switches and 'ethernet' in interface[0].lower() \
@@ -177,16 +223,16 @@ def get_cdp_change(interface: tuple, detail: dict, mgmt: bool = True) -> bool:
             and 'no cdp enable' not in detail['interfaces'][0]['nvPairs']['CONF']:
         if not detail['interfaces'][0]['nvPairs']['CONF']:
             detail['interfaces'][0]['nvPairs']['CONF'] = 'no cdp enable'
-            logger.debug("interface: {}, changing cdp".format(interface))
-            logger.debug("CONF: {}".format(detail['interfaces'][0]['nvPairs']['CONF']))
+            logger.debug("interface: %s, changing cdp", interface)
+            logger.debug("CONF: %s", LogPreview(detail['interfaces'][0]['nvPairs']['CONF']))
             return True
         else:
             # print(interface, detail)
             detail['interfaces'][0]['nvPairs']['CONF'] = '{}\n{}'.format(
                 detail['interfaces'][0]['nvPairs']['CONF'],
                 'no cdp enable')
-            logger.debug("interface: {}, changing cdp".format(interface))
-            logger.debug("multiple CONF: {}".format(detail['interfaces'][0]['nvPairs']['CONF']))
+            logger.debug("interface: %s, changing cdp", interface)
+            logger.debug("multiple CONF: %s", LogPreview(detail['interfaces'][0]['nvPairs']['CONF']))
             return True
     return False
 
@@ -195,38 +241,36 @@ def get_orphanport_change(dcnm: DcnmInterfaces, uplinks_file: str,
                           serials: Optional[list] = None) -> callable:
     if not dcnm.all_switches_details:
         dcnm.get_switches_details(serial_numbers=serials)
-    local_switches_details = dcnm.all_switches_details
     local_uplinks: Dict = _get_uplinks(uplinks_file)
-    logger.debug("get_orphanport_change: local_uplinks: {}".format(local_uplinks))
+    logger.debug("get_orphanport_change: local_uplinks: %s", LogPreview(local_uplinks))
+    # the function only runs on leaf switches
+    uplinks: Dict[str, FrozenSet[str]] = _get_uplinks_by_switch(dcnm.all_switches_details, local_uplinks,
+                                                                dcnm.all_leaf_switches)
 
     def orphan_port(interface: tuple, detail: dict) -> bool:
-        logger.debug("start get_orphanport_change: interface {}".format(interface))
-        logger.debug("detail: {}".format(detail))
-        # get uplinks
-        model = local_switches_details[interface[1]]['model']
-        logger.debug("orphan_port: model: {}".format(model))
-        this_model_uplinks: list = [local_uplinks[m] for m in local_uplinks if m in model][0]
-        if not this_model_uplinks:
-            _failed_dbg('orphan_port: No uplink data for model {}'.format(model), ('No uplink data for model', model))
-            raise DCNMValueError('No uplink data for model {}'.format(model))
-        logger.debug("orphan_port: this_model_uplinks: {}".format(this_model_uplinks))
+        logger.debug("start get_orphanport_change: interface %s", interface)
+        logger.debug("detail: %s", LogPreview(detail))
+        this_switch_uplinks = uplinks.get(interface[1])
+        if this_switch_uplinks is None:
+            # no uplink data for the model of the switch, reported when the index was built
+            return False
         # if not a mgmt interface and either a trunk host or access_host interface
         if 'mgmt' not in interface[0] and \
-                interface[0] not in this_model_uplinks and \
+                interface[0] not in this_switch_uplinks and \
                 ('int_trunk_host' in detail['policy'] or 'int_access_host' in detail['policy']) and \
                 'vpc orphan-port suspend' not in detail['interfaces'][0]['nvPairs']['CONF']:
             if not detail['interfaces'][0]['nvPairs']['CONF']:
                 detail['interfaces'][0]['nvPairs']['CONF'] = 'vpc orphan-port suspend'
-                logger.debug("interface: {}, changing orphan port suspend".format(interface))
-                logger.debug("orphan port CONF: {}".format(detail['interfaces'][0]['nvPairs']['CONF']))
+                logger.debug("interface: %s, changing orphan port suspend", interface)
+                logger.debug("orphan port CONF: %s", LogPreview(detail['interfaces'][0]['nvPairs']['CONF']))
                 return True
             else:
                 # print(interface, detail)
                 detail['interfaces'][0]['nvPairs']['CONF'] = '{}\n{}'.format(
                     detail['interfaces'][0]['nvPairs']['CONF'],
                     'vpc orphan-port suspend')
-                logger.debug("interface: {}, changing orphan port suspend".format(interface))
-                logger.debug("orphan port multiple CONF: {}".format(detail['interfaces'][0]['nvPairs']['CONF']))
+                logger.debug("interface: %s, changing orphan port suspend", interface)
+                logger.debug("orphan port multiple CONF: %s", LogPreview(detail['interfaces'][0]['nvPairs']['CONF']))
                 return True
         return False
 
@@ -234,6 +278,7 @@ def get_orphanport_change(dcnm: DcnmInterfaces, uplinks_file: str,
 
 
 def _get_uplinks(uplinks_file):
+    import yaml
     yaml_loader = partial(yaml.load, Loader=yaml.FullLoader)
     uplinks = _file_check(uplinks_file, loader=yaml_loader)
     local_uplinks: Dict[str, list] = {}
@@ -245,7 +290,41 @@ def _get_uplinks(uplinks_file):
     return local_uplinks
 
 
-def _normal_deploy(args: argparse.Namespace, dcnm: DcnmInterfaces):
+def _get_uplinks_by_switch(switches_details: Mapping, local_uplinks: Dict[str, list],
+                           serial_numbers: Iterable[str]) -> Dict[str, FrozenSet[str]]:
+    """
+    :param switches_details: switch details keyed by serial number, each with a model
+    :type switches_details: mapping
+    :param local_uplinks: uplink ports keyed by model, as returned by _get_uplinks
+    :type local_uplinks: dict
+    :param serial_numbers: switches to index
+    :type serial_numbers: iterable
+    :return: uplink ports keyed by serial number
+    :rtype: dict
+
+    A switch matches the first model of local_uplinks that is a substring of its model. Switches with no uplink
+    data are reported once and left out of the result.
+    """
+    uplinks_by_model: Dict[Optional[str], Optional[FrozenSet[str]]] = {}
+    uplinks_by_switch: Dict[str, FrozenSet[str]] = {}
+    missing: List[tuple] = []
+    for serial_number in serial_numbers:
+        details = switches_details.get(serial_number)
+        model = details['model'] if details is not None else None
+        if model not in uplinks_by_model:
+            uplinks = next((local_uplinks[m] for m in local_uplinks if model and m in model), None)
+            uplinks_by_model[model] = frozenset(uplinks) if uplinks else None
+        if uplinks_by_model[model] is None:
+            missing.append((serial_number, model))
+        else:
+            uplinks_by_switch[serial_number] = uplinks_by_model[model]
+    if missing:
+        _failed_dbg('orphan_port: No uplink data for switches {}'.format(missing),
+                    ('No uplink data for the models of these switches, their interfaces are not changed', missing))
+    return uplinks_by_switch
+
+
+def _normal_deploy(args: argparse.Namespace, dcnm: DcnmInterfaces, journal: Optional[ChangeJournal]):
     """
 
     :param args:
@@ -261,14 +340,15 @@ def _normal_deploy(args: argparse.Namespace, dcnm: DcnmInterfaces):
     if args.verbose:
         _dbg("Pushing to DCNM and Deploying")
     serials = _get_serial_numbers(args)
-    # get interface info for these serial numbers
-    dcnm.get_interfaces_nvpairs(serial_numbers=serials)
-    # if args.verbose: _dbg("interfaces details and nvpairs", dcnm.all_interfaces_nvpairs)
-    # get role and fabric info for these serial numbers
-    if args.all:
-        dcnm.get_all_switches()
-    else:
-        dcnm.get_switches_by_serial_number(serial_numbers=serials)
+    with phase("collect"):
+        # get interface info for these serial numbers
+        dcnm.get_interfaces_nvpairs(serial_numbers=serials)
+        # if args.verbose: _dbg("interfaces details and nvpairs", dcnm.all_interfaces_nvpairs)
+        # get role and fabric info for these serial numbers
+        if args.all:
+            dcnm.get_all_switches()
+        else:
+            dcnm.get_switches_by_serial_number(serial_numbers=serials)
     if args.verbose:
         _dbg("number of leaf switches", len(dcnm.all_leaf_switches.keys()))
         _dbg("leaf switches", dcnm.all_leaf_switches.keys())
@@ -277,7 +357,8 @@ def _normal_deploy(args: argparse.Namespace, dcnm: DcnmInterfaces):
     if args.description:
         _dbg("Adding Description Changes")
         changes_to_make.append(
-            (get_desc_changes(dcnm, args.pickle, excel=args.excel, verbose=args.verbose), None, False))
+            (get_desc_changes(dcnm, args.pickle, excel=args.excel, verbose=args.verbose, resume=args.resume,
+                              serials=serials, allow_pickle=args.legacy_pickle), None, False))
     if args.cdp:
         _dbg("Adding Disabling of CDP")
         changes_to_make.append((get_cdp_change, {'mgmt': args.mgmt}, False))
@@ -285,24 +366,49 @@ def _normal_deploy(args: argparse.Namespace, dcnm: DcnmInterfaces):
         _dbg("Adding Enabling of Orphan Ports")
         changes_to_make.append((get_orphanport_change(dcnm, uplinks_file='uplinks.yaml', serials=serials),
                                 None, True))
-    interfaces_will_change, interfaces_existing_conf = get_interfaces_to_change(dcnm, changes_to_make)
-    with open(args.icpickle, 'wb') as f:
-        dump(interfaces_existing_conf, f)
+    with phase("plan"):
+        interfaces_will_change, interfaces_existing_conf = get_interfaces_to_change(dcnm, changes_to_make)
+    if args.resume and os.path.isfile(args.icpickle):
+        # the interrupted run's snapshot holds the configuration from before any change was pushed
+        logger.info("resume: keeping existing snapshot {}".format(args.icpickle))
+    else:
+        with phase("snapshot"):
+            dump_interfaces_snapshot(interfaces_existing_conf, args.icpickle)
     if args.verbose:
         _dbg("interfaces to change", interfaces_will_change)
-    _deploy_stub(args, dcnm, interfaces_will_change, policy_ids, serials)
+    _deploy_stub(args, dcnm, interfaces_will_change, policy_ids, serials, journal,
+                 fields=changed_fields(interfaces_existing_conf, interfaces_will_change))
+
+
+def _journal_run(args: argparse.Namespace) -> dict:
+    """
+    the mode, the selected changes and the main arguments written into the journal, --resume only continues a
+    journal that matches them
+    """
+    return {'mode': 'backout' if args.backout else 'deploy', 'switch_deploy': args.switch_deploy, 'all': args.all,
+            'description': args.description, 'cdp': args.cdp, 'mgmt': args.mgmt, 'orphan': args.orphan,
+            'serials': sorted(args.serials or []), 'input_file': args.input_file}
 
 
 def _deploy_stub(args: argparse.Namespace, dcnm: DcnmInterfaces, interfaces_will_change: dict,
-                 policy_ids: Optional[Union[list, tuple, str]], serials: list):
-    success: set = push_to_dcnm(dcnm, interfaces_will_change, verbose=args.verbose)
+                 policy_ids: Optional[Union[list, tuple, str]], serials: list, journal: Optional[ChangeJournal],
+                 fields: Optional[Mapping[tuple, Iterable[str]]] = None):
+    with phase("push"):
+        success: set = push_to_dcnm(dcnm, interfaces_will_change, verbose=args.verbose, journal=journal)
+    if journal is not None and journal.resume:
+        # interfaces pushed by the interrupted run no longer show up as changes but may still need deploying
+        success |= journal.completed(PUT)
+    if journal is not None:
+        journal.checkpoint("push")
     try:
-        if args.switch_deploy:
-            deploy_to_fabric_using_switch_deploy(dcnm, serials, deploy_timeout=args.timeout, verbose=args.verbose)
-        else:
-            deploy_to_fabric_using_interface_deploy(dcnm, success, policies=policy_ids, deploy_timeout=args.timeout,
-                                                    fallback=args.backout,
-                                                    verbose=args.verbose)
+        with phase("deploy"):
+            if args.switch_deploy:
+                deploy_to_fabric_using_switch_deploy(dcnm, serials, deploy_timeout=args.timeout,
+                                                     verbose=args.verbose, journal=journal)
+            else:
+                deploy_to_fabric_using_interface_deploy(dcnm, success, policies=policy_ids,
+                                                        deploy_timeout=args.timeout, fallback=args.backout,
+                                                        verbose=args.verbose, journal=journal)
     except DCNMConnectionError as e:
         if e.args and e.args[0]['RETURN_CODE'] == 500 and "No Commands to execute." in e.args[0]['MESSAGE']:
             logger.error("While Attempting to Deploy to Switches, "
@@ -321,7 +427,14 @@ def _deploy_stub(args: argparse.Namespace, dcnm: DcnmInterfaces, interfaces_will
         raise
 
     # Verify
-    verify_interface_change(dcnm, interfaces_will_change, serial_numbers=serials, verbose=args.verbose)
+    if journal is not None:
+        journal.checkpoint("deploy")
+    with phase("verify"):
+        # a fallback restores whole interfaces, so it has no changed fields and compares all of them
+        verify_interface_change(dcnm, interfaces_will_change, serial_numbers=serials, verbose=args.verbose,
+                                fields=fields)
+    if journal is not None:
+        journal.checkpoint("verify")
 
 
 def _get_serial_numbers(args: argparse.Namespace):
@@ -348,7 +461,7 @@ def _get_serial_numbers(args: argparse.Namespace):
     return serials
 
 
-def _fallback(args: argparse.Namespace, dcnm: DcnmInterfaces):
+def _fallback(args: argparse.Namespace, dcnm: DcnmInterfaces, journal: Optional[ChangeJournal]):
     """
 
     :param args:
@@ -365,30 +478,39 @@ def _fallback(args: argparse.Namespace, dcnm: DcnmInterfaces):
     logger.info("FALLING BACK")
     serials = _get_serial_numbers(args)
     if args.switch_deploy:
-        if args.all:
-            dcnm.get_all_switches()
-        else:
-            dcnm.get_switches_by_serial_number(serial_numbers=serials)
+        with phase("collect"):
+            if args.all:
+                dcnm.get_all_switches()
+            else:
+                dcnm.get_switches_by_serial_number(serial_numbers=serials)
         if args.verbose:
             _dbg("number of leaf switches", len(dcnm.all_leaf_switches.keys()))
             _dbg("leaf switches", dcnm.all_leaf_switches.keys())
 
-    interfaces_existing_conf = depickle(args.icpickle)
+    with phase("load snapshot"):
+        # only the switches being restored are read from the snapshot
+        interfaces_existing_conf = load_snapshot(args.icpickle, serial_numbers=serials,
+                                                 allow_pickle=args.legacy_pickle)
     if args.verbose:
         _dbg("these interface configs will be restored", interfaces_existing_conf)
 
     policy_ids: Union[list, None] = None
     if args.description and not args.excel:
-        interface_desc_policies: Dict[str, list] = depickle(args.pickle)
+        interface_desc_policies: Dict[str, list] = load_snapshot(args.pickle, serial_numbers=serials,
+                                                                 allow_pickle=args.legacy_pickle)
         policy_ids: set = set()
-        for serial_number in interface_desc_policies:
-            for policy in interface_desc_policies[serial_number]:
-                dcnm.post_new_policy(policy)
-                policy_ids.add(policy["policyId"])
+        with phase("restore policies"):
+            for serial_number in interface_desc_policies:
+                for policy in interface_desc_policies[serial_number]:
+                    policy_ids.add(policy["policyId"])
+                    if journal is not None and journal.is_done(POLICY, policy["policyId"]):
+                        continue
+                    if dcnm.post_new_policy(policy) and journal is not None:
+                        journal.record(POLICY, policy["policyId"])
         policy_ids: list = list(policy_ids)
         if args.verbose:
             _dbg("these switch policies will be restored", interface_desc_policies)
-    _deploy_stub(args, dcnm, interfaces_existing_conf, policy_ids, serials)
+    _deploy_stub(args, dcnm, interfaces_existing_conf, policy_ids, serials, journal)
 
 
 if __name__ == '__main__':
@@ -435,17 +557,58 @@ if __name__ == '__main__':
     print("args parsed -- Running in %s mode" % mode)
     if args.verbose:
         _dbg("Connecting to DCNM...")
-    dcnm = DcnmInterfaces(args.dcnm, dryrun=args.dryrun)
-    dcnm.logon(username=args.username, password=args.password)
-
+    # a replayed run has no real token to cache
+    token_cache: Optional[TokenCache] = TokenCache(args.token_cache, args.token_cache_key) \
+        if args.token_cache and not args.replay else None
+    trace_sink: Optional[TraceSink] = TraceSink(args.trace) if args.trace else None
+    request_metrics = MetricsAggregator()
+    profiler: Optional[PhaseProfiler] = PhaseProfiler(args.profile) if args.profile else None
+    if profiler is not None:
+        profiler.start()
+    dcnm = DcnmInterfaces(args.dcnm, dryrun=args.dryrun, token_cache=token_cache, trace_sink=trace_sink,
+                          hooks=[request_metrics])
+    cassette: Optional[Union[RecordingAdapter, ReplayAdapter]] = None
+    if args.record:
+        cassette = RecordingAdapter(args.record, max_retries=dcnm.retry)
+    elif args.replay:
+        cassette = ReplayAdapter(args.replay, latency=args.replay_latency)
+    if cassette is not None:
+        dcnm.mount(cassette)
+    if args.replay:
+        # the cassette answers the logon, there are no credentials to ask for
+        dcnm.logon(username=args.username or 'replay', password='replay')
+    else:
+        dcnm.logon(username=args.username, password=args.password)
+
+    # a dry run changes nothing, the journal of the last real run is left alone
+    journal: Optional[ChangeJournal] = None
+    if not dcnm.dryrun:
+        journal = ChangeJournal(args.journal, resume=args.resume, run=_journal_run(args))
+    if journal is None and args.resume:
+        logger.warning("dry run: the journal {} is neither read nor written".format(args.journal))
+    elif journal is not None and args.resume:
+        print("resuming from journal {}, the interrupted run stopped after: {}".format(args.journal,
+                                                                                   journal.resumed_from))
     if not args.backout:
-        _normal_deploy(args, dcnm)
+        _normal_deploy(args, dcnm, journal)
 
     # Fallback
     else:
-        _fallback(args, dcnm)
-
-    dcnm.logout()
+        _fallback(args, dcnm, journal)
+
+    # keep the session alive when the token is cached so the next run can reuse it
+    if token_cache is None:
+        dcnm.logout()
+    if journal is not None:
+        journal.close()
+    if trace_sink is not None:
+        trace_sink.close()
+    if cassette is not None:
+        cassette.close()
+    request_metrics.print_report()
+    if profiler is not None:
+        profiler.stop()
+        profiler.print_report()
     print('=' * 40)
     print("FINISHED. GO GET PLASTERED!")
     print('=' * 40)
@@ -19,6 +19,10 @@ from DCNM_errors import DCNMServerResponseError, DCNMInterfacesParameterError, \
     DCNMSwitchStatusParameterError, DCNMSwitchStatusError, DCNMConnectionError, DCNMUnauthorizedError, \
     DCNMAuthenticationError
 from dcnm_connect import HttpApi
+from dcnm_utils import LogPreview
+from export import save_records, load_records, INTERFACES, POLICIES, SWITCHES
+from inventory_diff import InventoryDiff, RecordHashes, diff_inventories, policies_by_id
+from journal import PUT
 
 logger = logging.getLogger('dcnm_interfaces')
 
@@ -110,6 +114,8 @@ class DcnmInterfaces(HttpApi):
         self.all_switches_policies = defaultdict(list)
         self.all_switches_policies_prev: dict = {}
         self.fabrics: Dict[str, dict] = {}
+        # content digests of the records of the current and previous inventories
+        self._record_hashes = RecordHashes()
 
     @error_handler("ERROR getting switch serial numbers")
     def get_all_switches(self):
@@ -185,7 +191,8 @@ class DcnmInterfaces(HttpApi):
         :type templateName: str or None
         :param config: optional regex str
         :type config: str or None
-        :param save_to_file: optional parameter, if None do not save, if str use as filename to save to
+        :param save_to_file: optional parameter, if None do not save, if str use as filename to save to,
+        written as newline delimited json, or parquet if the name ends in .parquet
         :type save_to_file: None or str
         :param save_prev: if True and  attribute all_switches_policies exists,
         copy to attribute all_switches_policies_prev
@@ -372,8 +379,7 @@ class DcnmInterfaces(HttpApi):
                 del self.all_switches_policies[sn]
 
         if save_to_file is not None:
-            with open(save_to_file, 'w') as f:
-                f.write(str(self.all_switches_policies))
+            save_records(self.all_switches_policies, save_to_file, POLICIES)
 
     def determine_params(self, serial_numbers):
         if serial_numbers and isinstance(serial_numbers, (list, tuple)):
@@ -480,8 +486,7 @@ class DcnmInterfaces(HttpApi):
         self.all_switches_details = switches
 
         if save_to_file is not None:
-            with open(save_to_file, 'w') as f:
-                f.write(str(self.all_switches_details))
+            save_records(self.all_switches_details, save_to_file, SWITCHES)
 
     @error_handler("ERROR: get_all_interfaces_detail: getting interface details for serial number")
     def get_all_interfaces_details(self, serial_number: Optional[str] = None, interface: Optional[str] = None):
@@ -725,7 +730,8 @@ class DcnmInterfaces(HttpApi):
         :type physical: bool
         :param serial_numbers: required list or tuple of switch serial numbers
         :type serial_numbers: list or tuple
-        :param save_to_file: optional parameter, if None do not save, if str use as filename to save to
+        :param save_to_file: optional parameter, if None do not save, if str use as filename to save to,
+        written as newline delimited json, or parquet if the name ends in .parquet
         :type save_to_file: None or str
         :param save_prev: if True and  attribute all_interfaces_nvpairs exists,
         copy to attribute all_interfaces_nvpairs_prev
@@ -780,8 +786,7 @@ class DcnmInterfaces(HttpApi):
                                                    "oper must be a string or a list of strings")
 
         if save_to_file is not None:
-            with open(save_to_file, 'w') as f:
-                f.write(str(self.all_interfaces_details))
+            save_records(self.all_interfaces_details, save_to_file, INTERFACES)
 
     @error_handler("ERROR: get_all_interfaces_nvpairs: getting interface details and nvpairs for serial number")
     def get_all_interfaces_nvpairs(self, serial_number: Optional[str] = None,
@@ -850,7 +855,7 @@ class DcnmInterfaces(HttpApi):
         params = {'serialNumber': serial_number, 'ifName': interface}
         logger.info("get_all_interfaces_nvpairs: serial_number: {}".format(serial_number))
         response = self._check_response(self.get(path, params=params))
-        logger.debug("get_all_interfaces_nvpairs: response: {}".format(response))
+        logger.debug("get_all_interfaces_nvpairs: response: %s", LogPreview(response))
         for policy in json.loads(response['MESSAGE']):
             for interface in policy['interfaces']:
                 # print(interface)
@@ -884,7 +889,8 @@ class DcnmInterfaces(HttpApi):
         :type policy: str or list of strings
         :param interface: optional interface
         :type interface: str
-        :param save_to_file: optional parameter, if None do not save, if str use as filename to save to
+        :param save_to_file: optional parameter, if None do not save, if str use as filename to save to,
+        written as newline delimited json, or parquet if the name ends in .parquet
         :type save_to_file: None or str
         :param save_prev: if True and  attribute all_interfaces_nvpairs exists,
         copy to attribute all_interfaces_nvpairs_prev
@@ -897,8 +903,9 @@ class DcnmInterfaces(HttpApi):
         if self.all_interfaces_nvpairs and not save_prev:
             self.all_interfaces_nvpairs.clear()
         elif self.all_interfaces_nvpairs and save_prev:
-            self.all_interfaces_nvpairs_prev = deepcopy(self.all_interfaces_nvpairs)
-            self.all_interfaces_nvpairs.clear()
+            # the pulled interfaces go into a new dictionary, so the previous one is kept without copying it
+            self.all_interfaces_nvpairs_prev = self.all_interfaces_nvpairs
+            self.all_interfaces_nvpairs = {}
 
         if serial_numbers and isinstance(serial_numbers, str):
             serial_numbers = [serial_numbers]
@@ -936,8 +943,137 @@ class DcnmInterfaces(HttpApi):
                                                    "config must be a string or a list of strings")
 
         if save_to_file is not None:
-            with open(save_to_file, 'w') as f:
-                f.write(str(self.all_interfaces_nvpairs))
+            save_records(self.all_interfaces_nvpairs, save_to_file, INTERFACES)
+
+    def refresh_interfaces_nvpairs(self, serial_numbers: Union[str, List[str], Tuple[str]]) -> InventoryDiff:
+        """
+        :param serial_numbers: the switches to pull again
+        :type serial_numbers: str or list or tuple
+        :return: the interfaces of those switches that were added, removed or modified since the last pull
+        :rtype: InventoryDiff
+
+        Pulls the interfaces of some switches and keeps the interfaces of the others, e.g. the switches in the
+        serial_numbers of a diff_switches_policies. The previous inventory is kept in all_interfaces_nvpairs_prev.
+        """
+        if isinstance(serial_numbers, str):
+            serial_numbers = [serial_numbers]
+        refreshed: Dict[tuple, dict] = {}
+        for sn in serial_numbers:
+            refreshed.update(self.get_all_interfaces_nvpairs(serial_number=sn))
+        scope = set(serial_numbers)
+        current = {key: detail for key, detail in self.all_interfaces_nvpairs.items() if key[1] not in scope}
+        current.update(refreshed)
+        self.all_interfaces_nvpairs_prev = self.all_interfaces_nvpairs
+        self.all_interfaces_nvpairs = current
+        return self.diff_interfaces_nvpairs(serial_numbers=serial_numbers)
+
+    def diff_interfaces_nvpairs(self, serial_numbers: Optional[Union[list, tuple]] = None) -> InventoryDiff:
+        """
+        :param serial_numbers: only compare the interfaces of these switches, e.g. the switches of a partial pull
+        :type serial_numbers: None or list or tuple
+        :return: the interfaces added, removed or modified between all_interfaces_nvpairs_prev and
+        all_interfaces_nvpairs
+        :rtype: InventoryDiff
+        """
+        diff = diff_inventories(self.all_interfaces_nvpairs_prev, self.all_interfaces_nvpairs, self._record_hashes,
+                                serial_numbers)
+        self._prune_record_hashes()
+        return diff
+
+    def diff_interfaces_details(self, serial_numbers: Optional[Union[list, tuple]] = None) -> InventoryDiff:
+        """
+        :param serial_numbers: only compare the interfaces of these switches
+        :type serial_numbers: None or list or tuple
+        :return: the interfaces added, removed or modified between all_interfaces_details_prev and
+        all_interfaces_details
+        :rtype: InventoryDiff
+        """
+        diff = diff_inventories(self.all_interfaces_details_prev, self.all_interfaces_details, self._record_hashes,
+                                serial_numbers)
+        self._prune_record_hashes()
+        return diff
+
+    def diff_switches_policies(self, serial_numbers: Optional[Union[list, tuple]] = None) -> InventoryDiff:
+        """
+        :param serial_numbers: only compare the policies of these switches
+        :type serial_numbers: None or list or tuple
+        :return: the policies, keyed by policy id, added, removed or modified between all_switches_policies_prev
+        and all_switches_policies
+        :rtype: InventoryDiff
+        """
+        diff = diff_inventories(policies_by_id(self.all_switches_policies_prev),
+                                policies_by_id(self.all_switches_policies), self._record_hashes, serial_numbers)
+        self._prune_record_hashes()
+        return diff
+
+    def _prune_record_hashes(self):
+        self._record_hashes.prune(self.all_interfaces_nvpairs, self.all_interfaces_nvpairs_prev,
+                                  self.all_interfaces_details, self.all_interfaces_details_prev,
+                                  policies_by_id(self.all_switches_policies),
+                                  policies_by_id(self.all_switches_policies_prev))
+
+    def _load_export(self, attribute: str, kind: str, file: str, serial_numbers: Optional[Union[list, tuple]],
+                     save_prev: bool):
+        if save_prev:
+            setattr(self, attribute + '_prev', getattr(self, attribute))
+        setattr(self, attribute, load_records(file, kind, serial_numbers))
+        logger.info("load {}: loaded {} entries from {}".format(attribute, len(getattr(self, attribute)), file))
+
+    def load_switches_policies(self, file: str, serial_numbers: Optional[Union[list, tuple]] = None,
+                               save_prev: bool = False):
+        """
+        :param file: file written by get_switches_policies with save_to_file
+        :type file: str
+        :param serial_numbers: only load the policies of these serial numbers
+        :type serial_numbers: None or list or tuple
+        :param save_prev: if True, keep the current all_switches_policies in all_switches_policies_prev
+        :type save_prev: bool
+
+        Rehydrate all_switches_policies from an export without contacting DCNM
+        """
+        self._load_export('all_switches_policies', POLICIES, file, serial_numbers, save_prev)
+
+    def load_switches_details(self, file: str, serial_numbers: Optional[Union[list, tuple]] = None,
+                              save_prev: bool = False):
+        """
+        :param file: file written by get_switches_details with save_to_file
+        :type file: str
+        :param serial_numbers: only load the details of these serial numbers
+        :type serial_numbers: None or list or tuple
+        :param save_prev: if True, keep the current all_switches_details in all_switches_details_prev
+        :type save_prev: bool
+
+        Rehydrate all_switches_details from an export without contacting DCNM
+        """
+        self._load_export('all_switches_details', SWITCHES, file, serial_numbers, save_prev)
+
+    def load_interfaces_details(self, file: str, serial_numbers: Optional[Union[list, tuple]] = None,
+                                save_prev: bool = False):
+        """
+        :param file: file written by get_interfaces_details with save_to_file
+        :type file: str
+        :param serial_numbers: only load the interfaces of these serial numbers
+        :type serial_numbers: None or list or tuple
+        :param save_prev: if True, keep the current all_interfaces_details in all_interfaces_details_prev
+        :type save_prev: bool
+
+        Rehydrate all_interfaces_details from an export without contacting DCNM
+        """
+        self._load_export('all_interfaces_details', INTERFACES, file, serial_numbers, save_prev)
+
+    def load_interfaces_nvpairs(self, file: str, serial_numbers: Optional[Union[list, tuple]] = None,
+                                save_prev: bool = False):
+        """
+        :param file: file written by get_interfaces_nvpairs with save_to_file
+        :type file: str
+        :param serial_numbers: only load the interfaces of these serial numbers
+        :type serial_numbers: None or list or tuple
+        :param save_prev: if True, keep the current all_interfaces_nvpairs in all_interfaces_nvpairs_prev
+        :type save_prev: bool
+
+        Rehydrate all_interfaces_nvpairs from an export without contacting DCNM
+        """
+        self._load_export('all_interfaces_nvpairs', INTERFACES, file, serial_numbers, save_prev)
 
     @spinner()
     def deploy_switch_config(self, serial_number: str, fabric: Optional[str] = None, deploy_timeout: int = 300) -> bool:
@@ -1026,7 +1162,7 @@ class DcnmInterfaces(HttpApi):
         return info
 
     @spinner()
-    def put_interface_changes(self, interfaces_will_change: Dict[tuple, dict]) -> Tuple[set, set]:
+    def put_interface_changes(self, interfaces_will_change: Dict[tuple, dict], journal=None) -> Tuple[set, set]:
         """
 
         :param self:
@@ -1072,6 +1208,8 @@ class DcnmInterfaces(HttpApi):
                                'policy': 'int_trunk_host_11_1'}
                                }
         :type interfaces_will_change: dict, the key is a tuple, the value is a dictionary
+        :param journal: optional, records every successful put. interfaces it already holds are not pushed again
+        :type journal: journal.ChangeJournal
         :return: two sets, one of successful configurations, one of failed configurations
         :rtype: (set, set, )
 
@@ -1082,6 +1220,10 @@ class DcnmInterfaces(HttpApi):
         failed: set = set()
         success: set = set()
         for interface, details in interfaces_will_change_local.items():
+            if journal is not None and journal.is_done(PUT, interface):
+                logger.debug("put_interface_changes:  %s already pushed according to the journal", interface)
+                success.add(interface)
+                continue
             result = self.put_interface(interface, details)
             if not result:
                 logger.critical(
@@ -1090,14 +1232,16 @@ class DcnmInterfaces(HttpApi):
                 logger.critical(details)
                 failed.add(interface)
             elif result:
-                logger.debug("put_interface_changes:  {} successfully changed. Yay.".format(interface))
-                logger.debug(details)
+                logger.debug("put_interface_changes:  %s successfully changed. Yay.", interface)
+                logger.debug("put_interface_changes:  %s", LogPreview(details))
                 success.add(interface)
+                if journal is not None:
+                    journal.record(PUT, interface)
             else:
                 logger.critical("ERROR: put_interface_changes:  Don't know what happened: {}".format(result))
                 logger.critical("ERROR: put_interface_changes:  {} : {}".format(interface, details))
                 failed.add(interface)
-        logger.debug("put_interface_changes:  Successfully configured {}".format(success))
+        logger.debug("put_interface_changes:  Successfully configured %s", success)
         if failed:
             logger.critical("ERROR: put_interface_changes:  Failed configuring {}".format(failed))
         else:
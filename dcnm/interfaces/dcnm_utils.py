@@ -1,5 +1,8 @@
 import codecs
+import json
 import operator
+import threading
+from time import time
 
 string_types = str,
 integer_types = int,
@@ -122,3 +125,55 @@ viewkeys = operator.methodcaller("keys")
 viewvalues = operator.methodcaller("values")
 
 viewitems = operator.methodcaller("items")
+
+
+# longest rendering of a payload written to the debug log, full payloads go to a TraceSink
+LOG_PREVIEW_LENGTH = 512
+
+
+class LogPreview:
+    """
+    Lazily rendered, truncated view of a payload for use as a logging argument
+
+    logger.debug("data: %s", LogPreview(data)) only builds the string if a handler actually emits the record,
+    so large request and response bodies cost nothing when DEBUG is disabled.
+    """
+    __slots__ = ('obj', 'length')
+
+    def __init__(self, obj, length: int = LOG_PREVIEW_LENGTH):
+        self.obj = obj
+        self.length = length
+
+    def __str__(self):
+        text = str(self.obj)
+        if len(text) > self.length:
+            return "{}... <{} more characters>".format(text[:self.length], len(text) - self.length)
+        return text
+
+
+class TraceSink:
+    """
+    Writes full request and response bodies to a file, one JSON object per line.
+
+    Only enabled when explicitly requested, e.g. with the --trace command line option. Tokens are never written,
+    headers are not recorded.
+    """
+
+    def __init__(self, file: str):
+        self.file = file
+        self._lock = threading.Lock()
+        self._f = open(file, 'a')
+
+    def record(self, **fields):
+        fields.setdefault('time', time())
+        line = json.dumps(fields, default=str)
+        with self._lock:
+            self._f.write(line + '\n')
+            self._f.flush()
+
+    def close(self):
+        with self._lock:
+            self._f.close()
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.file!r})'
@@ -5,15 +5,15 @@ import traceback
 from copy import deepcopy
 from pickle import load
 from pprint import pprint
-from typing import Callable, Optional, Union, Dict, List, Tuple
-
-import pandas
-from colorama import init, Back, Fore, Style
-from pandas import read_excel
+from typing import Callable, Optional, Union, Dict, List, Tuple, Set, Iterable, Mapping
 
 from DCNM_errors import DCNMPolicyDeployError
-from DCNM_errors import ExcelFileError, DCNMFileError
+from DCNM_errors import DCNMFileError
+from descriptions import load_descriptions
 from dcnm_interfaces import DcnmInterfaces
+from inventory_diff import InventoryDiff
+from dcnm_utils import LogPreview
+from journal import ChangeJournal, DEPLOY, POLICIES_DEPLOY
 
 logger = logging.getLogger('interfaces_utilities')
 
@@ -33,8 +33,8 @@ def _dbg(header: str, data=None):
 def read_existing_descriptions(file: str) -> Dict[tuple, str]:
     """
 
-    :param file: an Excel file path/name containing columns "interface", "switch" and "description"
-    the switch column is the switch serial number
+    :param file: an Excel (or csv or parquet) file path/name containing columns "interface", "switch" and
+    "description", the switch column is the switch serial number
     :type file: str
     :return: dictionary
     :rtype: dict[tuple, str]
@@ -42,20 +42,10 @@ def read_existing_descriptions(file: str) -> Dict[tuple, str]:
     Read in an Excel file and return a dictionary of form {(interface, switch_serial_number): interface_description}
     """
     if _file_check(file, skip_load=True):
-        existing_descriptions_local: dict
-        logger.debug("reading excel file {}".format(file))
-        df: pandas.DataFrame = read_excel(file)
-        df.columns = df.columns.str.lower()
-        if 'description' not in df.columns or 'interface' not in df.columns or 'switch' not in df.columns:
-            logger.debug("Columns missing. {}".format(df.columns))
-            raise ExcelFileError('One or more columns missing')
-        existing_descriptions_local = df.to_dict('records')
-        # print(existing_descriptions)
-        existing_descriptions_local = {(interface['interface'], interface['switch']): interface['description'] for
-                                       interface
-                                       in
-                                       existing_descriptions_local}
-        logger.debug("read_existing_descriptions: existing descriptions: {}".format(existing_descriptions_local))
+        logger.debug("reading descriptions file {}".format(file))
+        existing_descriptions_local: Dict[tuple, str] = load_descriptions(file)
+        logger.debug("read_existing_descriptions: read {} existing descriptions".format(
+            len(existing_descriptions_local)))
         return existing_descriptions_local
 
 
@@ -116,14 +106,14 @@ def _run_functions(change_functions, details, interface, leaf=True):
         # or the function can run on any switch
         if (function[2] and leaf) or not function[2]:
             if function[1]:
-                logger.debug("_run_functions: sending {} to function {}".format(interface, function))
-                logger.debug("detail: {}".format(details))
-                logger.debug("{}".format(function[0]))
+                logger.debug("_run_functions: sending %s to function %s", interface, LogPreview(function))
+                logger.debug("detail: %s", LogPreview(details))
+                logger.debug("%s", function[0])
                 change = function[0](interface, details, **function[1]) or change
             else:
-                logger.debug("_run_functions: sending {} to function {}".format(interface, function))
-                logger.debug("detail: {}".format(details))
-                logger.debug("{}".format(function[0]))
+                logger.debug("_run_functions: sending %s to function %s", interface, LogPreview(function))
+                logger.debug("detail: %s", LogPreview(details))
+                logger.debug("%s", function[0])
                 change = function[0](interface, details) or change
         else:
             change = change or False
@@ -131,47 +121,135 @@ def _run_functions(change_functions, details, interface, leaf=True):
     return change
 
 
-def verify_interface_change(dcnm: DcnmInterfaces, interfaces_will_change: dict, verbose: bool = True, **kwargs):
-    dcnm.get_interfaces_nvpairs(save_prev=True, **kwargs)
-    failed: set = set()
-    success: set = set()
+# fields DCNM sets itself, so they are not compared
+UNVERIFIED_FIELDS = frozenset({'PRIORITY', 'FABRIC_NAME'})
+
+
+def changed_fields(interfaces_original: Mapping[tuple, dict],
+                   interfaces_to_change: Mapping[tuple, dict]) -> Dict[tuple, Set[str]]:
+    """
+    :param interfaces_original: the interface details before the change functions ran
+    :type interfaces_original: dict
+    :param interfaces_to_change: the changed interface details, as returned by get_interfaces_to_change
+    :type interfaces_to_change: dict
+    :return: the nvPairs keys that changed, keyed by interface
+    :rtype: dict
+    """
+    fields: Dict[tuple, Set[str]] = {}
+    for interface, detail in interfaces_to_change.items():
+        nvpairs = detail['interfaces'][0]['nvPairs']
+        original = interfaces_original[interface]['interfaces'][0]['nvPairs'] \
+            if interface in interfaces_original else {}
+        fields[interface] = {key for key, value in nvpairs.items()
+                             if key not in original or original[key] != value}
+    return fields
+
+
+def interface_field_diffs(expected: Mapping[tuple, dict], actual: Mapping[tuple, dict],
+                          fields: Optional[Mapping[tuple, Iterable[str]]] = None) -> Dict[tuple, Dict[str, tuple]]:
+    """
+    :param expected: the desired interface details, keyed by (interface name, serial number)
+    :type expected: dict
+    :param actual: the interface details pulled from DCNM
+    :type actual: dict
+    :param fields: the nvPairs keys to compare for each interface, interfaces missing from it or with no keys have
+    all of their nvPairs except UNVERIFIED_FIELDS and their policy compared
+    :type fields: dict or None
+    :return: {interface: {nvPairs key or 'policy': (expected value, value in DCNM)}} of the interfaces that do not
+    match, values missing from DCNM are None
+    :rtype: dict
+
+    Only the requested fields are read, nothing is copied.
+    """
+    diffs: Dict[tuple, Dict[str, tuple]] = {}
+    for interface, detail in expected.items():
+        expected_nvpairs = detail['interfaces'][0]['nvPairs']
+        actual_detail = actual.get(interface)
+        actual_nvpairs = actual_detail['interfaces'][0]['nvPairs'] if actual_detail else {}
+        keys = fields.get(interface) if fields is not None else None
+        # no recorded field, e.g. a plugin that only changed the policy, falls back to comparing everything
+        full = not keys
+        if full:
+            keys = (expected_nvpairs.keys() | actual_nvpairs.keys()) - UNVERIFIED_FIELDS
+        interface_diffs = {key: (expected_nvpairs.get(key), actual_nvpairs.get(key)) for key in keys
+                           if expected_nvpairs.get(key) != actual_nvpairs.get(key)}
+        if full and detail.get('policy') != (actual_detail or {}).get('policy'):
+            interface_diffs['policy'] = (detail.get('policy'), (actual_detail or {}).get('policy'))
+        if interface_diffs:
+            diffs[interface] = interface_diffs
+    return diffs
+
+
+def _report_drift(drift: InventoryDiff, interfaces_will_change: Mapping[tuple, dict], verbose: bool):
+    """ warn about the interfaces that changed since they were pulled but were not changed by this run """
+    if not drift.old:
+        return
+    unexpected = drift.changed - interfaces_will_change.keys()
+    if unexpected:
+        logger.warning("verify_interface_change: {} interfaces changed outside this run: {}".format(
+            len(unexpected), sorted(unexpected)))
+        if verbose:
+            _dbg("Interfaces changed outside this run", {interface: drift.fields(interface)
+                                                          for interface in sorted(unexpected)})
+
+
+def verify_interface_change(dcnm: DcnmInterfaces, interfaces_will_change: dict, verbose: bool = True,
+                            fields: Optional[Mapping[tuple, Iterable[str]]] = None,
+                            **kwargs) -> Dict[tuple, Dict[str, tuple]]:
+    """
+    :param dcnm: dcnm object
+    :type dcnm: DcnmInterfaces
+    :param interfaces_will_change: a dictionary of interfaces
+    :type interfaces_will_change: dict
+    :param verbose: output more information if this is set
+    :type verbose: bool
+    :param fields: the nvPairs keys changed for each interface, see changed_fields, if None all nvPairs are
+    compared
+    :type fields: dict or None
+    :param kwargs: passed to get_interfaces_nvpairs
+    :return: {interface: {nvPairs key: (desired value, value in DCNM)}} of the interfaces that failed verification
+    :rtype: dict
+
+    Pulls the interfaces of the switches that changed from DCNM and compares the changed fields to the
+    interfaces_will_change dict. Displays failures. Other interfaces of those switches that differ from the
+    previous pull are reported as changed outside this run.
+    """
     if verbose:
         _dbg("Verifying Interface Configurations")
-    interfaces_will_change_local = deepcopy(interfaces_will_change)
-    all_interfaces_nv_pairs_local = deepcopy(dcnm.all_interfaces_nvpairs)
-    for interface in interfaces_will_change:
-        # priority changes, so remove from comparison
-        interfaces_will_change_local[interface]['interfaces'][0]['nvPairs'].pop('PRIORITY', None)
-        interfaces_will_change_local[interface]['interfaces'][0]['nvPairs'].pop('FABRIC_NAME', None)
-        all_interfaces_nv_pairs_local[interface]['interfaces'][0]['nvPairs'].pop('PRIORITY', None)
-        all_interfaces_nv_pairs_local[interface]['interfaces'][0]['nvPairs'].pop('FABRIC_NAME', None)
-        if interfaces_will_change_local[interface] == all_interfaces_nv_pairs_local[interface]:
-            logger.debug("Verification confirmed for interface {}".format(interface))
-            logger.debug("{}".format(interfaces_will_change[interface]))
-            success.add(interface)
-        else:
-            logger.critical("Verification failed for interface {}".format(interface))
-            logger.critical("Desired configuration: {}".format(interfaces_will_change[interface]))
-            logger.critical("Configuration pulled from DCNM: {}".format(dcnm.all_interfaces_nvpairs[interface]))
-            failed.add(interface)
+    if not interfaces_will_change:
+        logger.debug("verify_interface_change: nothing to verify")
+        return {}
+    # only the switches with changed interfaces are pulled
+    kwargs['serial_numbers'] = sorted({serial_number for _, serial_number in interfaces_will_change})
+    dcnm.get_interfaces_nvpairs(save_prev=True, **kwargs)
+    _report_drift(dcnm.diff_interfaces_nvpairs(serial_numbers=kwargs['serial_numbers']), interfaces_will_change,
+                  verbose)
+    failed = interface_field_diffs(interfaces_will_change, dcnm.all_interfaces_nvpairs, fields)
+    logger.debug("verify_interface_change: verified {} interfaces, {} failed".format(len(interfaces_will_change),
+                                                                                    len(failed)))
+    for interface, diffs in failed.items():
+        logger.critical("Verification failed for interface {}".format(interface))
+        for key, (desired, actual) in sorted(diffs.items()):
+            logger.critical("    {}: desired {!r}, DCNM has {!r}".format(key, desired, actual))
     if failed:
-        if failed:
-            _failed_dbg("verify_interface_change:  Failed configuring {}".format(failed),
-                        ("Failed verification config changes to for the following switches:", failed))
+        _failed_dbg("verify_interface_change:  Failed configuring {}".format(set(failed)),
+                    ("Failed verification config changes to for the following switches:",
+                     failed if verbose else set(failed)))
     else:
         logger.debug("verify_interface_change: No Failures!")
         if verbose:
             _dbg("Successfully Verified All Interface Changes! Yay!")
-    # return success, failed
+    return failed
 
 
-def push_to_dcnm(dcnm: DcnmInterfaces, interfaces_to_change: dict, verbose: bool = True) -> set:
+def push_to_dcnm(dcnm: DcnmInterfaces, interfaces_to_change: dict, verbose: bool = True,
+                 journal: Optional[ChangeJournal] = None) -> set:
     # make changes
     success: set
     failure: set
     if verbose:
         _dbg("Putting changes to dcnm")
-    success, failure = dcnm.put_interface_changes(interfaces_to_change)
+    success, failure = dcnm.put_interface_changes(interfaces_to_change, journal=journal)
     if failure:
         _failed_dbg("Failed putting to DCNM for the following: {}".format(failure),
                     ("Failed pushing config changes to DCNM for the following switches:", failure))
@@ -188,12 +266,19 @@ def deploy_to_fabric_using_interface_deploy(dcnm: DcnmInterfaces, deploy,
                                             policies: Optional[Union[list, tuple, str]] = None,
                                             deploy_timeout: int = 300,
                                             fallback: bool = False,
-                                            verbose: bool = True):
+                                            verbose: bool = True,
+                                            journal: Optional[ChangeJournal] = None):
     deploy_list: list = DcnmInterfaces.create_deploy_list(deploy)
     if verbose:
         _dbg('Deploying changes to switches')
-    if dcnm.deploy_interfaces(deploy_list, deploy_timeout=deploy_timeout):
+    if journal is not None and journal.deploy_done('interfaces', {serial_number for _, serial_number in deploy}):
+        logger.info("interface deploy already completed according to the journal")
+        if verbose:
+            _dbg('Interface deploy already completed according to the journal', deploy)
+    elif dcnm.deploy_interfaces(deploy_list, deploy_timeout=deploy_timeout):
         logger.debug('successfully deployed to {}'.format(deploy))
+        if journal is not None:
+            journal.record(DEPLOY, 'interfaces')
         if verbose:
             _dbg('!!Successfully Deployed Config Changes to Switches!!', deploy)
     else:
@@ -207,8 +292,12 @@ def deploy_to_fabric_using_interface_deploy(dcnm: DcnmInterfaces, deploy,
             policies = [policies]
         if verbose:
             _dbg("DEPLOYING POLICIES: ", policies)
-        if dcnm.deploy_policies(policies, deploy_timeout=deploy_timeout):
+        if journal is not None and journal.deploy_done(POLICIES_DEPLOY, []):
+            logger.info("policy deploy already completed according to the journal")
+        elif dcnm.deploy_policies(policies, deploy_timeout=deploy_timeout):
             logger.debug('successfully deployed policies {}'.format(policies))
+            if journal is not None:
+                journal.record(DEPLOY, POLICIES_DEPLOY)
             if verbose:
                 _dbg('!!Successfully Deployed Config Policies to Switches!!', policies)
         else:
@@ -223,7 +312,8 @@ def deploy_to_fabric_using_interface_deploy(dcnm: DcnmInterfaces, deploy,
 
 def deploy_to_fabric_using_switch_deploy(dcnm: DcnmInterfaces, serial_numbers: Optional[Union[str, list]],
                                          deploy_timeout: int = 300,
-                                         verbose: bool = True):
+                                         verbose: bool = True,
+                                         journal: Optional[ChangeJournal] = None):
     deployed: set = set()
     logger.info("Deploying changes to switches")
     if verbose:
@@ -245,8 +335,12 @@ def deploy_to_fabric_using_switch_deploy(dcnm: DcnmInterfaces, serial_numbers: O
     for serial_number in reduced_serial_numbers:
         if serial_number in deployed:
             continue
-        if dcnm.deploy_switch_config(serial_number):
+        if journal is not None and journal.deploy_done(serial_number, [serial_number]):
+            logger.info("switch deploy of {} already completed according to the journal".format(serial_number))
+        elif dcnm.deploy_switch_config(serial_number):
             logger.debug('deploy returned successfully')
+            if journal is not None:
+                journal.record(DEPLOY, serial_number)
             if verbose:
                 _dbg('deploy returned successfully for: ', serial_number)
         else:
@@ -278,6 +372,7 @@ def deploy_to_fabric_using_switch_deploy(dcnm: DcnmInterfaces, serial_numbers: O
 
 
 def _failed_dbg(log_msg: str, messages: tuple):
+    from colorama import init, Back, Fore, Style
     init()
     logger.critical(log_msg)
     print()
@@ -0,0 +1,157 @@
+import json
+import logging
+import os
+from time import time
+from typing import Any, Dict, Optional, Set, Union, Hashable, Iterable
+
+from DCNM_errors import DCNMFileError
+
+logger = logging.getLogger('journal')
+
+DEFAULT_JOURNAL = "change_interfaces.journal"
+
+# record kinds
+PUT = 'put'
+DEPLOY = 'deploy'
+POLICY = 'policy'
+CHECKPOINT = 'checkpoint'
+# deploy unit of the policies restored by a fallback
+POLICIES_DEPLOY = 'policies'
+
+
+def _key(key: Union[str, list, tuple]) -> Hashable:
+    return tuple(key) if isinstance(key, list) else key
+
+
+class ChangeJournal:
+    """
+    Append only record of the work a run has completed, one json object per line.
+
+    A record is written for every interface pushed to DCNM, every deploy unit and every restored policy, and a
+    checkpoint at the end of each phase. Records are fsynced every batch_size records and at every checkpoint, so
+    a crash loses at most the last batch, which is simply done again on resume (the puts and deploys are
+    idempotent).
+
+    When resume is False an existing journal is moved aside to <file>.prev and a new one is started. When resume
+    is True the journal is read and appended to, and is_done reports the work the earlier run completed.
+
+    run describes the run, e.g. its mode and serial numbers, and is written into the start checkpoint. A journal
+    is only resumed by a run with the same description, anything else raises DCNMFileError. Dry runs must not
+    open a journal, their simulated puts and deploys would be recorded as completed.
+    """
+
+    def __init__(self, file: str = DEFAULT_JOURNAL, resume: bool = False, batch_size: int = 25,
+                 run: Optional[Dict[str, Any]] = None):
+        self.file = file
+        self.resume = resume
+        self.batch_size = batch_size
+        # json round trip, so it compares equal to the run read back from the journal
+        self.run: Dict[str, Any] = json.loads(json.dumps(run or {}))
+        self._done: Set[tuple] = set()
+        # serial numbers with interfaces pushed by this run, their deploys must run again even if journaled
+        self._pushed_serials: Set[str] = set()
+        self._posted_policies = False
+        self.last_checkpoint: Optional[str] = None
+        self._pending = 0
+        if resume:
+            self._read()
+        elif os.path.isfile(file):
+            os.replace(file, file + '.prev')
+        # where the earlier run stopped
+        self.resumed_from: Optional[str] = self.last_checkpoint
+        self._f = open(file, 'a')
+        if self._f.tell() and not self._ends_with_newline():
+            # terminate the partial record left by a crash so the next record starts on its own line
+            self._f.write('\n')
+        self.record(CHECKPOINT, 'resume' if resume else 'start', run=self.run)
+
+    def _ends_with_newline(self) -> bool:
+        with open(self.file, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b'\n'
+
+    def _read(self):
+        if not os.path.isfile(self.file):
+            logger.warning("journal: {} not found, nothing to resume".format(self.file))
+            return
+        started: Optional[dict] = None
+        with open(self.file) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # a partial line left by a crash
+                    logger.warning("journal: skipping unreadable record in {}".format(self.file))
+                    continue
+                if entry['kind'] == CHECKPOINT:
+                    self.last_checkpoint = entry['key']
+                    if entry['key'] == 'start':
+                        started = entry
+                else:
+                    self._done.add((entry['kind'], _key(entry['key'])))
+        if started is None or started.get('run') != self.run:
+            logger.critical("journal: {} was written by a different run: {}, this run: {}".format(
+                self.file, started.get('run') if started else None, self.run))
+            raise DCNMFileError("journal {} was not written by a run with the same mode and arguments ({}), it can "
+                                "not be resumed. run again without --resume".format(self.file, self.run))
+        logger.info("journal: resuming from {} with {} completed records, last checkpoint {}".format(
+            self.file, len(self._done), self.last_checkpoint))
+
+    def record(self, kind: str, key: Union[str, tuple], **details):
+        """
+        :param kind: put, deploy, policy or checkpoint
+        :type kind: str
+        :param key: the interface tuple, serial number, policy id or checkpoint name
+        :type key: str or tuple
+        """
+        entry = {'kind': kind, 'key': key, 'time': time()}
+        entry.update(details)
+        self._f.write(json.dumps(entry) + '\n')
+        if kind == CHECKPOINT:
+            self.last_checkpoint = key
+        else:
+            self._done.add((kind, _key(key)))
+            if kind == PUT:
+                self._pushed_serials.add(key[1])
+            elif kind == POLICY:
+                self._posted_policies = True
+        self._pending += 1
+        if kind == CHECKPOINT or self._pending >= self.batch_size:
+            self.sync()
+
+    def checkpoint(self, name: str):
+        self.record(CHECKPOINT, name)
+
+    def is_done(self, kind: str, key: Union[str, tuple]) -> bool:
+        return (kind, _key(key)) in self._done
+
+    def deploy_done(self, unit: str, serial_numbers: Iterable[str]) -> bool:
+        """
+        :param unit: name of the deploy unit, a serial number for switch deploys
+        :type unit: str
+        :param serial_numbers: the switches the deploy unit covers
+        :type serial_numbers: iterable
+        :return: True if an earlier run completed the deploy and this run has pushed nothing new to those switches
+        :rtype: bool
+        """
+        if not self.is_done(DEPLOY, unit):
+            return False
+        if unit == POLICIES_DEPLOY:
+            return not self._posted_policies
+        return self._pushed_serials.isdisjoint(serial_numbers)
+
+    def completed(self, kind: str) -> set:
+        return {key for done_kind, key in self._done if done_kind == kind}
+
+    def sync(self):
+        self._f.flush()
+        os.fsync(self._f.fileno())
+        self._pending = 0
+
+    def close(self):
+        if not self._f.closed:
+            self.record(CHECKPOINT, 'finished')
+            self._f.close()
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.file!r}, resume={self.resume!r})'
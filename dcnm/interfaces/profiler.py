@@ -0,0 +1,178 @@
+import cProfile
+import os
+import pstats
+import sys
+import threading
+from collections import defaultdict, OrderedDict
+from contextlib import contextmanager
+from time import perf_counter, process_time
+from typing import Optional, Dict, List
+
+# categories of exclusive (tottime) profile time, checked in order against filename and function name
+CATEGORIES = OrderedDict([
+    ('network', ('/requests/', '/urllib3/', 'http/client.py', 'socket.py', 'ssl.py', 'selectors.py', '_socket',
+                 '_ssl', 'select.')),
+    ('deepcopy', ('copy.py',)),
+    ('regex', ('/re.py', '/re/', 'sre_', '_sre', 're.Pattern')),
+    ('json', ('/json/', '_json')),
+])
+
+_active: Optional['PhaseProfiler'] = None
+
+
+@contextmanager
+def phase(name: str):
+    """
+    time the enclosed block as phase name if a PhaseProfiler is running, otherwise do nothing
+    """
+    if _active is None:
+        yield
+        return
+    with _active.phase(name):
+        yield
+
+
+def _category(stat_key: tuple) -> str:
+    filename, _, funcname = stat_key
+    location = filename.replace('\\', '/') + ' ' + funcname
+    for category, markers in CATEGORIES.items():
+        for marker in markers:
+            if marker in location:
+                return category
+    return 'other'
+
+
+class PhaseResult:
+    __slots__ = ('name', 'wall', 'cpu', 'stats', 'categories')
+
+    def __init__(self, name: str):
+        self.name = name
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.stats: Optional[pstats.Stats] = None
+        self.categories: Dict[str, float] = defaultdict(float)
+
+
+class PhaseProfiler:
+    """
+    Deterministic profile plus stack sampling of named phases of a run.
+
+    Each phase is profiled with cProfile; its wall clock and process cpu time are recorded and the profile's
+    exclusive time is split into network (waiting on DCNM), deepcopy, regex, json and other. A sampling thread
+    records the stack of the profiled thread every sample_interval seconds, which is written out as collapsed
+    stacks ('phase;frame;frame count' lines) that flamegraph.pl, speedscope and similar tools read directly.
+    """
+
+    def __init__(self, output_prefix: str = "change_interfaces_profile", sample_interval: float = 0.005):
+        self.output_prefix = output_prefix
+        self.sample_interval = sample_interval
+        self.phases: Dict[str, PhaseResult] = OrderedDict()
+        self.samples: Dict[str, int] = defaultdict(int)
+        self._current: List[str] = []
+        self._thread_id: Optional[int] = None
+        self._stop = threading.Event()
+        self._sampler: Optional[threading.Thread] = None
+
+    def start(self):
+        global _active
+        _active = self
+        self._thread_id = threading.get_ident()
+        self._stop.clear()
+        self._sampler = threading.Thread(target=self._sample, name='profiler-sampler', daemon=True)
+        self._sampler.start()
+
+    def stop(self):
+        global _active
+        _active = None
+        self._stop.set()
+        if self._sampler is not None:
+            self._sampler.join()
+            self._sampler = None
+
+    def _sample(self):
+        own_file = __file__.rsplit('.', 1)[0]
+        while not self._stop.wait(self.sample_interval):
+            frame = sys._current_frames().get(self._thread_id)
+            if frame is None or not self._current:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                if not code.co_filename.startswith(own_file) and 'contextlib' not in code.co_filename:
+                    stack.append("{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename),
+                                                     code.co_firstlineno))
+                frame = frame.f_back
+            stack.append(self._current[-1])
+            self.samples[';'.join(reversed(stack))] += 1
+
+    @contextmanager
+    def phase(self, name: str):
+        # phases started inside another phase are named parent/child
+        name = '/'.join(self._current[-1:] + [name])
+        result = self.phases.setdefault(name, PhaseResult(name))
+        self._current.append(name)
+        # cProfile can not be nested, an inner phase's profile time is part of the outer phase
+        profile = cProfile.Profile() if len(self._current) == 1 else None
+        wall_start, cpu_start = perf_counter(), process_time()
+        if profile is not None:
+            profile.enable()
+        try:
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+            result.wall += perf_counter() - wall_start
+            result.cpu += process_time() - cpu_start
+            self._current.pop()
+            if profile is not None:
+                self._add_stats(result, profile)
+
+    @staticmethod
+    def _add_stats(result: PhaseResult, profile: cProfile.Profile):
+        stats = pstats.Stats(profile)
+        for key, (_, _, tottime, _, _) in stats.stats.items():
+            result.categories[_category(key)] += tottime
+        if result.stats is None:
+            result.stats = stats
+        else:
+            result.stats.add(stats)
+
+    def report(self) -> str:
+        columns = ['network'] + [c for c in CATEGORIES if c != 'network'] + ['other']
+        lines = ["{:<20} {:>9} {:>9}".format('PHASE', 'WALL s', 'CPU s') +
+                 ''.join(" {:>9}".format(c.upper()[:9]) for c in columns)]
+        for result in self.phases.values():
+            line = "{:<20} {:>9.2f} {:>9.2f}".format(result.name, result.wall, result.cpu)
+            if result.stats is not None:
+                line += ''.join(" {:>9.2f}".format(result.categories.get(c, 0.0)) for c in columns)
+            lines.append(line)
+        lines.append("network is time spent waiting on the controller, the other columns are exclusive local time")
+        return '\n'.join(lines)
+
+    def write(self) -> List[str]:
+        """
+        write collapsed stacks to <output_prefix>.collapsed and a pstats file per phase
+
+        :return: the files written
+        :rtype: list
+        """
+        written = []
+        collapsed = self.output_prefix + '.collapsed'
+        with open(collapsed, 'w') as f:
+            for stack, count in sorted(self.samples.items()):
+                f.write("{} {}\n".format(stack, count))
+        written.append(collapsed)
+        for result in self.phases.values():
+            if result.stats is not None:
+                pstats_file = "{}.{}.pstats".format(self.output_prefix, result.name.replace(" ", "_").replace("/", "."))
+                result.stats.dump_stats(pstats_file)
+                written.append(pstats_file)
+        return written
+
+    def print_report(self):
+        print('=' * 40)
+        print("PROFILE")
+        print('=' * 40)
+        print(self.report())
+        for file in self.write():
+            print("profile written to {}".format(file))
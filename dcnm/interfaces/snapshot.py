@@ -0,0 +1,234 @@
+"""
+Backout snapshots of interface configurations and switch policies
+
+A snapshot file is laid out as
+
+    DCNMSNAP <version> <codec> <index offset>\n     fixed width plain text header
+    <compressed member>                            newline delimited json records of one serial number
+    ...
+    <compressed member>                            json index: kind, created, {serial: [offset, length, count]}
+
+Every member is compressed on its own (gzip, or zstd if the zstandard package is installed and requested), so a
+reader seeks straight to the switches it needs and only decompresses those. Snapshots hold nothing but json, unlike
+the pickles they replace, so they are safe to load from any location. Loading a pickle can run arbitrary code, so
+load_snapshot only reads the pickles written by earlier versions when allow_pickle is set. Convert them once with
+
+    python snapshot.py FILE [OUTPUT]
+"""
+import gzip
+import json
+import logging
+import os
+from collections import defaultdict
+from pickle import load
+from time import time
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+from DCNM_errors import DCNMFileError
+
+logger = logging.getLogger('snapshot')
+
+SNAPSHOT_MAGIC = b"DCNMSNAP"
+SNAPSHOT_VERSION = 1
+# magic, version, codec and a zero padded index offset
+_HEADER_FORMAT = "{} {:>3} {:<4} {:020d}\n"
+_HEADER_LENGTH = len(_HEADER_FORMAT.format(SNAPSHOT_MAGIC.decode(), SNAPSHOT_VERSION, 'gzip', 0))
+
+INTERFACES = 'interfaces'
+POLICIES = 'policies'
+
+
+def _compressor(codec: str):
+    if codec == 'gzip':
+        return lambda data: gzip.compress(data, compresslevel=6), gzip.decompress
+    if codec == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise DCNMFileError("the zstandard package is required for zstd compressed snapshots")
+        return zstandard.ZstdCompressor().compress, zstandard.ZstdDecompressor().decompress
+    raise DCNMFileError("unknown snapshot compression {}".format(codec))
+
+
+def _write(file: str, kind: str, groups: Dict[str, Iterable[dict]], codec: str = 'gzip'):
+    compress, _ = _compressor(codec)
+    index: Dict[str, list] = {}
+    tmp = file + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(b' ' * _HEADER_LENGTH)
+        for serial_number, records in groups.items():
+            lines = [json.dumps(record, separators=(',', ':')) for record in records]
+            member = compress(''.join(line + '\n' for line in lines).encode())
+            index[serial_number] = [f.tell(), len(member), len(lines)]
+            f.write(member)
+        index_offset = f.tell()
+        f.write(compress(json.dumps({'kind': kind, 'version': SNAPSHOT_VERSION, 'created': time(),
+                                     'serials': index}).encode()))
+        f.seek(0)
+        f.write(_HEADER_FORMAT.format(SNAPSHOT_MAGIC.decode(), SNAPSHOT_VERSION, codec, index_offset).encode())
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, file)
+    logger.info("snapshot: wrote {} serial numbers of {} to {}".format(len(index), kind, file))
+
+
+def dump_interfaces_snapshot(interfaces_conf: Dict[Tuple[str, str], dict], file: str, codec: str = 'gzip'):
+    """
+    :param interfaces_conf: interface configurations keyed by (interface name, serial number)
+    :type interfaces_conf: dict
+    :param file: snapshot file name
+    :type file: str
+    :param codec: gzip or zstd
+    :type codec: str
+    """
+    groups: Dict[str, List[dict]] = defaultdict(list)
+    for interface, details in interfaces_conf.items():
+        groups[interface[1]].append({'interface': list(interface), 'details': details})
+    _write(file, INTERFACES, groups, codec=codec)
+
+
+def dump_policies_snapshot(policies: Dict[str, List[dict]], file: str, codec: str = 'gzip'):
+    """
+    :param policies: switch policies keyed by serial number
+    :type policies: dict
+    :param file: snapshot file name
+    :type file: str
+    :param codec: gzip or zstd
+    :type codec: str
+    """
+    _write(file, POLICIES, policies, codec=codec)
+
+
+def is_snapshot(file: str) -> bool:
+    with open(file, 'rb') as f:
+        return f.read(len(SNAPSHOT_MAGIC)) == SNAPSHOT_MAGIC
+
+
+class SnapshotReader:
+    """
+    Random access to the serial numbers stored in a snapshot file
+    """
+
+    def __init__(self, file: str):
+        self.file = file
+        with open(file, 'rb') as f:
+            header = f.read(_HEADER_LENGTH).decode().split()
+            if len(header) != 4 or header[0] != SNAPSHOT_MAGIC.decode():
+                raise DCNMFileError("{} is not a snapshot file".format(file))
+            version, self.codec, index_offset = int(header[1]), header[2], int(header[3])
+            if version > SNAPSHOT_VERSION:
+                raise DCNMFileError("snapshot {} has version {}, this program reads up to version {}".format(
+                    file, version, SNAPSHOT_VERSION))
+            _, self._decompress = _compressor(self.codec)
+            f.seek(index_offset)
+            index = json.loads(self._decompress(f.read()))
+        self.version = version
+        self.kind: str = index['kind']
+        self.created: float = index['created']
+        self.index: Dict[str, list] = index['serials']
+
+    @property
+    def serial_numbers(self) -> List[str]:
+        return list(self.index)
+
+    def records(self, serial_numbers: Optional[Iterable[str]] = None) -> Iterable[Tuple[str, dict]]:
+        """
+        :param serial_numbers: serial numbers to read, all serial numbers in the snapshot if None
+        :type serial_numbers: iterable or None
+        :return: generator of (serial number, record), only the members of the requested serial numbers are read
+        """
+        if serial_numbers is None:
+            serial_numbers = self.index
+        with open(self.file, 'rb') as f:
+            for serial_number in serial_numbers:
+                if serial_number not in self.index:
+                    logger.warning("snapshot: serial number {} not found in {}".format(serial_number, self.file))
+                    continue
+                offset, length, _ = self.index[serial_number]
+                f.seek(offset)
+                for line in self._decompress(f.read(length)).splitlines():
+                    if line:
+                        yield serial_number, json.loads(line)
+
+    def load(self, serial_numbers: Optional[Iterable[str]] = None) -> dict:
+        """
+        rebuild the dictionary that was snapshotted, restricted to serial_numbers if given
+        """
+        if self.kind == INTERFACES:
+            return {tuple(record['interface']): record['details'] for _, record in self.records(serial_numbers)}
+        result: Dict[str, list] = defaultdict(list)
+        for serial_number, record in self.records(serial_numbers):
+            result[serial_number].append(record)
+        return dict(result)
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.file!r})'
+
+
+def load_snapshot(file: str, serial_numbers: Optional[Iterable[str]] = None,
+                  allow_pickle: bool = False) -> Union[dict, object]:
+    """
+    :param file: snapshot or legacy pickle file name
+    :type file: str
+    :param serial_numbers: only return the data for these serial numbers
+    :type serial_numbers: iterable or None
+    :param allow_pickle: load a file that is not a snapshot as a legacy pickle, only for files from trusted
+    locations
+    :type allow_pickle: bool
+    :return: the snapshotted dictionary
+
+    legacy pickle files are loaded whole and then filtered.
+    """
+    if not os.path.isfile(file):
+        logger.critical("Error: file {} not found".format(file))
+        raise DCNMFileError("Error: input file {} not found".format(file))
+    if is_snapshot(file):
+        return SnapshotReader(file).load(serial_numbers)
+    if not allow_pickle:
+        logger.critical("Error: {} is not a snapshot file".format(file))
+        raise DCNMFileError("{0} is not a snapshot file. If it is a pickle written by an earlier version and comes "
+                            "from a trusted location, convert it with: python snapshot.py {0}".format(file))
+    logger.warning("snapshot: {} is a legacy pickle file, loading it whole".format(file))
+    with open(file, 'rb') as f:
+        contents = load(f)
+    if serial_numbers is None or not isinstance(contents, dict):
+        return contents
+    serial_numbers = set(serial_numbers)
+    return {key: value for key, value in contents.items()
+            if (key[1] if isinstance(key, tuple) else key) in serial_numbers}
+
+
+def convert_pickle(file: str, output: Optional[str] = None, codec: str = 'gzip') -> str:
+    """
+    :param file: legacy pickle of interface configurations or switch policies, only from trusted locations
+    :type file: str
+    :param output: snapshot file name, the pickle file name with a .snap extension if None
+    :type output: str or None
+    :param codec: gzip or zstd
+    :type codec: str
+    :return: the snapshot file name
+    :rtype: str
+    """
+    contents = load_snapshot(file, allow_pickle=True)
+    if not isinstance(contents, dict):
+        raise DCNMFileError("{} does not hold interface configurations or switch policies".format(file))
+    if output is None:
+        output = os.path.splitext(file)[0] + '.snap'
+    # interface configurations are keyed by (interface name, serial number), policies by serial number
+    if all(isinstance(key, tuple) for key in contents):
+        dump_interfaces_snapshot(contents, output, codec=codec)
+    else:
+        dump_policies_snapshot(contents, output, codec=codec)
+    return output
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="convert a legacy pickle file to a snapshot. only convert pickles "
+                                                 "from trusted locations, loading a pickle can run arbitrary code")
+    parser.add_argument("file", help="legacy pickle file")
+    parser.add_argument("output", nargs="?", default=None,
+                        help="snapshot file to write, default is the pickle file name with a .snap extension")
+    args = parser.parse_args()
+    print("wrote {}".format(convert_pickle(args.file, args.output)))